@@ -0,0 +1,134 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Apply an osmChange (.osc) file to a database built by process_map or
+insert_into_database.py, instead of rebuilding it from a full extract.
+
+The change file is streamed. Created and modified nodes and ways go through
+the same shape_element (and so the same street and postcode cleaners) as a
+full import and replace the stored element together with its tags and way
+nodes; deleted elements are removed with their tags and way nodes.
+Relations are not stored and are skipped. The spatial index and the rollup
+tables are updated along the way.
+"""
+import sqlite3
+import xml.etree.cElementTree as ET
+from collections import defaultdict
+
+import data_transform
+import osm_sqlite
+import rollups
+import spatial
+
+ACTIONS = ('create', 'modify', 'delete')
+
+# element -> (element table, [child tables keyed on the element id])
+TABLES = {'node': ('nodes', ['nodes_tags']),
+          'way': ('ways', ['ways_tags', 'ways_nodes'])}
+
+
+def iter_changes(osc_file):
+    """Yield (action, element) for every node, way and relation in osc_file"""
+    context = ET.iterparse(osc_file, events=("start", "end"))
+    _, root = next(context)
+    action = None
+    action_elem = None
+    for event, elem in context:
+        if event == "start":
+            if elem.tag in ACTIONS:
+                action, action_elem = elem.tag, elem
+            continue
+        if elem.tag in ('node', 'way', 'relation') and action is not None:
+            yield action, elem
+            action_elem.clear()
+        elif elem.tag in ACTIONS:
+            action = action_elem = None
+            root.clear()
+
+
+class ChangeApplier(object):
+    """Upsert and delete shaped elements in an existing database"""
+
+    def __init__(self, con):
+        self.con = con
+        self.spatial = spatial.has_spatial_index(con)
+        self.rollups = rollups.has_rollups(con)
+        self.upserts = {}
+        for key, table in osm_sqlite.ELEMENT_TABLES:
+            statement, columns = osm_sqlite.insert_statement(con, table)
+            if key in TABLES:
+                statement = statement.replace("INSERT INTO", "INSERT OR REPLACE INTO", 1)
+            self.upserts[key] = (statement, columns)
+
+    def _rows(self, key, records):
+        columns = self.upserts[key][1]
+        return [tuple(record[c] for c in columns) for record in records]
+
+    def delete(self, element_type, element_id):
+        table, children = TABLES[element_type]
+        if self.rollups:
+            rollups.remove_element(self.con, element_type, element_id)
+        for child in children:
+            self.con.execute("DELETE FROM %s WHERE id = ?" % child, (element_id,))
+        self.con.execute("DELETE FROM %s WHERE id = ?" % table, (element_id,))
+        if self.spatial:
+            spatial.delete_element(self.con, element_type, element_id)
+
+    def upsert(self, el):
+        element_type = 'node' if 'node' in el else 'way'
+        _, children = TABLES[element_type]
+        element_id = el[element_type]['id']
+        if self.rollups:
+            rollups.remove_element(self.con, element_type, element_id)
+        for child in children:
+            self.con.execute("DELETE FROM %s WHERE id = ?" % child, (element_id,))
+        for key, value in el.iteritems():
+            records = [value] if isinstance(value, dict) else value
+            if records:
+                self.con.executemany(self.upserts[key][0], self._rows(key, records))
+        if self.rollups:
+            rollups.add_element(self.con, element_type, element_id)
+        if self.spatial:
+            if element_type == 'node':
+                spatial.update_node(self.con, element_id)
+            else:
+                spatial.update_way(self.con, element_id)
+
+
+def apply_changes(osc_file, db_path=data_transform.DB_PATH, validate=False):
+    """Apply osc_file to db_path in one transaction.
+    Returns {(action, element type): count}"""
+    counts = defaultdict(int)
+    validator = data_transform.fast_validator.FastValidator(data_transform.SCHEMA)
+    con = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        applier = ChangeApplier(con)
+        con.execute("BEGIN")
+        for action, element in iter_changes(osc_file):
+            if element.tag not in TABLES:
+                counts[(action, element.tag)] += 1
+                continue
+            if action == 'delete':
+                applier.delete(element.tag, int(element.attrib['id']))
+            else:
+                el = data_transform.shape_element(element)
+                if validate is True:
+                    data_transform.validate_element(el, validator)
+                applier.upsert(el)
+            counts[(action, element.tag)] += 1
+        con.execute("COMMIT")
+    except:
+        con.rollback()
+        raise
+    finally:
+        con.close()
+    return dict(counts)
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+    import pprint
+    if os.path.exists(data_transform.NORMALIZATION_TABLE_PATH):
+        data_transform.load_normalization_tables()
+    pprint.pprint(apply_changes(sys.argv[1]))
@@ -1,10 +1,10 @@
 #!/usr/bin/env python2
 # -*- coding: utf-8 -*-
 
-import xml.etree.cElementTree as ET
 import pprint
 from collections import defaultdict
 import re
+import osm_stream
 
 osmfile = "san_jose_california.osm"
 
@@ -17,13 +17,14 @@ street_type_re = re.compile(r'\S+\.?$', re.IGNORECASE)
 street_types = defaultdict(set)
 
 #expected values based on current usps database
-expected_street = ["Close", "Cove", "Commons", "Bend", "Grove", "Green", "Glen",
+#kept as a set so every lookup in the audit loop is O(1)
+expected_street = frozenset(["Close", "Cove", "Commons", "Bend", "Grove", "Green", "Glen",
             "Gardens", "Heights", "Highway", "Hills", "Landing", "Mall",
             "Meadows", "Park", "Parkway", "Plaza", "Point", "Ridge", "Row",
             "Run", "Spur", "Square", "Station", "Terrace", "Trail", "View",
             "Vista", "Walk", "Wall", "Alley", "Center", "Crescent", "Way",
             "Road", "Street", "Avenue", "Boulevard", "Drive", "Court",
-            "Place", "Alley", "Circle", "Estates", "Lane", "Loop", "Expressway"]
+            "Place", "Alley", "Circle", "Estates", "Lane", "Loop", "Expressway"])
 
 #corrections
 mapping = { "street": "Street",
@@ -81,65 +82,29 @@ def is_street_name(tag):
     return (tag.attrib['k'] == "addr:street")
 
 
-#checks steet types for node and way top level tags
-#prints out the unusual street types in a dictionary format
-#returns the unusual street types
-def audit(osmfile):
-    osm_file = open(osmfile, "r")
-    street_types = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    audit_street_type(street_types, tag.attrib['v'])
-    #pprint.pprint(dict(street_types))                
-    osm_file.close()
-    return street_types
-
-
-#Cleaning the data by replacing the unusual street types with the corrections in mapping
-#prints out the cleaned data
-def fix_street(osmfile):
-    st_types = audit(osmfile)
-    for st_type, ways in st_types.iteritems():
-        for name in ways:
-            if st_type in mapping:
-                better_name = name.replace(st_type, mapping[st_type])
-                print name, "=>", better_name
-
-
-fix_street(osmfile)
-
 #|------------------------|
 #|---Auditing Cities------|
 #|------------------------|
 
-#checks what cities are present in this OSM file
-def audit_city(osmfile):
-    osm_file = open(osmfile, "r")  
-    cities = set()
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if tag.attrib['k'] == "addr:city" and tag.attrib['v'] != "San Jose" and tag.attrib['v'] != "san Jose" and tag.attrib['v'] != "San jose" and tag.attrib['v'] != "san jose":
-                    cities.add(tag.attrib['v'])
-    print "Cities in the OSM file:", cities
+#spellings of the home city that are not reported
+home_city = frozenset(["San Jose", "san Jose", "San jose", "san jose"])
 
-
-audit_city(osmfile)
+def audit_city_name(cities, city):
+    if city not in home_city:
+        cities.add(city)
 
 
 #|--------------------------------------|
 #|---Auditing & Cleaning Zip Codes------|
 #|--------------------------------------|
 
-expected_zipcode = ["94089", "95002", "95008", "95013", "95014", "95032",
+expected_zipcode = frozenset(["94089", "95002", "95008", "95013", "95014", "95032",
                      "95035", "95037", "95050", "95054", "95070", "95110",
                      "95111", "95112", "95113", "95116", "95117", "95118",
                      "95119", "95120", "95121", "95122", "95123", "95124",
                      "95125", "95126", "95127", "95128", "95129", "95130",
                      "95131", "95132", "95133", "95134", "95135", "95136",
-                     "95138", "95139", "95140", "95148"] 
+                     "95138", "95139", "95140", "95148"])
 
 invalid_zipcodes = defaultdict(set)
 
@@ -151,19 +116,6 @@ def audit_zipcode(invalid_zipcodes, zipcode):
 def is_zipcode(tag):
     return (tag.attrib['k'] == "addr:postcode")
 
-def audit_zip(osmfile):
-    osm_file = open(osmfile, "r")
-    invalid_zipcodes = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_zipcode(tag):
-                    audit_zipcode(invalid_zipcodes, tag.attrib['v'])
-    #pprint.pprint(dict(invalid_zipcodes))
-    return invalid_zipcodes
-
-zipcode = audit_zip(osmfile)
-
 #cleaning postal codes
 def fix_zipcode(zipcode):
     letters = re.findall('[a-zA-Z]*', zipcode)
@@ -176,17 +128,106 @@ def fix_zipcode(zipcode):
         return re.findall(r'\d{5}', zipcode)
 
 
-for street_type, ways in zipcode.iteritems():
-    for name in ways:
-        corrected = fix_zipcode(name)
-        print name, "=>", corrected
-        
+#|-----------------------------------------|
+#|---Single pass audit engine--------------|
+#|-----------------------------------------|
 
+#an auditor looks at the value of every tag whose key is in `keys` and records
+#it in its own report, audit_func(report, value). With keys None it sees every
+#tag and is told the key as well, audit_func(report, key, value)
+class Auditor(object):
+    """Collect a report from the tags of node and way elements"""
+
+    def __init__(self, name, keys, audit_func, report_factory=lambda: defaultdict(set)):
+        self.name = name
+        self.keys = frozenset(keys) if keys is not None else None
+        self.audit_func = audit_func
+        self.report_factory = report_factory
+
+
+AUDITORS = []
+
+def register_auditor(name, keys, audit_func, report_factory=lambda: defaultdict(set)):
+    """Add an auditor to the set run by run_audits, replacing one of the same name"""
+    auditor = Auditor(name, keys, audit_func, report_factory)
+    AUDITORS[:] = [a for a in AUDITORS if a.name != name]
+    AUDITORS.append(auditor)
+    return auditor
+
+
+register_auditor("street", ["addr:street"], audit_street_type)
+register_auditor("city", ["addr:city"], audit_city_name, set)
+register_auditor("zip", ["addr:postcode"], audit_zipcode)
+
+
+#streams the file once, handing every node/way tag to the auditors interested
+#in its key. osm_stream clears elements as soon as they end so memory stays flat.
+def run_audits(osmfile, auditors=None):
+    """Run the auditors over osmfile in a single pass and return {name: report}"""
+    if auditors is None:
+        auditors = AUDITORS
+    reports = {}
+    by_key = defaultdict(list)
+    every_tag = []
+    for auditor in auditors:
+        report = auditor.report_factory()
+        reports[auditor.name] = report
+        if auditor.keys is None:
+            every_tag.append((auditor.audit_func, report))
+        else:
+            for key in auditor.keys:
+                by_key[key].append((auditor.audit_func, report))
+
+    for elem in osm_stream.iter_elements(osmfile, ("node", "way")):
+        for tag in elem.iter("tag"):
+            key = tag.attrib['k']
+            value = tag.attrib['v']
+            for audit_func, report in by_key.get(key, ()):
+                audit_func(report, value)
+            for audit_func, report in every_tag:
+                audit_func(report, key, value)
+    return reports
+
+
+def _auditor(name):
+    return [a for a in AUDITORS if a.name == name]
 
 
+#checks steet types for node and way top level tags
+#returns the unusual street types
+def audit(osmfile):
+    return run_audits(osmfile, _auditor("street"))["street"]
 
 
-    
+#checks what cities are present in this OSM file
+def audit_city(osmfile):
+    return run_audits(osmfile, _auditor("city"))["city"]
 
 
+def audit_zip(osmfile):
+    return run_audits(osmfile, _auditor("zip"))["zip"]
+
 
+#Cleaning the data by replacing the unusual street types with the corrections in mapping
+#prints out the cleaned data
+def fix_street(osmfile, st_types=None):
+    if st_types is None:
+        st_types = audit(osmfile)
+    for st_type, ways in st_types.iteritems():
+        for name in ways:
+            if st_type in mapping:
+                better_name = name.replace(st_type, mapping[st_type])
+                print name, "=>", better_name
+
+
+if __name__ == '__main__':
+    reports = run_audits(osmfile)
+
+    fix_street(osmfile, reports["street"])
+
+    print "Cities in the OSM file:", reports["city"]
+
+    for street_type, ways in reports["zip"].iteritems():
+        for name in ways:
+            corrected = fix_zipcode(name)
+            print name, "=>", corrected
@@ -0,0 +1,568 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the hot paths of the wrangling pipeline on seeded synthetic
+OSM files, so that a change to get_element, shape_element, fix_street or
+validate_element can be measured instead of guessed.
+
+generate() writes an extract shaped like san_jose_california.osm: about
+nine nodes to every way, most nodes untagged, ways of a handful to a few
+dozen nodes mostly near each other, a long tail of tag keys and values,
+abbreviated street names and untidy postcodes for the cleaners, a few
+non-ASCII names and keys with problem characters. The same seed and size
+give the same file. generate_changes() writes a small osmChange against a
+database loaded from one, for the tests of code that apply_changes drives.
+
+Every stage runs in a process of its own, so its peak RSS is its own:
+
+  parse        get_element over nodes and ways
+  shape        shape_element (dicts, as used with cerberus and custom sinks)
+  shape_rows   shape_element_rows (tuples, as used by process_map)
+  clean        fix_street and fix_zipcode on every street and postcode value
+  validate     validate_element with the compiled validator
+  csv_write    CSVSink.write_rows of every shaped element
+  sqlite_load  insert_into_database.load_database of the csv_write output
+  process_map  the whole serial csv run, end to end
+
+Only the named step is timed; parsing, for example, is not part of the
+shape figure. Results are JSON, {size: {'stages': {stage: {'seconds',
+'items', 'per_second', 'peak_rss_mb'}}}}, and compare() checks them against
+a saved baseline:
+
+    python benchmark.py --sizes 10MB --save baseline.json
+    python benchmark.py --sizes 10MB --baseline baseline.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import data_transform
+import fast_validator
+import insert_into_database
+import osm_stream
+
+SIZES = {'10MB': 10, '100MB': 100, '1GB': 1024}
+STAGES = ('parse', 'shape', 'shape_rows', 'clean', 'validate', 'csv_write', 'sqlite_load',
+          'process_map')
+DATA_DIR = "benchmark_data"
+RESULTS_PATH = "benchmark_results.json"
+TOLERANCE = 0.10
+
+# about 30% of the bytes of an extract are in its ways
+NODE_SHARE = 0.7
+
+
+# ================================================== #
+#               Synthetic OSM                        #
+# ================================================== #
+STREET_NAMES = ['Almaden', 'Bascom', 'Berryessa', 'Blossom Hill', 'Camden', 'Capitol',
+                'Curtner', 'Hamilton', 'Hillsdale', 'King', 'Meridian', 'Monterey',
+                'Saratoga', 'Snell', 'Story', 'Tully', 'Winchester', 'Stevens Creek',
+                u'Alameda de las Pulgas', u'Paseo de San Antonio', u'Calle Se\xf1ora']
+STREET_TYPES = ['Street', 'Avenue', 'Road', 'Drive', 'Court', 'Way', 'Lane', 'Boulevard',
+                'Circle', 'Expressway', 'St', 'Ave', 'Rd.', 'Dr', 'Ct', 'Blvd', 'St.', 'Ln.',
+                'Pkwy', 'street', 'ave', 'Sq']
+POSTCODES = ['95112', '95110', '95125', '95014', '95050', '95008', '94089', '95126',
+             'CA 95014', '95110-1234', '95129-3421', '9511', 'CA', '95035']
+CITIES = ['San Jose', 'San Jose', 'Santa Clara', 'Sunnyvale', 'Cupertino', 'Campbell',
+          'Milpitas', 'Los Gatos', 'san jose', 'San Jos\xc3\xa9'.decode('utf-8')]
+AMENITIES = ['parking', 'restaurant', 'school', 'place_of_worship', 'fast_food', 'cafe',
+             'bench', 'bank', 'fuel', 'toilets', 'post_box', 'pharmacy', 'bicycle_parking']
+CUISINES = ['mexican', 'pizza', 'chinese', 'vietnamese', 'burger', 'japanese', 'sandwich',
+            'indian', 'coffee_shop', 'thai', 'korean', 'american']
+HIGHWAYS = ['residential', 'service', 'footway', 'tertiary', 'secondary', 'primary',
+            'crossing', 'traffic_signals', 'stop', 'turning_circle']
+BUILDINGS = ['yes', 'yes', 'yes', 'house', 'residential', 'commercial', 'garage', 'apartments']
+
+# (key, weight, values); values None means a free text value
+NODE_KEYS = [('highway', 30, HIGHWAYS), ('name', 15, None), ('amenity', 12, AMENITIES),
+             ('addr:housenumber', 10, None), ('addr:street', 10, None),
+             ('addr:postcode', 6, POSTCODES), ('addr:city', 6, CITIES),
+             ('cuisine', 4, CUISINES), ('created_by', 5, ['JOSM', 'Potlatch 0.10f']),
+             ('power', 4, ['tower', 'pole']), ('source', 4, ['survey', 'bing', 'tiger']),
+             ('shop', 3, ['convenience', 'supermarket', 'clothes', 'hairdresser']),
+             ('gnis:feature_id', 2, None), ('postcode', 1, POSTCODES),
+             ('name:en', 1, None), ('fixme', 1, None), ('FIXME', 1, None),
+             ('name 1', 1, None), ('maxspeed?', 1, ['25 mph'])]
+WAY_KEYS = [('building', 40, BUILDINGS), ('highway', 35, HIGHWAYS), ('name', 20, None),
+            ('tiger:county', 12, ['Santa Clara, CA']), ('tiger:cfcc', 10, ['A41', 'A45']),
+            ('tiger:reviewed', 8, ['no']), ('oneway', 8, ['yes', '-1']),
+            ('addr:street', 6, None), ('addr:housenumber', 6, None),
+            ('addr:postcode', 4, POSTCODES), ('lanes', 4, ['1', '2', '3', '4']),
+            ('surface', 3, ['asphalt', 'concrete', 'paved']), ('amenity', 3, AMENITIES),
+            ('landuse', 3, ['residential', 'grass', 'retail']), ('source', 2, ['bing', 'tiger'])]
+
+# San Jose
+MIN_LAT, MIN_LON, MAX_LAT, MAX_LON = 37.12, -122.05, 37.47, -121.59
+
+
+def _cumulative(weighted):
+    total, cumulative = 0, []
+    for key, weight, values in weighted:
+        total += weight
+        cumulative.append(total)
+    return cumulative, total
+
+
+def _escape(value):
+    return (value.replace('&', '&amp;').replace('<', '&lt;')
+            .replace('"', '&quot;').replace('>', '&gt;'))
+
+
+class _Generator(object):
+
+    def __init__(self, seed):
+        self.random = random.Random(seed)
+        self.node_keys = NODE_KEYS, _cumulative(NODE_KEYS)
+        self.way_keys = WAY_KEYS, _cumulative(WAY_KEYS)
+        self.changeset = 1000000
+        self.timestamp = 1262304000
+
+    def _user(self):
+        # a few accounts make most of the edits
+        uid = min(int(self.random.paretovariate(0.8)), 5000)
+        return uid, u'mapper_%d' % uid if uid % 97 else u'cart\xf3grafo_%d' % uid
+
+    def _value(self, key, values):
+        rnd = self.random
+        if values is not None:
+            return rnd.choice(values)
+        if key == 'addr:street':
+            return u'%s %s' % (rnd.choice(STREET_NAMES), rnd.choice(STREET_TYPES))
+        if key == 'addr:housenumber':
+            return unicode(rnd.randint(1, 9999))
+        if key == 'gnis:feature_id':
+            return unicode(rnd.randint(200000, 2800000))
+        if key.startswith('name'):
+            if rnd.random() < 0.5:
+                return u'%s %s' % (rnd.choice(STREET_NAMES), rnd.choice(STREET_TYPES))
+            return u'%s & %s #%d' % (rnd.choice(STREET_NAMES), rnd.choice(CUISINES).title(),
+                                     rnd.randint(1, 500))
+        return u'check %d' % rnd.randint(1, 100)
+
+    def _tags(self, count, keys):
+        weighted, (cumulative, total) = keys
+        chosen = {}
+        for _ in xrange(count):
+            r = self.random.random() * total
+            for i, bound in enumerate(cumulative):
+                if r < bound:
+                    break
+            key, _, values = weighted[i]
+            chosen[key] = self._value(key, values)
+        return ''.join(u'    <tag k="%s" v="%s"/>\n' % (k, _escape(v))
+                       for k, v in sorted(chosen.iteritems()))
+
+    def _attributes(self, element_id):
+        rnd = self.random
+        uid, user = self._user()
+        self.timestamp += rnd.randint(0, 600)
+        if rnd.random() < 0.05:
+            self.changeset += rnd.randint(1, 50)
+        return u'id="%d" version="%d" timestamp="%s" changeset="%d" uid="%d" user="%s"' % (
+            element_id, min(int(rnd.expovariate(0.6)) + 1, 40),
+            time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.timestamp)),
+            self.changeset, uid, _escape(user))
+
+    def node(self, node_id):
+        rnd = self.random
+        lat = MIN_LAT + rnd.random() * (MAX_LAT - MIN_LAT)
+        lon = MIN_LON + rnd.random() * (MAX_LON - MIN_LON)
+        attributes = self._attributes(node_id)
+        coords = u'lat="%.7f" lon="%.7f"' % (lat, lon)
+        if rnd.random() >= 0.08:
+            return u'  <node %s %s/>\n' % (attributes, coords)
+        return u'  <node %s %s>\n%s  </node>\n' % (
+            attributes, coords, self._tags(1 + int(rnd.expovariate(0.6)), self.node_keys))
+
+    def way(self, way_id, node_ids):
+        rnd = self.random
+        length = min(2 + int(rnd.expovariate(0.14)), 200)
+        # ways mostly use nodes that were added around the same time
+        start = rnd.randint(0, len(node_ids) - 1)
+        refs = []
+        for i in xrange(length):
+            if rnd.random() < 0.9:
+                refs.append(node_ids[(start + i) % len(node_ids)])
+            else:
+                refs.append(rnd.choice(node_ids))
+        if rnd.random() < 0.3:
+            refs.append(refs[0])  # closed ways, e.g. buildings
+        return u'  <way %s>\n%s%s  </way>\n' % (
+            self._attributes(way_id),
+            ''.join(u'    <nd ref="%d"/>\n' % ref for ref in refs),
+            self._tags(1 + int(rnd.expovariate(0.5)), self.way_keys))
+
+
+def generate(path, size_mb, seed=0):
+    """Write a synthetic OSM file of about size_mb megabytes to path and
+    return {'nodes': n, 'ways': n, 'bytes': n}"""
+    target = int(size_mb * 1048576)
+    gen = _Generator(seed)
+    node_ids = []
+    node_id = 25000000
+    way_id = 4000000
+    with open(path, 'wb') as out:
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                  '<osm version="0.6" generator="benchmark.py">\n'
+                  '  <bounds minlat="%s" minlon="%s" maxlat="%s" maxlon="%s"/>\n'
+                  % (MIN_LAT, MIN_LON, MAX_LAT, MAX_LON))
+        while out.tell() < target * NODE_SHARE or not node_ids:
+            node_id += 1 + int(gen.random.expovariate(0.5))
+            node_ids.append(node_id)
+            out.write(gen.node(node_id).encode('utf-8'))
+        ways = 0
+        while out.tell() < target or not ways:
+            way_id += 1 + int(gen.random.expovariate(0.5))
+            ways += 1
+            out.write(gen.way(way_id, node_ids).encode('utf-8'))
+        out.write('</osm>\n')
+        size = out.tell()
+    return {'nodes': len(node_ids), 'ways': ways, 'bytes': size}
+
+
+CHANGES = u'''<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6" generator="benchmark.py">
+<modify>
+  <node id="%(node)d" lat="37.3" lon="-121.9" %(attributes)s>
+    <tag k="amenity" v="cafe"/>
+    <tag k="addr:city" v="san jose"/>
+    <tag k="test:flavour" v="a value not seen before"/>
+  </node>
+  <way id="%(way)d" %(attributes)s>
+    <nd ref="%(node)d"/><nd ref="%(created)d"/>
+    <tag k="highway" v="residential"/>
+    <tag k="name" v="Calle Se\xf1ora"/>
+  </way>
+</modify>
+<create>
+  <node id="%(created)d" lat="37.2" lon="-121.8" %(attributes)s>
+    <tag k="cuisine" v="pizza"/>
+  </node>
+</create>
+<delete>
+  <node id="%(deleted_node)d" lat="0" lon="0" %(attributes)s/>
+  <way id="%(deleted_way)d" %(attributes)s/>
+</delete>
+</osmChange>
+'''
+
+
+def generate_changes(path, con):
+    """Write to path an osmChange for the database at con (one built from a
+    generated file) that modifies, creates and deletes tagged nodes and ways,
+    by a user not seen before. Returns the ids, {'node': id, 'way': id,
+    'created': id, 'deleted_node': id, 'deleted_way': id}"""
+    nodes = [row[0] for row in con.execute("SELECT DISTINCT id FROM nodes_tags ORDER BY id LIMIT 2")]
+    ways = [row[0] for row in con.execute("SELECT DISTINCT id FROM ways_tags ORDER BY id LIMIT 2")]
+    ids = {'node': nodes[0], 'deleted_node': nodes[1], 'way': ways[0], 'deleted_way': ways[1],
+           'created': 1}
+    attributes = ('version="99" timestamp="2017-01-01T00:00:00Z" changeset="1" '
+                  'uid="999999" user="change_tester"')
+    with open(path, 'wb') as out:
+        out.write((CHANGES % dict(ids, attributes=attributes)).encode('utf-8'))
+    return ids
+
+
+def data_file(size, seed=0, data_dir=DATA_DIR):
+    """Path of the synthetic file for size ('10MB', ...), generated on first
+    use"""
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    path = os.path.join(data_dir, 'synthetic_%s_%d.osm' % (size, seed))
+    if not os.path.exists(path):
+        generate(path + '.tmp', SIZES[size], seed)
+        os.rename(path + '.tmp', path)
+    return path
+
+
+# ================================================== #
+#               Stages                               #
+# ================================================== #
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _elements(osm_file):
+    return data_transform.get_element(osm_file, tags=('node', 'way'))
+
+
+def _parse(osm_file, work_dir):
+    clock = time.time
+    count = 0
+    start = clock()
+    for _ in _elements(osm_file):
+        count += 1
+    return count, clock() - start
+
+
+def _timed_shape(shape):
+    def stage(osm_file, work_dir):
+        clock = time.time
+        count = 0
+        seconds = 0.0
+        for element in _elements(osm_file):
+            start = clock()
+            shape(element)
+            seconds += clock() - start
+            count += 1
+        return count, seconds
+    return stage
+
+
+def _clean(osm_file, work_dir):
+    # the raw cleaners, without the Normalizer lookups shaping goes through
+    streets, postcodes = [], []
+    for element in _elements(osm_file):
+        for tag in element.iter('tag'):
+            k = tag.attrib['k']
+            if k == 'addr:street':
+                streets.append(tag.attrib['v'])
+            elif k in ('addr:postcode', 'postcode'):
+                postcodes.append(tag.attrib['v'])
+    fix_street, fix_zipcode, mapping = (data_transform.fix_street, data_transform.fix_zipcode,
+                                        data_transform.mapping)
+    start = time.time()
+    for name in streets:
+        fix_street(name, mapping)
+    for postcode in postcodes:
+        fix_zipcode(postcode)
+    return len(streets) + len(postcodes), time.time() - start
+
+
+def _validate(osm_file, work_dir):
+    validator = fast_validator.FastValidator(data_transform.SCHEMA)
+    validate_element, shape_element = data_transform.validate_element, data_transform.shape_element
+    clock = time.time
+    count = 0
+    seconds = 0.0
+    for element in _elements(osm_file):
+        shaped = shape_element(element)
+        start = clock()
+        validate_element(shaped, validator)
+        seconds += clock() - start
+        count += 1
+    return count, seconds
+
+
+def _csv_paths(work_dir):
+    return [os.path.join(work_dir, path) for path, _ in data_transform.CSV_OUTPUTS]
+
+
+def _csv_write(osm_file, work_dir):
+    shape = data_transform.shape_element_rows
+    clock = time.time
+    count = 0
+    seconds = 0.0
+    start = clock()
+    sink = data_transform.CSVSink(_csv_paths(work_dir))
+    seconds += clock() - start
+    for element in _elements(osm_file):
+        rows = shape(element)
+        start = clock()
+        sink.write_rows(rows)
+        seconds += clock() - start
+        count += 1
+    start = clock()
+    sink.close()
+    return count, seconds + clock() - start
+
+
+def _sqlite_load(osm_file, work_dir):
+    if not os.path.exists(_csv_paths(work_dir)[0]):
+        _csv_write(osm_file, work_dir)
+    db_path = os.path.join(work_dir, 'benchmark.db')
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    start = time.time()
+    stats = insert_into_database.load_database(db_path, work_dir, verbose=False)
+    seconds = time.time() - start
+    return sum(rows for rows, _ in stats.itervalues()), seconds
+
+
+def _process_map(osm_file, work_dir):
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        start = time.time()
+        data_transform.process_map(os.path.join(cwd, osm_file), validate=True)
+        seconds = time.time() - start
+    finally:
+        os.chdir(cwd)
+    return sum(1 for _ in _elements(osm_file)), seconds
+
+
+STAGE_FUNCTIONS = {'parse': _parse,
+                   'shape': _timed_shape(data_transform.shape_element),
+                   'shape_rows': _timed_shape(data_transform.shape_element_rows),
+                   'clean': _clean,
+                   'validate': _validate,
+                   'csv_write': _csv_write,
+                   'sqlite_load': _sqlite_load,
+                   'process_map': _process_map}
+
+# what the items counted by each stage are
+STAGE_UNITS = {'clean': 'values', 'sqlite_load': 'rows'}
+
+
+def _run_stage(args):
+    stage, osm_file, work_dir = args
+    items, seconds = STAGE_FUNCTIONS[stage](osm_file, work_dir)
+    return {'seconds': round(seconds, 4),
+            'items': items,
+            'unit': STAGE_UNITS.get(stage, 'elements'),
+            'per_second': round(items / seconds, 1) if seconds else None,
+            'peak_rss_mb': round(_peak_rss_mb(), 1)}
+
+
+def run_stage(stage, osm_file, work_dir):
+    """Run one stage in a fresh process and return its measurements"""
+    pool = multiprocessing.Pool(1)
+    try:
+        result = pool.apply(_run_stage, ((stage, osm_file, work_dir),))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return result
+
+
+def run(sizes=('10MB',), stages=STAGES, seed=0, data_dir=DATA_DIR, repeat=1, verbose=True):
+    """Benchmark stages on the synthetic file of each size. With repeat > 1
+    the fastest run of each stage is kept."""
+    results = {'python': platform.python_version(),
+               'backend': osm_stream.BACKEND,
+               'machine': platform.machine(),
+               'cpus': multiprocessing.cpu_count(),
+               'seed': seed,
+               'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+               'sizes': {}}
+    for size in sizes:
+        osm_file = data_file(size, seed, data_dir)
+        work_dir = tempfile.mkdtemp(prefix='benchmark_', dir=data_dir)
+        measured = {}
+        try:
+            for stage in stages:
+                for _ in xrange(repeat):
+                    result = run_stage(stage, osm_file, work_dir)
+                    if stage not in measured or result['seconds'] < measured[stage]['seconds']:
+                        measured[stage] = result
+                if verbose:
+                    print_stage(size, stage, measured[stage])
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        results['sizes'][size] = {'bytes': os.path.getsize(osm_file), 'stages': measured}
+    return results
+
+
+def print_stage(size, stage, result):
+    print "%-6s %-12s %9.2fs %12s %-8s/s %8.1fMB" % (
+        size, stage, result['seconds'],
+        '%.0f' % result['per_second'] if result['per_second'] else '-',
+        result['unit'], result['peak_rss_mb'])
+
+
+# ================================================== #
+#               Baselines                            #
+# ================================================== #
+def save(results, path=RESULTS_PATH):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load(path=RESULTS_PATH):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """[(size, stage, baseline per_second, per_second, change)] for the
+    stages measured in both, change being the relative difference in
+    throughput, and the list of those slower by more than tolerance"""
+    rows = []
+    regressions = []
+    for size, measured in sorted(results['sizes'].iteritems()):
+        before = baseline['sizes'].get(size, {}).get('stages', {})
+        for stage in STAGES:
+            if stage not in measured['stages'] or stage not in before:
+                continue
+            old, new = before[stage]['per_second'], measured['stages'][stage]['per_second']
+            if not old or not new:
+                continue
+            row = (size, stage, old, new, new / old - 1)
+            rows.append(row)
+            if row[4] < -tolerance:
+                regressions.append(row)
+    return rows, regressions
+
+
+def print_comparison(rows):
+    for size, stage, old, new, change in rows:
+        print "%-6s %-12s %12.0f -> %12.0f /s %+7.1f%%" % (size, stage, old, new, 100 * change)
+
+
+# ================================================== #
+#               Quick self check                     #
+# ================================================== #
+def test():
+    data_dir = tempfile.mkdtemp(prefix='benchmark_test_')
+    try:
+        path = os.path.join(data_dir, 'small.osm')
+        counts = generate(path, 0.5, seed=7)
+        again = generate(path + '.2', 0.5, seed=7)
+        assert counts == again, (counts, again)
+        assert open(path, 'rb').read() == open(path + '.2', 'rb').read()
+        assert 5 < counts['nodes'] / float(counts['ways']) < 15, counts
+        # the file goes through the whole pipeline with validation on
+        work_dir = os.path.join(data_dir, 'work')
+        os.makedirs(work_dir)
+        result = _run_stage(('process_map', path, work_dir))
+        assert result['items'] == counts['nodes'] + counts['ways'], (result, counts)
+        result = _run_stage(('sqlite_load', path, work_dir))
+        assert result['items'] > counts['nodes'] + counts['ways'], result
+        baseline = {'sizes': {'10MB': {'stages': {'parse': {'per_second': 1000.0},
+                                                  'shape': {'per_second': 1000.0}}}}}
+        current = {'sizes': {'10MB': {'stages': {'parse': {'per_second': 800.0},
+                                                 'shape': {'per_second': 950.0}}}}}
+        rows, regressions = compare(current, baseline)
+        assert len(rows) == 2 and [row[1] for row in regressions] == ['parse'], rows
+        print "benchmark: %(nodes)d nodes, %(ways)d ways, %(bytes)d bytes" % counts
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the wrangling pipeline stages")
+    parser.add_argument('--sizes', nargs='+', default=['10MB'], choices=sorted(SIZES))
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=STAGES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--save', default=RESULTS_PATH, help="where to write the results")
+    parser.add_argument('--baseline', help="results file to compare against")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.stages, args.seed, args.data_dir, args.repeat)
+    save(results, args.save)
+    if args.baseline:
+        rows, regressions = compare(results, load(args.baseline), args.tolerance)
+        print_comparison(rows)
+        if regressions:
+            print "%d stage(s) slower than the baseline by more than %d%%" % (
+                len(regressions), 100 * args.tolerance)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,116 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Checkpoints that let an interrupted process_map run carry on where it
+stopped instead of starting again from byte zero.
+
+A checkpoint is a small JSON file recording, after an element has been
+written: the element (tag and id), an input offset at or before the start
+of that element, and the size of every output file. Resuming truncates the
+outputs to those sizes, which drops anything written after the checkpoint,
+parses the input again from the first node or way at or after the offset
+(osm_chunks.find_boundary) and skips elements up to and including the
+checkpointed one.
+
+The offsets come from CountingReader: iterparse only reads more input once
+it has handed out every event of the previous read, so when an element is
+yielded its end lies within the last read, and "bytes read minus the size
+of the last read" cannot be past it. That bound for one element is then a
+safe start for the next.
+"""
+import json
+import os
+
+import osm_chunks
+
+
+class CountingReader(object):
+    """File wrapper that knows how far into the underlying file it has read.
+    prefix is returned before the file contents and not counted."""
+
+    def __init__(self, f, start=0, prefix=''):
+        self._file = f
+        self._prefix = prefix
+        self.position = start
+        self.last_read = 0
+
+    def read(self, size=-1):
+        if self._prefix:
+            if size is None or size < 0:
+                size = len(self._prefix)
+            data, self._prefix = self._prefix[:size], self._prefix[size:]
+            self.last_read = 0
+            return data
+        data = self._file.read(size)
+        self.position += len(data)
+        self.last_read = len(data)
+        return data
+
+    def safe_offset(self):
+        """An offset no later than the end of the element just parsed, and so
+        no later than the start of the next one"""
+        return self.position - self.last_read
+
+
+def input_state(file_in):
+    stat = os.stat(file_in)
+    return {'input': os.path.abspath(file_in), 'input_size': stat.st_size,
+            'input_mtime': int(stat.st_mtime)}
+
+
+def save(path, file_in, offset, last, files, elements):
+    """Record a checkpoint after element last = (tag, id). files are the
+    open outputs; they are flushed to disk first."""
+    outputs = []
+    for f in files:
+        f.flush()
+        os.fsync(f.fileno())
+        outputs.append([os.path.abspath(f.name), f.tell()])
+    state = input_state(file_in)
+    state.update({'offset': offset, 'last': list(last), 'outputs': outputs,
+                  'elements': elements})
+    # written aside and renamed, so a crash never leaves half a checkpoint
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(path + '.tmp', path)
+
+
+def load(path):
+    """The saved checkpoint, or None"""
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def clear(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def check_input(state, file_in):
+    """Raise ValueError unless file_in is the file the checkpoint was taken on"""
+    current = input_state(file_in)
+    for key in ('input', 'input_size', 'input_mtime'):
+        if state[key] != current[key]:
+            raise ValueError("checkpoint was taken on a different input (%s: %r != %r)"
+                             % (key, state[key], current[key]))
+
+
+def truncate_outputs(state):
+    """Cut every output back to its size at the checkpoint"""
+    for path, size in state['outputs']:
+        with open(path, 'r+b') as f:
+            f.truncate(size)
+
+
+def resume_reader(raw, state):
+    """A CountingReader over the rest of the open input raw, starting at or
+    before the checkpointed element, wrapped in a new <osm> element"""
+    start = osm_chunks.find_boundary(raw, state['offset'])
+    if start is None:
+        raise ValueError("no element found after checkpoint offset %d" % state['offset'])
+    raw.seek(start)
+    return CountingReader(raw, start, osm_chunks.OSMChunk.prefix)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Streaming access to .gz and .bz2 files, so compressed OSM extracts and csvs
+can be read and written without a decompressed copy on disk.
+
+Where a command line (de)compressor is installed it runs as a separate
+process connected by a pipe, which moves the (de)compression off the
+parsing process: pigz and lbzip2/pbzip2 are preferred as they use every
+core, then plain gzip and bzip2. Without one the standard library modules
+are used. bz2.BZ2File in Python 2 stops after the first stream, so
+multi-stream files (as written by pbzip2, lbzip2 or by concatenating
+shards) are read with a decompressor that starts over at each stream.
+
+Both formats allow compressed files to be concatenated, which is how
+process_map_parallel joins compressed csv shards.
+"""
+import bz2
+import gzip
+import io
+import os
+import subprocess
+from cStringIO import StringIO
+from distutils.spawn import find_executable
+
+BLOCK_SIZE = 1 << 20
+GZIP_LEVEL = 6
+
+# suffix -> command line tools in order of preference
+TOOLS = {'.gz': ('pigz', 'gzip'),
+         '.bz2': ('lbzip2', 'pbzip2', 'bzip2')}
+USE_TOOLS = True
+
+_found = {}
+
+
+def compression(path):
+    """'.gz', '.bz2' or None"""
+    if isinstance(path, basestring):
+        for suffix in TOOLS:
+            if path.endswith(suffix):
+                return suffix
+    return None
+
+
+def is_compressed(path):
+    return compression(path) is not None
+
+
+def find(path):
+    """path, or path.gz / path.bz2 if only a compressed copy exists"""
+    if not os.path.exists(path):
+        for suffix in sorted(TOOLS):
+            if os.path.exists(path + suffix):
+                return path + suffix
+    return path
+
+
+def tool(suffix):
+    """The preferred installed command line tool for suffix, or None"""
+    if suffix not in _found:
+        _found[suffix] = next((name for name in TOOLS[suffix] if find_executable(name)), None)
+    return _found[suffix] if USE_TOOLS else None
+
+
+# ================================================== #
+#               Reading                              #
+# ================================================== #
+class _ToolReader(object):
+    """stdout of a decompressor process, as a read-only file"""
+
+    def __init__(self, command, path):
+        self.name = path
+        self._command = command
+        self._process = subprocess.Popen(command + [path], stdout=subprocess.PIPE,
+                                         bufsize=BLOCK_SIZE)
+        self._file = self._process.stdout
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def readline(self, size=-1):
+        return self._file.readline(size)
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def close(self):
+        if self._file.closed:
+            return
+        finished = self._process.poll() is not None
+        self._file.close()
+        code = self._process.wait()
+        # a reader that stops early kills the tool with SIGPIPE
+        if code > 0 or (code < 0 and finished):
+            raise IOError("%s failed reading %s (exit status %d)" % (self._command[0], self.name, code))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _MultiStreamBZ2(io.RawIOBase):
+    """Raw reader over every bz2 stream in a file"""
+
+    def __init__(self, path):
+        io.RawIOBase.__init__(self)
+        self._file = open(path, 'rb')
+        self._decompressor = bz2.BZ2Decompressor()
+        # decompressed data not yet read is self._pending[self._offset:]
+        self._pending = ''
+        self._offset = 0
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        while self._offset >= len(self._pending):
+            data = self._file.read(BLOCK_SIZE)
+            if not data:
+                return
+            pieces = []
+            while data:
+                try:
+                    pieces.append(self._decompressor.decompress(data))
+                except EOFError:
+                    # the previous stream ended exactly at a block boundary
+                    self._decompressor = bz2.BZ2Decompressor()
+                    continue
+                data = self._decompressor.unused_data
+                if data:
+                    self._decompressor = bz2.BZ2Decompressor()
+            self._pending = ''.join(pieces)
+            self._offset = 0
+
+    def readinto(self, b):
+        self._fill()
+        start = self._offset
+        n = min(len(b), len(self._pending) - start)
+        b[:n] = self._pending[start:start + n]
+        self._offset = start + n
+        return n
+
+    def close(self):
+        self._file.close()
+        io.RawIOBase.close(self)
+
+
+def open_input(path):
+    """A file object streaming the decompressed contents of path, or path
+    itself opened for reading if it is not compressed"""
+    suffix = compression(path)
+    if suffix is None:
+        return open(path, 'rb')
+    command = tool(suffix)
+    if command is not None:
+        return _ToolReader([command, '-dc'], path)
+    if suffix == '.gz':
+        return gzip.open(path, 'rb')
+    return io.BufferedReader(_MultiStreamBZ2(path), BLOCK_SIZE)
+
+
+# ================================================== #
+#               Writing                              #
+# ================================================== #
+class _ToolWriter(object):
+    """stdin of a compressor process writing to path, as a write-only file"""
+
+    def __init__(self, command, path):
+        self.name = path
+        self._command = command
+        self._out = open(path, 'wb')
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=self._out,
+                                         bufsize=BLOCK_SIZE)
+        self._file = self._process.stdin
+
+    def write(self, data):
+        self._file.write(data)
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.close()
+        code = self._process.wait()
+        self._out.close()
+        if code != 0:
+            raise IOError("%s failed writing %s (exit status %d)" % (self._command[0], self.name, code))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_output(path, use_tools=True):
+    """A file object compressing what is written to it into path according
+    to its suffix. use_tools=False keeps the compression in this process,
+    e.g. in pool workers that already run one per core."""
+    suffix = compression(path)
+    if suffix is None:
+        return open(path, 'wb')
+    command = tool(suffix) if use_tools else None
+    if command is not None:
+        return _ToolWriter([command, '-c'], path)
+    if suffix == '.gz':
+        return gzip.open(path, 'wb', GZIP_LEVEL)
+    return bz2.BZ2File(path, 'wb')
+
+
+def compress(data, suffix):
+    """data as one complete .gz or .bz2 stream, for concatenating to a file"""
+    if suffix == '.gz':
+        buf = StringIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=GZIP_LEVEL) as f:
+            f.write(data)
+        return buf.getvalue()
+    if suffix == '.bz2':
+        return bz2.compress(data)
+    return data
@@ -0,0 +1,209 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Write a small sample of a large OSM file that the whole pipeline (auditing,
+shaping, validation, the database load) can run on in seconds.
+
+One of three modes picks the nodes and ways:
+
+  stride=k      every k-th node and way, as in the usual Udacity snippet
+  ratio=r       each node and way with probability r; the choice is made by
+                hashing (seed, type, id), so the same elements are chosen
+                whatever else is in the file
+  bbox=(min_lat, min_lon, max_lat, max_lon)
+                the nodes inside the box and the ways using any of them
+
+With closure=True (the default) every node used by a sampled way is written
+as well, so ways_nodes -> nodes references hold in the sample. The input is
+read once; as the ways come after the nodes, nodes and ways are spooled to
+temporary files and the sample is put together from those at the end.
+Relations are not sampled.
+"""
+import hashlib
+import os
+import re
+import shutil
+import sqlite3
+import struct
+import tempfile
+
+import compressed_io
+import osm_stream
+
+OSM_FILE = "san_jose_california.osm"
+SAMPLE_FILE = "sample.osm"
+
+ATTRIBUTE_ORDER = ('id', 'lat', 'lon', 'version', 'timestamp', 'changeset', 'uid', 'user', 'visible')
+_ESCAPE = re.compile(r'[&<>"\n\r\t]')
+_ENTITIES = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;',
+             '\n': '&#10;', '\r': '&#13;', '\t': '&#9;'}
+_UINT64 = struct.Struct('<Q')
+
+
+def _quote(value):
+    # most values need no escaping, so only those that do go through sub()
+    if _ESCAPE.search(value):
+        value = _ESCAPE.sub(lambda m: _ENTITIES[m.group()], value)
+    return '"%s"' % value
+
+
+def _attributes(attrib):
+    names = [name for name in ATTRIBUTE_ORDER if name in attrib]
+    names += sorted(name for name in attrib if name not in ATTRIBUTE_ORDER)
+    return ''.join(' %s=%s' % (name, _quote(attrib[name])) for name in names)
+
+
+def to_xml(element):
+    """element and its children as UTF-8 encoded OSM XML"""
+    children = list(element)
+    if not children:
+        text = u'  <%s%s/>\n' % (element.tag, _attributes(element.attrib))
+    else:
+        text = u'  <%s%s>\n%s  </%s>\n' % (
+            element.tag, _attributes(element.attrib),
+            u''.join(u'    <%s%s/>\n' % (child.tag, _attributes(child.attrib)) for child in children),
+            element.tag)
+    return text.encode('utf-8')
+
+
+# ================================================== #
+#               Selection                            #
+# ================================================== #
+def hash_unit(seed, tag, element_id):
+    """A number in [0, 1) fixed by (seed, tag, element_id)"""
+    digest = hashlib.md5('%s:%s:%s' % (seed, tag, element_id)).digest()
+    return _UINT64.unpack(digest[:8])[0] / 18446744073709551616.0
+
+
+class _Selector(object):
+
+    def __init__(self, stride, ratio, bbox, seed):
+        if [stride, ratio, bbox].count(None) != 2:
+            raise ValueError("pass exactly one of stride, ratio and bbox")
+        self.stride = stride
+        self.ratio = ratio
+        self.bbox = bbox
+        self.seed = seed
+        self.count = 0
+        self.in_box = set()
+
+    def __call__(self, element):
+        self.count += 1
+        if self.stride is not None:
+            return (self.count + self.seed) % self.stride == 0
+        if self.ratio is not None:
+            return hash_unit(self.seed, element.tag, element.attrib['id']) < self.ratio
+        if element.tag == 'node':
+            min_lat, min_lon, max_lat, max_lon = self.bbox
+            inside = (min_lat <= float(element.attrib['lat']) <= max_lat and
+                      min_lon <= float(element.attrib['lon']) <= max_lon)
+            if inside:
+                self.in_box.add(element.attrib['id'])
+            return inside
+        return any(nd.attrib['ref'] in self.in_box for nd in element.iter('nd'))
+
+
+# ================================================== #
+#               Sampling                             #
+# ================================================== #
+def _spool(f, element_id, selected, data):
+    f.write('%s %d %d\n' % (element_id, selected, len(data)))
+    f.write(data)
+
+
+def _unspool(f):
+    while True:
+        header = f.readline()
+        if not header:
+            return
+        element_id, selected, size = header.split()
+        yield element_id, selected == '1', f.read(int(size))
+
+
+def create_sample(osm_file=OSM_FILE, sample_file=SAMPLE_FILE, stride=None, ratio=None,
+                  bbox=None, seed=0, closure=True):
+    """Write the sample to sample_file and return the number of nodes and
+    ways written, {'node': n, 'way': n, 'closure': nodes added for ways}"""
+    if stride is None and ratio is None and bbox is None:
+        stride = 10
+    select = _Selector(stride, ratio, bbox, seed)
+    counts = {'node': 0, 'way': 0, 'closure': 0}
+    spool_dir = os.path.dirname(os.path.abspath(sample_file))
+    with compressed_io.open_output(sample_file) as out, \
+         tempfile.TemporaryFile(dir=spool_dir) as nodes, \
+         tempfile.TemporaryFile(dir=spool_dir) as ways:
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                  '<osm version="0.6" generator="create_sample.py">\n')
+        if bbox is not None:
+            out.write('  <bounds minlat="%s" minlon="%s" maxlat="%s" maxlon="%s"/>\n' % tuple(bbox))
+        needed = set()
+        for element in osm_stream.iter_elements(osm_file, ('bounds', 'node', 'way')):
+            if element.tag == 'bounds':
+                if bbox is None:
+                    out.write(to_xml(element))
+                continue
+            selected = select(element)
+            if element.tag == 'node':
+                if closure:
+                    _spool(nodes, element.attrib['id'], selected, to_xml(element))
+                elif selected:
+                    out.write(to_xml(element))
+                    counts['node'] += 1
+            elif selected:
+                if closure:
+                    needed.update(nd.attrib['ref'] for nd in element.iter('nd'))
+                    _spool(ways, element.attrib['id'], True, to_xml(element))
+                else:
+                    out.write(to_xml(element))
+                counts['way'] += 1
+        if closure:
+            nodes.seek(0)
+            for element_id, selected, data in _unspool(nodes):
+                if selected or element_id in needed:
+                    out.write(data)
+                    counts['node'] += 1
+                    counts['closure'] += not selected
+            ways.seek(0)
+            for _, _, data in _unspool(ways):
+                out.write(data)
+        out.write('</osm>\n')
+    return counts
+
+
+def test():
+    """Sample a generated file in each mode, load the samples and check that
+    every way node resolves to a node of the sample"""
+    import benchmark
+    import data_transform
+    directory = tempfile.mkdtemp(prefix='create_sample_test_')
+    try:
+        osm_path = os.path.join(directory, 'test.osm')
+        benchmark.generate(osm_path, 0.5, seed=3)
+        mid_lat = (benchmark.MIN_LAT + benchmark.MAX_LAT) / 2
+        mid_lon = (benchmark.MIN_LON + benchmark.MAX_LON) / 2
+        modes = {'stride': {'stride': 7}, 'ratio': {'ratio': 0.1, 'seed': 1},
+                 'bbox': {'bbox': (benchmark.MIN_LAT, benchmark.MIN_LON, mid_lat, mid_lon)}}
+        for name, options in sorted(modes.iteritems()):
+            sample_path = os.path.join(directory, name + '.osm')
+            db_path = os.path.join(directory, name + '.db')
+            counts = create_sample(osm_path, sample_path, **options)
+            assert counts['way'] > 0 and counts['closure'] > 0, (name, counts)
+            data_transform.process_map(sample_path, validate=True, sink='sqlite', db_path=db_path)
+            con = sqlite3.connect(db_path)
+            loaded = [con.execute("SELECT COUNT(*) FROM %s" % table).fetchone()[0]
+                      for table in ('nodes', 'ways')]
+            assert loaded == [counts['node'], counts['way']], (name, loaded, counts)
+            dangling = con.execute("SELECT COUNT(*) FROM ways_nodes wn LEFT JOIN nodes n "
+                                   "ON n.id = wn.node_id WHERE n.id IS NULL").fetchone()[0]
+            assert dangling == 0, (name, dangling)
+            con.close()
+        again = create_sample(osm_path, os.path.join(directory, 'again.osm'), **modes['ratio'])
+        assert open(os.path.join(directory, 'again.osm'), 'rb').read() == \
+            open(os.path.join(directory, 'ratio.osm'), 'rb').read(), again
+        print "create_sample: the ways of every sample resolve to sampled nodes"
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    print create_sample()
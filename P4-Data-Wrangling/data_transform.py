@@ -1,15 +1,29 @@
 #!/usr/bin/env python2
 # -*- coding: utf-8 -*-
 
-import xml.etree.cElementTree as ET
 import pprint
 from collections import defaultdict
+from operator import itemgetter
 import re
 import csv
-import codecs
-import pprint
-import cerberus
 import schema
+import os
+import shutil
+import tempfile
+import multiprocessing
+import osm_chunks
+import fast_validator
+import osm_sqlite
+import normalize
+import osm_stream
+import osm_pbf
+import compressed_io
+import checkpoint
+import validation
+import instrument
+import tag_dictionary
+from cStringIO import StringIO
+import pipeline
 
 osmfile = "san_jose_california.osm"
 OSM_PATH = "san_jose_california.osm"
@@ -92,11 +106,10 @@ def is_street_name(tag):
 #returns the unusual street types
 def audit(osmfile):
     street_types = defaultdict(set)
-    for event, elem in ET.iterparse(osmfile, events=("start",)):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    audit_street_type(street_types, tag.attrib['v'])
+    for elem in osm_stream.iter_elements(osmfile, ("node", "way")):
+        for tag in elem.iter("tag"):
+            if is_street_name(tag):
+                audit_street_type(street_types, tag.attrib['v'])
     return street_types
 
 
@@ -133,32 +146,48 @@ def is_zipcode(tag):
 
 def audit_zip(osmfile):
     invalid_zipcodes = defaultdict(set)
-    for event, elem in ET.iterparse(osmfile, events=("start",)):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_zipcode(tag):
-                    audit_zipcode(invalid_zipcodes, tag.attrib['v'])
+    for elem in osm_stream.iter_elements(osmfile, ("node", "way")):
+        for tag in elem.iter("tag"):
+            if is_zipcode(tag):
+                audit_zipcode(invalid_zipcodes, tag.attrib['v'])
     return invalid_zipcodes
 
-zipcode = audit_zip(osmfile)
+#cleaning postal codes: the first five digit group, e.g. "CA 95014" and
+#"95110-1234" become "95014" and "95110"
+ZIPCODE_RE = re.compile(r'\d{5}')
 
-#cleaning postal codes
 def fix_zipcode(zipcode):
-    letters = re.findall('[a-zA-Z]*', zipcode)
-    if letters:
-        letters = letters[0]
-    letters.strip()
-    if letters == "CA":
-        return str(re.findall(r'\d{5}', zipcode)[0])
-    else:
-        return str(re.findall(r'\d{5}', zipcode))
+    m = ZIPCODE_RE.search(zipcode)
+    if m:
+        return m.group()
+    return zipcode
+
+
+#|--------------------------------------|
+#|---Normalization lookups--------------|
+#|--------------------------------------|
+
+#every distinct value is cleaned once; see normalize.py
+street_normalizer = normalize.Normalizer(lambda name: fix_street(name, mapping))
+zipcode_normalizer = normalize.Normalizer(fix_zipcode)
+
+NORMALIZERS = {'street': street_normalizer, 'postcode': zipcode_normalizer}
+NORMALIZED_KEYS = {'street': ['addr:street'], 'postcode': ['addr:postcode', 'postcode']}
+NORMALIZATION_TABLE_PATH = "normalization_tables.json"
 
 
 def update_zipcode(name):
-    for street_type, ways in zipcode.iteritems():
-        for name in ways:
-            corrected = fix_zipcode(name)
-            return corrected
+    return zipcode_normalizer(name)
+
+
+def build_normalization_tables(osmfile, path=NORMALIZATION_TABLE_PATH):
+    """Precompute the street and postcode lookups for osmfile and save them"""
+    normalize.build_tables(osmfile, NORMALIZERS, NORMALIZED_KEYS)
+    normalize.save_tables(path, NORMALIZERS)
+
+
+def load_normalization_tables(path=NORMALIZATION_TABLE_PATH):
+    normalize.load_tables(path, NORMALIZERS)
 
 
 NODES_PATH = "nodes.csv"
@@ -166,6 +195,9 @@ NODE_TAGS_PATH = "nodes_tags.csv"
 WAYS_PATH = "ways.csv"
 WAY_NODES_PATH = "ways_nodes.csv"
 WAY_TAGS_PATH = "ways_tags.csv"
+DB_PATH = "san_jose_california.db"
+CHECKPOINT_PATH = "process_map.checkpoint.json"
+CHECKPOINT_EVERY = 100000
 
 LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
 PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
@@ -179,122 +211,204 @@ WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
 
+# Field order of the tuples made by shape_element_rows
+ROW_FIELDS = {'node': NODE_FIELDS, 'node_tags': NODE_TAGS_FIELDS, 'way': WAY_FIELDS,
+              'way_nodes': WAY_NODES_FIELDS, 'way_tags': WAY_TAGS_FIELDS}
+# ... and of the rows written with dictionary encoded tags (tag_dictionary.py)
+DICTIONARY_ROW_FIELDS = dict(ROW_FIELDS, node_tags=tag_dictionary.TAG_ID_FIELDS,
+                             way_tags=tag_dictionary.TAG_ID_FIELDS)
+
+
+#|--------------------------------------|
+#|---Tag key classification-------------|
+#|--------------------------------------|
+
+#value cleaners by full tag key
+KEY_CLEANERS = {'addr:street': street_normalizer,
+                'addr:postcode': zipcode_normalizer,
+                'postcode': zipcode_normalizer}
+
+#shape_element output keys for each element type
+ELEMENT_SHAPES = {'node': ('node', 'node_tags'),
+                  'way': ('way', 'way_tags')}
+
+#default attribute fields of each element type, as a list and as a set
+ATTR_FIELDS = {'node': NODE_FIELDS, 'way': WAY_FIELDS}
+FIELD_SETS = {'node': frozenset(NODE_FIELDS), 'way': frozenset(WAY_FIELDS)}
+
+SKIP_TAG = ()
+
+
+def classify_key(k, problem_chars=PROBLEMCHARS, default_tag_type='regular'):
+    """Return the (type, key, cleaner) plan for a tag key, or SKIP_TAG for keys
+    with problem characters. "addr:street" becomes ('addr', 'street', cleaner)
+    and "amenity" ('regular', 'amenity', None)."""
+    if problem_chars.search(k):
+        return SKIP_TAG
+    if LOWER_COLON.search(k):
+        tag_type, key = k.split(":", 1)
+    else:
+        tag_type, key = default_tag_type, k
+    return (tag_type, key, KEY_CLEANERS.get(k))
+
+
+#there are only a few thousand distinct keys, so each one is classified once.
+#A file with junk keys could grow the cache without end, so when it is full
+#it is retired and keys still in use move back from the retired one on their
+#next miss: the hot keys survive and at most twice TAG_PLANS_SIZE are kept
+TAG_PLANS = {}
+RETIRED_TAG_PLANS = {}
+TAG_PLANS_SIZE = 100000
+
+def tag_plan(k):
+    plan = TAG_PLANS.get(k)
+    if plan is None:
+        if len(TAG_PLANS) >= TAG_PLANS_SIZE:
+            RETIRED_TAG_PLANS.clear()
+            RETIRED_TAG_PLANS.update(TAG_PLANS)
+            TAG_PLANS.clear()
+        plan = RETIRED_TAG_PLANS.get(k)
+        if plan is None:
+            plan = classify_key(k)
+        TAG_PLANS[k] = plan
+    return plan
+
 
 def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
                   problem_chars=PROBLEMCHARS, default_tag_type='regular'):
     """Clean and shape node or way XML elements to Python dict"""
+    shape = ELEMENT_SHAPES.get(element.tag)
+    if shape is None:
+        return None
+    attr_key, tags_key = shape
+
+    if problem_chars is PROBLEMCHARS and default_tag_type == 'regular':
+        plans = TAG_PLANS
+        plan_for = tag_plan
+    else:
+        plans = {}
+        plan_for = lambda k: classify_key(k, problem_chars, default_tag_type)
+
+    attrib = element.attrib
+    element_id = attrib['id']
+    fields = node_attr_fields if attr_key == 'node' else way_attr_fields
+    if fields == ATTR_FIELDS[attr_key]:
+        field_set = FIELD_SETS[attr_key]
+    else:
+        field_set = frozenset(fields)
+    # equal sizes and every key a field means the same keys; issuperset works
+    # with the attribute mapping of cElementTree and of lxml alike
+    if len(attrib) == len(field_set) and field_set.issuperset(attrib.keys()):
+        attribs = dict(attrib)
+    else:
+        attribs = {}
+        for i in fields:
+            attribs[i] = attrib.get(i, '00000')
 
-    node_attribs = {}
-    way_attribs = {}
-    way_nodes = []
     tags = []  # Handles secondary tags the same way for both node and way elements
-
-
-    if element.tag == "node":
-        for i in NODE_FIELDS:
-            try:
-                node_attribs[i] = element.attrib[i]
-            except:
-                node_attribs[i] = '00000'
-                pass
-        for child in element.iter("tag"):
-            #taking out unexpected characters
-            if PROBLEMCHARS.search(child.attrib["k"]):
-                pass
-            elif LOWER_COLON.search(child.attrib["k"]):
-                dic = {'id':element.attrib['id']}
-                dic["type"] = child.attrib["k"].split(":", 1)[0]
-                dic["key"] = child.attrib["k"].split(":", 1)[1]
-                if child.attrib['k'] == "addr:street":
-                    #cleaning street names
-                    dic["value"] = fix_street(child.attrib["v"], mapping)
-                elif child.attrib["k"] == 'addr:postcode':
-                    #cleaning postcode
-                    dic["value"] = update_zipcode(child.attrib["v"])
-                else:
-                    dic["value"] = child.attrib['v']
-            else:
-                dic = {'id':element.attrib['id']}
-                #sharing top level node id
-                dic["id"] = element.attrib["id"]
-                dic["type"] = "regular"
-                dic["key"] = child.attrib["k"]
-                if child.attrib["k"] == "postcode":
-                    #cleaning postcode
-                    dic["value"] = update_zipcode(child.attrib['v'])
-                else:
-                    dic["value"] = child.attrib['v']
-            tags.append(dic)
-        return {'node': node_attribs, 'node_tags': tags}
-
-    if element.tag == "way":
-        for i in WAY_FIELDS:
-            try:
-                way_attribs[i] = element.attrib[i]
-            except:
-                way_attribs[i] == '00000'
-                pass
-        for child in element.iter("tag"):
-            #taking out unexpected characters
-            if PROBLEMCHARS.search(child.attrib["k"]):
-                pass
-            elif LOWER_COLON.search(child.attrib["k"]):
-                dic = {'id':element.attrib['id']}
-                dic["type"] = child.attrib["k"].split(":", 1)[0]
-                dic["key"] = child.attrib["k"].split(":", 1)[1]
-                if child.attrib['k'] == "addr:street":
-                    #cleaning street names
-                    dic["value"] = fix_street(child.attrib["v"], mapping)
-                elif child.attrib["k"] == 'addr:postcode':
-                    #cleaning postcode
-                    dic["value"] = update_zipcode(child.attrib["v"])
-                else:
-                    dic["value"] = child.attrib['v']
-            else:
-                dic = {'id':element.attrib['id']}
-                #sharing top level node id
-                dic["id"] = element.attrib["id"]
-                dic["type"] = "regular"
-                dic["key"] = child.attrib["k"]
-                if child.attrib["k"] == "postcode":
-                    #cleaning postcode
-                    dic["value"] = update_zipcode(child.attrib['v'])
-                else:
-                    dic["value"] = child.attrib['v']
-            tags.append(dic)
-        pos = 0
-        for child in element.iter('nd'):
-            dic = {}
-            dic['id'] = element.attrib['id']
-            dic['node_id'] = child.attrib['ref']
-            dic['position'] = pos
-            way_nodes.append(dic)
-            pos += 1
-        return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
+    way_nodes = []
+    for child in element:
+        if child.tag == "tag":
+            k = child.get("k")
+            plan = plans.get(k)
+            if plan is None:
+                plan = plan_for(k)
+            if plan:
+                tag_type, key, clean = plan
+                value = child.get("v")
+                if clean is not None:
+                    value = clean(value)
+                tags.append({'id': element_id, 'key': key, 'value': value, 'type': tag_type})
+        elif child.tag == "nd":
+            way_nodes.append({'id': element_id, 'node_id': child.get('ref'),
+                              'position': len(way_nodes)})
+
+    shaped = {attr_key: attribs, tags_key: tags}
+    if attr_key == 'way':
+        shaped['way_nodes'] = way_nodes
+    return shaped
+
+
+NODE_ROW = itemgetter(*NODE_FIELDS)
+WAY_ROW = itemgetter(*WAY_FIELDS)
+
+
+def _utf8(value):
+    if value.__class__ is unicode:
+        return value.encode('utf-8')
+    return value
+
+
+def shape_element_rows(element):
+    """Fast path version of shape_element: the same records as tuples in
+    the order of ROW_FIELDS, with text UTF-8 encoded, ready for csv.writer
+    or executemany"""
+    if element.tag == 'node':
+        attr_key, tags_key, row_of, fields = 'node', 'node_tags', NODE_ROW, NODE_FIELDS
+    elif element.tag == 'way':
+        attr_key, tags_key, row_of, fields = 'way', 'way_tags', WAY_ROW, WAY_FIELDS
+    else:
+        return None
+
+    attrib = element.attrib
+    element_id = attrib['id']
+    try:
+        row = row_of(attrib)
+    except KeyError:
+        row = tuple([attrib.get(i, '00000') for i in fields])
+    if attrib.get('user').__class__ is unicode:
+        row = tuple([_utf8(v) for v in row])
+
+    plans = TAG_PLANS
+    tags = []
+    way_nodes = []
+    for child in element:
+        if child.tag == "tag":
+            k = child.get("k")
+            plan = plans.get(k)
+            if plan is None:
+                plan = tag_plan(k)
+            if plan:
+                tag_type, key, clean = plan
+                value = child.get("v")
+                if clean is not None:
+                    value = clean(value)
+                tags.append((element_id, _utf8(key), _utf8(value), _utf8(tag_type)))
+        elif child.tag == "nd":
+            way_nodes.append((element_id, child.get('ref'), len(way_nodes)))
+
+    shaped = {attr_key: row, tags_key: tags}
+    if attr_key == 'way':
+        shaped['way_nodes'] = way_nodes
+    return shaped
 
 
 # ================================================== #
 #               Helper Functions                     #
 # ================================================== #
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag"""
-
-    context = ET.iterparse(osm_file, events=("start", "end"))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+def get_element(osm_file, tags=('node', 'way', 'relation'), accept=None):
+    """Yield element if it is the right type of tag (and accept(element))"""
+    return osm_stream.iter_elements(osm_file, tags, accept)
 
 
 def validate_element(element, validator, schema=SCHEMA):
     """Raise ValidationError if element does not match schema"""
     if validator.validate(element, schema) is not True:
-        field, errors = next(validator.errors.iteritems())
-        message_string = "\nElement of type '{0}' has the following errors:\n{1}"
-        error_string = pprint.pformat(errors)
+        raise_validation_error(validator)
+
+
+def validate_rows(rows, validator, schema=SCHEMA):
+    """validate_element for the output of shape_element_rows"""
+    if validator.validate_rows(rows, ROW_FIELDS, schema) is not True:
+        raise_validation_error(validator)
+
+
+def raise_validation_error(validator):
+    field, errors = next(validator.errors.iteritems())
+    message_string = "\nElement of type '{0}' has the following errors:\n{1}"
+    error_string = pprint.pformat(errors)
 
-        raise Exception(message_string.format(field, error_string))
+    raise Exception(message_string.format(field, error_string))
 
 
 class UnicodeDictWriter(csv.DictWriter, object):
@@ -313,45 +427,418 @@ class UnicodeDictWriter(csv.DictWriter, object):
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
-def process_map(file_in, validate):
-    """Iteratively process each XML element and write to csv(s)"""
-
-    with codecs.open(NODES_PATH, 'w') as nodes_file, \
-         codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file, \
-         codecs.open(WAYS_PATH, 'w') as ways_file, \
-         codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file, \
-         codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file:
-
-        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
-
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
-
-        validator = cerberus.Validator()
-
-        for element in get_element(file_in, tags=('node', 'way')):
-            el = shape_element(element)
-            if el:
-                if validate is True:
-                    validate_element(el, validator)
+CSV_OUTPUTS = [(NODES_PATH, NODE_FIELDS),
+               (NODE_TAGS_PATH, NODE_TAGS_FIELDS),
+               (WAYS_PATH, WAY_FIELDS),
+               (WAY_NODES_PATH, WAY_NODES_FIELDS),
+               (WAY_TAGS_PATH, WAY_TAGS_FIELDS)]
+DICTIONARY_CSV_OUTPUTS = [(NODES_PATH, NODE_FIELDS),
+                          (tag_dictionary.NODE_TAG_IDS_PATH, tag_dictionary.TAG_ID_FIELDS),
+                          (WAYS_PATH, WAY_FIELDS),
+                          (WAY_NODES_PATH, WAY_NODES_FIELDS),
+                          (tag_dictionary.WAY_TAG_IDS_PATH, tag_dictionary.TAG_ID_FIELDS)]
+
+
+def csv_paths(compress=None, outputs=CSV_OUTPUTS):
+    """The output paths, with a '.gz' or '.bz2' suffix if compress is set"""
+    suffix = '.' + compress.lstrip('.') if compress else ''
+    return [path + suffix for path, _ in outputs]
+
+
+class CSVSink(object):
+    """Write shaped elements to the five csv files, compressed if the paths
+    end in .gz or .bz2. With a tag_dictionary.TagDictionary the tags of
+    write_rows are written as ids (outputs=DICTIONARY_CSV_OUTPUTS)."""
+
+    def __init__(self, paths=None, header=True, use_tools=True, append=False,
+                 outputs=CSV_OUTPUTS, dictionary=None):
+        if paths is None:
+            paths = csv_paths(outputs=outputs)
+        if append:
+            self.files = [open(path, 'ab') for path in paths]
+        else:
+            self.files = [compressed_io.open_output(path, use_tools) for path in paths]
+        self.dictionary = dictionary
+        self.writers = [UnicodeDictWriter(f, fields)
+                        for f, (_, fields) in zip(self.files, outputs)]
+        self.row_writers = [csv.writer(f) for f in self.files]
+        if header:
+            for writer in self.writers:
+                writer.writeheader()
+
+    def write(self, el):
+        nodes_writer, node_tags_writer, ways_writer, way_nodes_writer, way_tags_writer = self.writers
+        if 'node' in el:
+            nodes_writer.writerow(el['node'])
+            node_tags_writer.writerows(el['node_tags'])
+        else:
+            ways_writer.writerow(el['way'])
+            way_nodes_writer.writerows(el['way_nodes'])
+            way_tags_writer.writerows(el['way_tags'])
+
+    def write_rows(self, rows):
+        """Write the output of shape_element_rows"""
+        if self.dictionary is not None:
+            rows = self.dictionary.encode_rows(rows)
+        nodes_writer, node_tags_writer, ways_writer, way_nodes_writer, way_tags_writer = self.row_writers
+        if 'node' in rows:
+            nodes_writer.writerow(rows['node'])
+            node_tags_writer.writerows(rows['node_tags'])
+        else:
+            ways_writer.writerow(rows['way'])
+            way_nodes_writer.writerows(rows['way_nodes'])
+            way_tags_writer.writerows(rows['way_tags'])
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _store_node(node_store, shaped):
+    node = shaped['node']
+    if isinstance(node, tuple):
+        node_store.add(node[0], node[1], node[2])
+    else:
+        node_store.add(node['id'], node['lat'], node['lon'])
+
+
+def process_elements(file_in, validate, sink, node_store=None, pipelined=False,
+                     element_filter=None, instruments=None):
+    """Shape, optionally validate and write every node and way in file_in.
+    Node coordinates are also added to node_store when one is given.
+    element_filter (see osm_filter.py) drops elements before they are shaped.
 
+    validate is True, False or a validation.ErrorCollector, which checks a
+    sample of the elements and collects errors in its report instead of
+    raising on the first one.
+
+    Sinks with a write_rows method get tuples from shape_element_rows;
+    others get the dicts of shape_element. With pipelined=True the writes
+    run on a background thread (see pipeline.py) and the time spent in each
+    stage is returned.
+
+    instruments (an instrument.RunInstruments) counts and times the run;
+    without them the loop below runs bare."""
+    validator = fast_validator.FastValidator(SCHEMA)
+    if hasattr(sink, 'write_rows'):
+        shape, check, write = shape_element_rows, validate_rows, sink.write_rows
+    else:
+        shape, check, write = shape_element, validate_element, sink.write
+    collector = validate if isinstance(validate, validation.ErrorCollector) else None
+    if collector is not None:
+        collector.open(ROW_FIELDS)
+        check_element = collector.add
+    elif validate is True:
+        check_element = lambda shaped: check(shaped, validator)
+    else:
+        check_element = None
+    raw = None
+    if (instruments is not None and isinstance(file_in, basestring)
+            and not osm_pbf.is_pbf(file_in) and not compressed_io.is_compressed(file_in)):
+        # counts the bytes parsed for the progress lines
+        raw = open(file_in, 'rb')
+        reader = file_in = checkpoint.CountingReader(raw)
+        instruments.position = lambda: reader.position
+    elements = get_element(file_in, tags=('node', 'way'), accept=element_filter)
+
+    try:
+        if pipelined:
+            def shape_and_store(element):
+                shaped = shape(element)
+                if shaped and node_store is not None and element.tag == 'node':
+                    _store_node(node_store, shaped)
+                return shaped
+            if instruments is None:
+                return pipeline.run(elements, shape_and_store, check_element, write)
+            timings = instruments.call(pipeline.run, instruments.watch(elements),
+                                       shape_and_store, check_element, write)
+            for stage, seconds in timings.iteritems():
+                instruments.timer.add(stage, seconds)
+            return timings
+
+        if instruments is not None:
+            def store(element, shaped):
                 if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
-                elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
+                    _store_node(node_store, shaped)
+            instruments.run_loop(elements, shape, check_element, write,
+                                 store if node_store is not None else None)
+            return
+
+        for element in elements:
+            shaped = shape(element)
+            if shaped:
+                if check_element is not None:
+                    check_element(shaped)
+                write(shaped)
+                if node_store is not None and element.tag == 'node':
+                    _store_node(node_store, shaped)
+    finally:
+        if collector is not None:
+            collector.close()
+        if raw is not None:
+            raw.close()
+
+
+def process_map(file_in, validate, workers=1, sink='csv', db_path=DB_PATH,
+                node_store=None, pipelined=False, compress=None, checkpoint_path=None,
+                element_filter=None, instruments=None, encode_tags=False):
+    """Iteratively process each XML element and write to csv(s).
+
+    sink='sqlite' streams the elements straight into the tables of
+    data_wrangling_schema.sql in db_path instead; any object with write(el)
+    and close() can be passed as well. A node_store.NodeStore passed as
+    node_store is filled with every node's coordinates on the way.
+
+    pipelined=True writes on a background thread and returns the seconds
+    spent in each stage (parse, shape, validate, write, ...).
+
+    file_in may also be an .osm.pbf extract. Its blobs are decoded on a
+    process pool by osm_pbf, so workers does not apply to it. Nor does it to
+    .osm.gz and .osm.bz2 input, which is decompressed while it is parsed.
+    compress='gz' or 'bz2' writes compressed csvs (nodes.csv.gz, ...).
+
+    checkpoint_path=CHECKPOINT_PATH saves a checkpoint every
+    CHECKPOINT_EVERY elements and when an element fails; run again with the
+    same arguments to resume from it (see checkpoint.py).
+
+    element_filter=osm_filter.ElementFilter(...) only shapes and writes the
+    elements it accepts. A filter with a bbox that keeps ways remembers the
+    nodes in the box, so it needs a serial run without checkpoints.
+
+    instruments=instrument.RunInstruments(...) prints progress lines and
+    writes a JSON report of counts and stage times (see instrument.py).
+
+    encode_tags=True stores tag keys and values once, in tag_keys and
+    tag_values, and the tags as ids (see tag_dictionary.py): csv output goes
+    to nodes_tag_ids.csv and ways_tag_ids.csv plus the two dictionary csvs.
+    It needs workers=1, whatever the input, and no checkpoints.
+    """
+    if element_filter is not None and getattr(element_filter, 'stateful', False):
+        if checkpoint_path is not None or (workers > 1 and not osm_pbf.is_pbf(file_in)
+                                           and not compressed_io.is_compressed(file_in)):
+            raise ValueError("a bbox filter on ways needs a serial run without checkpoints")
+        # forget the nodes a previous run found in the box
+        element_filter.reset()
+    if instruments is not None:
+        plain_xml = not osm_pbf.is_pbf(file_in) and not compressed_io.is_compressed(file_in)
+        instruments.start(file_in, os.path.getsize(file_in) if plain_xml else None,
+                          workers=workers, pipelined=pipelined, compress=compress,
+                          checkpointed=checkpoint_path is not None,
+                          filtered=element_filter is not None)
+        try:
+            return _process_map(file_in, validate, workers, sink, db_path, node_store, pipelined,
+                                compress, checkpoint_path, element_filter, instruments, encode_tags)
+        finally:
+            instruments.finish()
+    return _process_map(file_in, validate, workers, sink, db_path, node_store, pipelined,
+                        compress, checkpoint_path, element_filter, None, encode_tags)
+
+
+def _process_map(file_in, validate, workers, sink, db_path, node_store, pipelined, compress,
+                 checkpoint_path, element_filter, instruments=None, encode_tags=False):
+    if encode_tags:
+        return _process_map_encoded(file_in, validate, workers, sink, db_path, node_store,
+                                    pipelined, compress, checkpoint_path, element_filter,
+                                    instruments)
+    if checkpoint_path is not None:
+        if (workers > 1 or sink != 'csv' or node_store is not None or pipelined or compress
+                or osm_pbf.is_pbf(file_in) or compressed_io.is_compressed(file_in)):
+            raise ValueError("checkpoints need uncompressed xml input and serial, "
+                             "uncompressed csv output")
+        return process_map_checkpointed(file_in, validate, checkpoint_path,
+                                        element_filter=element_filter, instruments=instruments)
+    if workers > 1 and not osm_pbf.is_pbf(file_in) and not compressed_io.is_compressed(file_in):
+        if sink != 'csv':
+            raise ValueError("parallel mode only writes csv output")
+        if node_store is not None:
+            raise ValueError("node_store needs workers=1: in parallel mode the nodes are "
+                             "read by the worker processes")
+        return process_map_parallel(file_in, validate, workers, compress, element_filter,
+                                    instruments)
+
+    if sink == 'csv':
+        sink = CSVSink(csv_paths(compress))
+    elif sink == 'sqlite':
+        sink = osm_sqlite.SQLiteSink(db_path, row_fields=ROW_FIELDS)
+
+    with sink:
+        timings = process_elements(file_in, validate, sink, node_store, pipelined, element_filter,
+                                   instruments)
+    if node_store is not None:
+        node_store.finish()
+    return timings
+
+
+def _process_map_encoded(file_in, validate, workers, sink, db_path, node_store, pipelined,
+                         compress, checkpoint_path, element_filter, instruments):
+    """_process_map with dictionary encoded tags"""
+    # ids are handed out in input order, so even .pbf and compressed input,
+    # which ignore workers elsewhere, are refused more than one
+    if checkpoint_path is not None or workers > 1:
+        raise ValueError("encode_tags needs a serial run (workers=1) without checkpoints")
+    dictionary = tag_dictionary.TagDictionary()
+    if sink == 'csv':
+        sink = CSVSink(csv_paths(compress, DICTIONARY_CSV_OUTPUTS),
+                       outputs=DICTIONARY_CSV_OUTPUTS, dictionary=dictionary)
+    elif sink == 'sqlite':
+        sink = osm_sqlite.SQLiteSink(db_path, row_fields=DICTIONARY_ROW_FIELDS,
+                                     dictionary=dictionary)
+    else:
+        raise ValueError("encode_tags writes csv or sqlite output")
+
+    with sink:
+        timings = process_elements(file_in, validate, sink, node_store, pipelined, element_filter,
+                                   instruments)
+    if isinstance(sink, CSVSink):
+        dictionary.write_csv(*csv_paths(compress, [(tag_dictionary.TAG_KEYS_PATH, None),
+                                                   (tag_dictionary.TAG_VALUES_PATH, None)]))
+    if node_store is not None:
+        node_store.finish()
+    return timings
+
+
+def process_map_checkpointed(file_in, validate, checkpoint_path=CHECKPOINT_PATH,
+                             every=CHECKPOINT_EVERY, element_filter=None, instruments=None):
+    """process_map to csv, resuming from checkpoint_path if it exists. The
+    checkpoint is removed once the whole file has been processed."""
+    state = checkpoint.load(checkpoint_path)
+    if state is not None:
+        checkpoint.check_input(state, file_in)
+        checkpoint.truncate_outputs(state)
+    validator = fast_validator.FastValidator(SCHEMA)
+    collector = validate if isinstance(validate, validation.ErrorCollector) else None
+    if collector is not None:
+        collector.open(ROW_FIELDS)
+    count = state['elements'] if state else 0
+    last = tuple(state['last']) if state else None
+    offset = state['offset'] if state else 0
+    writing = False
+    with open(file_in, 'rb') as raw, CSVSink(header=state is None, append=state is not None) as sink:
+        reader = checkpoint.resume_reader(raw, state) if state else checkpoint.CountingReader(raw)
+        skip = last
+        next_offset = reader.position
+        elements = get_element(reader, tags=('node', 'way'), accept=element_filter)
+        if instruments is not None:
+            instruments.position = lambda: reader.position
+            elements = instruments.watch(elements)
+        try:
+            for element in elements:
+                key = (element.tag, element.attrib['id'])
+                element_offset, next_offset = next_offset, reader.safe_offset()
+                if skip is not None:
+                    # already written before the checkpoint
+                    if key == skip:
+                        skip = None
+                    continue
+                rows = shape_element_rows(element)
+                if collector is not None:
+                    collector.add(rows)
+                elif validate is True:
+                    validate_rows(rows, validator)
+                writing = True
+                sink.write_rows(rows)
+                writing = False
+                count += 1
+                last, offset = key, element_offset
+                if count % every == 0:
+                    checkpoint.save(checkpoint_path, file_in, offset, last, sink.files, count)
+            if skip is not None:
+                raise ValueError("checkpointed %s %s not found in %s" % (skip + (file_in,)))
+        except:
+            # rows of an element that failed half way through writing cannot
+            # be told apart, so only a clean failure moves the checkpoint on
+            if last is not None and not writing:
+                checkpoint.save(checkpoint_path, file_in, offset, last, sink.files, count)
+            raise
+        finally:
+            if collector is not None:
+                collector.close()
+    checkpoint.clear(checkpoint_path)
+    return count
+
+
+# ================================================== #
+#               Parallel Processing                  #
+# ================================================== #
+def _process_shard(args):
+    """Worker: process one byte range of file_in into headerless shard csvs"""
+    file_in, start, end, validate, shard_paths, element_filter, instruments = args
+    if isinstance(validate, validation.ErrorCollector):
+        # a copy of the caller's collector; the worker is already one of a pool
+        validate.workers = 0
+        # and a seed of its own, or every shard would sample the same positions
+        if validate.seed is not None:
+            validate.seed = (validate.seed, start)
+    # each worker compresses its own shards, so no compressor processes
+    with CSVSink(shard_paths, header=False, use_tools=False) as sink, \
+         osm_chunks.OSMChunk(file_in, start, end) as chunk:
+        process_elements(chunk, validate, sink, element_filter=element_filter,
+                         instruments=instruments)
+    return shard_paths, getattr(validate, 'report', None), instruments
+
+
+def process_map_parallel(file_in, validate, workers, compress=None, element_filter=None,
+                         instruments=None):
+    """Split file_in at node/way boundaries and process the pieces on a
+    process pool. Shards are appended to the five csvs in input order, so
+    the output is identical to a single process run. Compressed shards are
+    complete .gz/.bz2 streams and are concatenated the same way."""
+    ranges = osm_chunks.split_osm(file_in, workers * 4)
+    shard_dir = tempfile.mkdtemp(prefix='osm_shards_', dir=os.path.dirname(os.path.abspath(NODES_PATH)))
+    jobs = []
+    paths = csv_paths(compress)
+    for i, (start, end) in enumerate(ranges):
+        shard_paths = [os.path.join(shard_dir, '%s.%04d%s' % (os.path.basename(csv_path), i,
+                                                             compressed_io.compression(path) or ''))
+                       for path, (csv_path, _) in zip(paths, CSV_OUTPUTS)]
+        jobs.append((file_in, start, end, validate, shard_paths, element_filter, instruments))
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        outputs = []
+        for path, (_, fields) in zip(paths, CSV_OUTPUTS):
+            f = open(path, 'wb')
+            header = StringIO()
+            UnicodeDictWriter(header, fields).writeheader()
+            f.write(compressed_io.compress(header.getvalue(), compressed_io.compression(path)))
+            outputs.append(f)
+        try:
+            # imap keeps results in submission order while the pool runs ahead
+            for i, (shard_paths, report, counted) in enumerate(pool.imap(_process_shard, jobs)):
+                if report is not None:
+                    validate.report.merge(report)
+                if counted is not None:
+                    # stage times are summed over the workers
+                    instruments.merge(counted)
+                    instruments.add_bytes(ranges[i][1] - ranges[i][0])
+                    instruments.tick()
+                for out, shard_path in zip(outputs, shard_paths):
+                    with open(shard_path, 'rb') as shard:
+                        shutil.copyfileobj(shard, out, 1 << 20)
+                    os.remove(shard_path)
+        finally:
+            for f in outputs:
+                f.close()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        shutil.rmtree(shard_dir, ignore_errors=True)
 
 
 if __name__ == '__main__':
-    # Note: Validation is ~ 10X slower. For the project consider using a small
-    # sample of the map when validating.
+    # Note: Validation uses the schema compiled by fast_validator. It is not
+    # free: on a 16MB extract it adds about a quarter to the run time (0.55s
+    # to validate what takes 2s to parse and shape). cerberus.Validator() can
+    # still be passed to validate_element to cross check.
+    if os.path.exists(NORMALIZATION_TABLE_PATH):
+        load_normalization_tables()
     process_map(OSM_PATH, validate=True)
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import xml.etree.cElementTree as ET
 import re
+import osm_stream
 """
 Your task is to explore the data a bit more.
 The first task is a fun one - find out how many unique users
@@ -14,12 +14,14 @@ filename = 'san_jose_california.osm'
 
 def process_map(filename):
     users = set()
-    for _, element in ET.iterparse(filename):
+    for element in osm_stream.iter_elements(filename):
         if element.get("uid"):
             users.add(element.attrib["uid"])
     print len(users)
+    return users
 
-process_map(filename)
+if __name__ == '__main__':
+    process_map(filename)
 
 
 
@@ -0,0 +1,418 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+A drop-in replacement for cerberus.Validator for the schema in schema.py.
+
+Instead of walking the schema for every element the way cerberus does, the
+schema is turned into Python source once - one specialised function per top
+level field (node, node_tags, way, way_nodes, way_tags) - and compiled. The
+generated code coerces and type checks each field inline and reports errors
+in the same shape and with the same messages as cerberus, so
+data_transform.validate_element works unchanged with either validator.
+
+Only the rules used by schema.py are supported: type, required, coerce and
+nested dict/list schemas.
+"""
+from collections import Mapping, Sequence
+import pprint
+import random
+
+import schema as osm_schema
+
+MISSING = object()
+
+TYPE_CHECKS = {
+    'integer': '(int, long)',
+    'float': '(float, int, long)',
+    'string': 'basestring',
+}
+
+COERCED_TYPES = {int: 'integer', float: 'float'}
+
+
+class _Source(object):
+    """Collects indented lines of generated code"""
+
+    def __init__(self):
+        self.lines = []
+        self.names = 0
+
+    def add(self, indent, line):
+        self.lines.append('    ' * indent + line)
+
+    def name(self, prefix):
+        self.names += 1
+        return '%s_%d' % (prefix, self.names)
+
+
+def _field_code(src, namespace, indent, doc, errors, field, rules):
+    """Emit the checks for one field of a dict schema"""
+    v = src.name('v')
+    msgs = src.name('msgs')
+    type_name = rules.get('type')
+    src.add(indent, '%s = %s.get(%r, MISSING)' % (v, doc, field))
+    src.add(indent, 'if %s is MISSING:' % v)
+    if rules.get('required'):
+        src.add(indent + 1, "%s[%r] = ['required field']" % (errors, field))
+    else:
+        src.add(indent + 1, 'pass')
+    src.add(indent, 'else:')
+    src.add(indent + 1, '%s = None' % msgs)
+    if 'coerce' in rules:
+        coerce = src.name('coerce')
+        namespace[coerce] = rules['coerce']
+        src.add(indent + 1, 'try:')
+        src.add(indent + 2, '%s = %s(%s)' % (v, coerce, v))
+        src.add(indent + 1, 'except Exception as exc:')
+        src.add(indent + 2, "%s = [\"field '%s' cannot be coerced: %%s\" %% exc]" % (msgs, field))
+    src.add(indent + 1, 'if %s is None:' % v)
+    src.add(indent + 2, "%s = (%s or []) + ['null value not allowed']" % (msgs, msgs))
+    if type_name in TYPE_CHECKS:
+        src.add(indent + 1, 'elif not isinstance(%s, %s):' % (v, TYPE_CHECKS[type_name]))
+        src.add(indent + 2, "%s = (%s or []) + ['must be of %s type']" % (msgs, msgs, type_name))
+    src.add(indent + 1, 'if %s:' % msgs)
+    src.add(indent + 2, '%s[%r] = %s' % (errors, field, msgs))
+    src.add(indent + 1, 'else:')
+    src.add(indent + 2, '%s[%r] = %s' % (doc + '_out', field, v))
+
+
+def _dict_code(src, namespace, indent, doc, rules):
+    """Emit code checking the dict `doc`; leaves its errors in doc_errors and
+    the coerced copy in doc_out"""
+    known = src.name('known')
+    namespace[known] = frozenset(rules)
+    errors = doc + '_errors'
+    src.add(indent, '%s = {}' % errors)
+    src.add(indent, '%s_out = {}' % doc)
+    for field in sorted(rules):
+        _field_code(src, namespace, indent, doc, errors, field, rules[field])
+    src.add(indent, 'if not %s.issuperset(%s):' % (known, doc))
+    src.add(indent + 1, 'for k in %s:' % doc)
+    src.add(indent + 2, 'if k not in %s:' % known)
+    src.add(indent + 3, "%s[k] = ['unknown field']" % errors)
+    src.add(indent + 3, '%s_out[k] = %s[k]' % (doc, doc))
+
+
+def _top_level_code(src, namespace, field, rules):
+    """Emit a function check_<field>(value) -> (errors or None, coerced value)"""
+    src.add(0, 'def check_%s(value):' % field)
+    src.add(1, 'if value is None:')
+    src.add(2, "return ['null value not allowed'], value")
+    if rules['type'] == 'dict':
+        src.add(1, 'if not isinstance(value, Mapping):')
+        src.add(2, "return ['must be of dict type'], value")
+        src.add(1, 'item = value')
+        _dict_code(src, namespace, 1, 'item', rules['schema'])
+        src.add(1, 'if item_errors:')
+        src.add(2, 'return [item_errors], item_out')
+        src.add(1, 'return None, item_out')
+    elif rules['type'] == 'list':
+        item_rules = rules['schema']
+        src.add(1, 'if isinstance(value, basestring) or not isinstance(value, Sequence):')
+        src.add(2, "return ['must be of list type'], value")
+        src.add(1, 'list_errors = {}')
+        src.add(1, 'list_out = []')
+        src.add(1, 'for i, item in enumerate(value):')
+        src.add(2, 'if not isinstance(item, Mapping):')
+        src.add(3, "list_errors[i] = ['must be of dict type']")
+        src.add(3, 'list_out.append(item)')
+        src.add(3, 'continue')
+        _dict_code(src, namespace, 2, 'item', item_rules['schema'])
+        src.add(2, 'if item_errors:')
+        src.add(3, 'list_errors[i] = [item_errors]')
+        src.add(2, 'list_out.append(item_out)')
+        src.add(1, 'if list_errors:')
+        src.add(2, 'return [list_errors], list_out')
+        src.add(1, 'return None, list_out')
+    else:
+        raise ValueError("unsupported top level type %r" % rules['type'])
+    src.add(0, '')
+
+
+def _quick_dict_expr(src, namespace, doc, rules, fields=None):
+    """An expression that is True only when the dict `doc` is valid. It may
+    raise on bad input, which the caller treats as False.
+
+    With fields, `doc` is a tuple holding the values of fields in order."""
+    if fields is None:
+        terms = ['%s.__class__ is dict' % doc]
+        if all(r.get('required') for r in rules.itervalues()):
+            terms.append('len(%s) == %d' % (doc, len(rules)))
+        else:
+            known = src.name('known')
+            namespace[known] = frozenset(rules)
+            terms.append('%s.issuperset(%s)' % (known, doc))
+    else:
+        if not set(fields) <= set(rules) or \
+                any(r.get('required') and f not in fields for f, r in rules.iteritems()):
+            return 'False'
+        terms = ['%s.__class__ is tuple' % doc, 'len(%s) == %d' % (doc, len(fields))]
+    for field in sorted(rules):
+        r = rules[field]
+        if fields is not None:
+            if field not in fields:
+                continue
+            value = '%s[%d]' % (doc, list(fields).index(field))
+        elif r.get('required'):
+            value = '%s[%r]' % (doc, field)
+        else:
+            value = '%s.get(%r, MISSING)' % (doc, field)
+        check = TYPE_CHECKS.get(r.get('type'), 'object')
+        if 'coerce' in r:
+            coerce = src.name('coerce')
+            namespace[coerce] = r['coerce']
+            if COERCED_TYPES.get(r['coerce']) == r.get('type') and \
+                    (r.get('required') or fields is not None):
+                # int() and float() either raise or return the right type.
+                # Ids are digit strings, and str.isdigit() is a third of int()
+                if r['coerce'] is int:
+                    terms.append('(%s.__class__ is str and %s.isdigit() or %s(%s) is not None)'
+                                 % (value, value, coerce, value))
+                else:
+                    terms.append('%s(%s) is not None' % (coerce, value))
+                continue
+            value = '%s(%s)' % (coerce, value)
+            type_check = 'isinstance(%s, %s)' % (value, check)
+        elif check == 'basestring':
+            # the class test passes the usual str without the isinstance call
+            type_check = '(%s.__class__ is str or isinstance(%s, basestring))' % (value, value)
+        else:
+            type_check = 'isinstance(%s, %s)' % (value, check)
+        if r.get('required') or fields is not None:
+            terms.append(type_check)
+        else:
+            terms.append('(%r not in %s or %s)' % (field, doc, type_check))
+    return ' and '.join(terms)
+
+
+def _quick_code(src, namespace, field, rules, fields=None, name='quick'):
+    """Emit quick_<field>(value) -> True when value is valid. Most elements
+    are valid, so this is the only code that normally runs; anything it
+    rejects is re-checked by check_<field> to build the error report."""
+    src.add(0, 'def %s_%s(value):' % (name, field))
+    src.add(1, 'try:')
+    if rules['type'] == 'dict':
+        src.add(2, 'return %s' % _quick_dict_expr(src, namespace, 'value', rules['schema'], fields))
+    else:
+        src.add(2, 'if value.__class__ is not list:')
+        src.add(3, 'return False')
+        src.add(2, 'for item in value:')
+        src.add(3, 'if not (%s):' % _quick_dict_expr(src, namespace, 'item',
+                                                     rules['schema']['schema'], fields))
+        src.add(4, 'return False')
+        src.add(2, 'return True')
+    src.add(1, 'except Exception:')
+    src.add(2, 'return False')
+    src.add(0, '')
+
+
+def compile_schema(schema):
+    """Return {field: (quick check, full check)} generated from a cerberus
+    schema dict"""
+    src = _Source()
+    namespace = {'MISSING': MISSING, 'Mapping': Mapping, 'Sequence': Sequence}
+    for field in sorted(schema):
+        _quick_code(src, namespace, field, schema[field])
+        _top_level_code(src, namespace, field, schema[field])
+    code = compile('\n'.join(src.lines), '<schema validator>', 'exec')
+    exec code in namespace
+    return dict((field, (namespace['quick_%s' % field], namespace['check_%s' % field]))
+                for field in schema)
+
+
+def compile_row_schema(schema, field_orders):
+    """Return {field: quick check} for shaped rows, where each record is a
+    tuple of the values of field_orders[field] in order"""
+    src = _Source()
+    namespace = {'MISSING': MISSING}
+    for field in sorted(schema):
+        _quick_code(src, namespace, field, schema[field], field_orders[field], 'rows')
+    code = compile('\n'.join(src.lines), '<schema row validator>', 'exec')
+    exec code in namespace
+    return dict((field, namespace['rows_%s' % field]) for field in schema)
+
+
+def rows_to_document(rows, field_orders):
+    """Turn shaped rows back into the dict document shape_element produces"""
+    document = {}
+    for field, value in rows.iteritems():
+        fields = field_orders.get(field)
+        if fields is None:
+            document[field] = value
+        elif isinstance(value, tuple):
+            document[field] = dict(zip(fields, value))
+        else:
+            document[field] = [dict(zip(fields, row)) if isinstance(row, tuple) else row
+                               for row in value]
+    return document
+
+
+class FastValidator(object):
+    """Validate documents against a compiled schema.
+
+    Follows the part of the cerberus.Validator interface that
+    validate_element uses: validate() returns True or False and leaves the
+    errors in .errors and the coerced document in .document."""
+
+    def __init__(self, schema=None):
+        self._compiled = {}
+        self._row_compiled = {}
+        self.schema = schema
+        self.errors = {}
+        self._document = None
+        self._checked = None
+        if schema is not None:
+            self._checks(schema)
+
+    def _checks(self, schema):
+        checks = self._compiled.get(id(schema))
+        if checks is None:
+            checks = self._compiled[id(schema)] = (schema, compile_schema(schema))
+        return checks[1]
+
+    def validate(self, document, schema=None):
+        checks = self._checks(schema if schema is not None else self.schema)
+        self._document = None
+        for field, value in document.iteritems():
+            check = checks.get(field)
+            if check is None or not check[0](value):
+                self._full_check(document, checks)
+                return not self.errors
+        self.errors = {}
+        self._checked = (document, checks)
+        return True
+
+    def _full_check(self, document, checks):
+        errors = {}
+        out = {}
+        for field, value in document.iteritems():
+            check = checks.get(field)
+            if check is None:
+                errors[field] = ['unknown field']
+                out[field] = value
+                continue
+            field_errors, out[field] = check[1](value)
+            if field_errors:
+                errors[field] = field_errors
+        self.errors = errors
+        self._document = out
+
+    def validate_rows(self, rows, field_orders, schema=None):
+        """validate() for shaped rows ({field: tuple or [tuples]}). Rows that
+        fail the quick check are turned back into a dict document so the
+        errors are the same as validate() reports. .document is not set."""
+        schema = schema if schema is not None else self.schema
+        key = (id(schema), id(field_orders))
+        entry = self._row_compiled.get(key)
+        if entry is None:
+            entry = self._row_compiled[key] = (schema, field_orders,
+                                               compile_row_schema(schema, field_orders))
+        quick = entry[2]
+        for field, value in rows.iteritems():
+            check = quick.get(field)
+            if check is None or not check(value):
+                return self.validate(rows_to_document(rows, field_orders), schema)
+        self.errors = {}
+        self._document = self._checked = None
+        return True
+
+    @property
+    def document(self):
+        """The last validated document with coercions applied"""
+        if self._document is None and self._checked is not None:
+            self._full_check(*self._checked)
+        return self._document
+
+
+# ================================================== #
+#               Differential test                    #
+# ================================================== #
+def _normalise(errors):
+    """Error message lists are sorted, cerberus does not order them consistently"""
+    if isinstance(errors, dict):
+        return dict((k, _normalise(v)) for k, v in errors.iteritems())
+    if isinstance(errors, list):
+        items = [_normalise(e) for e in errors]
+        return sorted(items) if all(isinstance(e, basestring) for e in items) else items
+    return errors
+
+
+def _random_document(rng):
+    """A shaped element with a few random fields broken"""
+    bad_values = [None, 'x', '', '1.5', 1.7, 3, True, u'caf\xe9', ['a'], {'a': 1}]
+    if rng.random() < 0.5:
+        doc = {'node': {'id': '1', 'lat': '37.3', 'lon': '-121.9', 'user': 'u', 'uid': '2',
+                        'version': '1', 'changeset': '3', 'timestamp': 't'},
+               'node_tags': [{'id': '1', 'key': 'k', 'value': 'v', 'type': 'regular'}
+                             for _ in range(rng.randint(0, 3))]}
+    else:
+        doc = {'way': {'id': '1', 'user': 'u', 'uid': '2', 'version': '1',
+                       'changeset': '3', 'timestamp': 't'},
+               'way_nodes': [{'id': '1', 'node_id': '5', 'position': i}
+                             for i in range(rng.randint(0, 3))],
+               'way_tags': [{'id': '1', 'key': 'k', 'value': 'v', 'type': 'regular'}
+                            for _ in range(rng.randint(0, 3))]}
+    for _ in range(rng.randint(0, 3)):
+        field = rng.choice(sorted(doc))
+        target = doc[field]
+        if not isinstance(target, (list, dict)):
+            continue
+        if isinstance(target, list):
+            if not target or rng.random() < 0.1:
+                doc[field] = rng.choice(bad_values + [[], [5]])
+                continue
+            target = rng.choice(target)
+            if not isinstance(target, dict):
+                continue
+        key = rng.choice(sorted(target) + ['extra'])
+        if rng.random() < 0.2:
+            target.pop(key, None)
+        else:
+            target[key] = rng.choice(bad_values)
+    if rng.random() < 0.05:
+        doc['extra'] = 1
+    return doc
+
+
+def _as_rows(doc, field_orders):
+    """doc with each record turned into a tuple, or None if a record does
+    not have exactly the expected fields"""
+    rows = {}
+    for field, value in doc.iteritems():
+        fields = field_orders.get(field)
+        records = [value] if isinstance(value, dict) else value
+        if fields is None or not isinstance(records, list):
+            return None
+        for record in records:
+            if not isinstance(record, dict) or sorted(record) != sorted(fields):
+                return None
+        tuples = [tuple(record[f] for f in fields) for record in records]
+        rows[field] = tuples[0] if isinstance(value, dict) else tuples
+    return rows
+
+
+def test(runs=5000, seed=0):
+    import cerberus
+    import data_transform
+    rng = random.Random(seed)
+    fast = FastValidator(osm_schema.schema)
+    reference = cerberus.Validator()
+    # the tuple layout shape_element_rows really produces
+    field_orders = data_transform.ROW_FIELDS
+    for _ in range(runs):
+        doc = _random_document(rng)
+        expected = reference.validate(doc, osm_schema.schema)
+        assert fast.validate(doc, osm_schema.schema) == expected, pprint.pformat(doc)
+        assert _normalise(fast.errors) == _normalise(reference.errors), \
+            pprint.pformat((doc, fast.errors, reference.errors))
+        if expected:
+            assert fast.document == reference.document, pprint.pformat(doc)
+        rows = _as_rows(doc, field_orders)
+        if rows is not None:
+            assert fast.validate_rows(rows, field_orders) == expected, pprint.pformat(doc)
+            assert _normalise(fast.errors) == _normalise(reference.errors), pprint.pformat(doc)
+    print "fast validator matches cerberus on %d documents" % runs
+
+
+if __name__ == '__main__':
+    test()
@@ -1,57 +1,79 @@
-import sqlite3
 import csv
+import os
+import time
+from itertools import islice
 from pprint import pprint
 
-#connecting to database
-con = sqlite3.connect("san_jose_california.db")
-con.text_factory = str
-
-#getting cursor object
-cur = con.cursor()
-
-# create nodes table
-cur.execute("CREATE TABLE nodes (id, lat, lon, user, uid, version, changeset, timestamp);")
-with open('nodes.csv','rb') as fin:
-    dr = csv.DictReader(fin) 
-    to_db = [(i['id'], i['lat'], i['lon'], i['user'], i['uid'], i['version'], i['changeset'], i['timestamp']) \
-             for i in dr]
-
-cur.executemany("INSERT INTO nodes (id, lat, lon, user, uid, version, changeset, timestamp) \
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?);", to_db)
-con.commit()
-
-#create nodes_tags table
-cur.execute("CREATE TABLE nodes_tags (id, key, value, type);")
-with open('nodes_tags.csv','rb') as fin:
-    dr = csv.DictReader(fin) 
-    to_db = [(i['id'], i['key'], i['value'], i['type']) for i in dr]
-
-cur.executemany("INSERT INTO nodes_tags (id, key, value, type) VALUES (?, ?, ?, ?);", to_db)
-con.commit()
-
-#Create ways table
-cur.execute("CREATE TABLE ways (id, user, uid, version, changeset, timestamp);")
-with open('ways.csv','rb') as fin:
-    dr = csv.DictReader(fin) 
-    to_db = [(i['id'], i['user'], i['uid'], i['version'], i['changeset'], i['timestamp']) for i in dr]
-
-cur.executemany("INSERT INTO ways (id, user, uid, version, changeset, timestamp) VALUES (?, ?, ?, ?, ?, ?);", to_db)
-con.commit()
-
-#Create ways_nodes table
-cur.execute("CREATE TABLE ways_nodes (id, node_id, position);")
-with open('ways_nodes.csv','rb') as fin:
-    dr = csv.DictReader(fin) 
-    to_db = [(i['id'], i['node_id'], i['position']) for i in dr]
-
-cur.executemany("INSERT INTO ways_nodes (id, node_id, position) VALUES (?, ?, ?);", to_db)
-con.commit()
-
-#Create ways_tags table
-cur.execute("CREATE TABLE ways_tags (id, key, value, type);")
-with open('ways_tags.csv','rb') as fin:
-    dr = csv.DictReader(fin) 
-    to_db = [(i['id'], i['key'], i['value'], i['type']) for i in dr]
-
-cur.executemany("INSERT INTO ways_tags (id, key, value, type) VALUES (?, ?, ?, ?);", to_db)
-con.commit()
+import compressed_io
+import osm_sqlite
+import tag_dictionary
+
+DB_PATH = "san_jose_california.db"
+
+#csv file -> table, in load order
+CSV_TABLES = [('nodes.csv', 'nodes'),
+              ('nodes_tags.csv', 'nodes_tags'),
+              ('ways.csv', 'ways'),
+              ('ways_nodes.csv', 'ways_nodes'),
+              ('ways_tags.csv', 'ways_tags')]
+
+BATCH_SIZE = 10000
+
+
+#streams csv_path into table batch_size rows at a time, so memory use does not
+#depend on the size of the file. Columns are matched by the csv header.
+#csv_path may be a .gz or .bz2 file, which is decompressed as it is read.
+def load_csv(con, table, csv_path, batch_size=BATCH_SIZE):
+    """Insert the rows of csv_path into table and return the row count"""
+    statement, columns = osm_sqlite.insert_statement(con, table)
+    rows = 0
+    with compressed_io.open_input(csv_path) as fin:
+        reader = csv.reader(fin)
+        header = next(reader)
+        order = [header.index(c) for c in columns]
+        con.execute("BEGIN")
+        while True:
+            batch = [tuple([row[i] for i in order]) for row in islice(reader, batch_size)]
+            if not batch:
+                break
+            con.executemany(statement, batch)
+            rows += len(batch)
+        con.execute("COMMIT")
+    return rows
+
+
+#creates the typed tables from data_wrangling_schema.sql, loads every csv (or
+#its .gz/.bz2 copy if only that exists) and builds the indexes afterwards.
+#encoded_tags=True loads the csvs of process_map(..., encode_tags=True) into
+#the dictionary encoded layout of tag_dictionary.py.
+#Returns {table: (rows, seconds)}
+def load_database(db_path=DB_PATH, csv_dir='.', batch_size=BATCH_SIZE,
+                  schema_path=osm_sqlite.SCHEMA_SQL_PATH, verbose=True, encoded_tags=False):
+    con = osm_sqlite.connect_for_import(db_path)
+    stats = {}
+    try:
+        osm_sqlite.create_tables(con, schema_path)
+        csv_tables, indexes = CSV_TABLES, osm_sqlite.INDEXES
+        if encoded_tags:
+            tag_dictionary.create_tables(con)
+            csv_tables, indexes = tag_dictionary.CSV_TABLES, tag_dictionary.INDEXES
+        for csv_name, table in csv_tables:
+            start = time.time()
+            rows = load_csv(con, table, compressed_io.find(os.path.join(csv_dir, csv_name)), batch_size)
+            elapsed = time.time() - start
+            stats[table] = (rows, elapsed)
+            if verbose:
+                print "%-12s %10d rows %8.1fs %10.0f rows/s" % (
+                    table, rows, elapsed, rows / elapsed if elapsed else 0)
+        start = time.time()
+        violations = osm_sqlite.finish_import(con, indexes)
+        if verbose:
+            print "indexes built in %.1fs, %d foreign key violations" % (
+                time.time() - start, violations)
+    finally:
+        con.close()
+    return stats
+
+
+if __name__ == '__main__':
+    pprint(load_database())
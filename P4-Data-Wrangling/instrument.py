@@ -0,0 +1,315 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Counters, stage timers, progress lines and an optional profiler for long
+process_map runs.
+
+    run = instrument.RunInstruments(interval=30, report_path='run_report.json')
+    data_transform.process_map(OSM_PATH, validate=True, instruments=run)
+
+prints a line like
+
+    1250000 elements (1130000 nodes, 120000 ways)  41312/s  180.2/1722.5MB (10.5%)  ETA 0:05:12
+
+every interval seconds to stderr and, at the end, writes a JSON report with
+the element counts, the seconds spent parsing, shaping, validating and
+writing, the rate and the peak RSS. Bytes and ETA are known for plain XML
+input; for .pbf and compressed input only the element counts are shown.
+
+profile='cprofile' runs the processing loop (and only it) under cProfile,
+profile='sample' under a sampling profiler that looks at the main thread's
+stack every SAMPLE_INTERVAL seconds of CPU time, which costs far less (run
+from another thread, it falls back to cProfile). The
+most expensive functions go into the report; profile_path also saves the
+cProfile data for pstats or snakeviz.
+
+Without instruments process_map runs its plain loop, so there is nothing
+to pay when they are off.
+"""
+import cProfile
+import json
+import pstats
+import resource
+import signal
+import sys
+import threading
+import time
+
+import pipeline
+
+PROGRESS_INTERVAL = 10.0
+SAMPLE_INTERVAL = 0.005
+TOP_FUNCTIONS = 25
+
+# elements between progress checks when the loop is not timed anyway
+CHECK_EVERY = 4096
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _function_name(code):
+    return '%s:%d(%s)' % (code.co_filename, code.co_firstlineno, code.co_name)
+
+
+def _duration(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds / 3600, seconds / 60 % 60, seconds % 60)
+
+
+# ================================================== #
+#               Profilers                            #
+# ================================================== #
+class SamplingProfiler(object):
+    """Counts the functions on the main thread's stack on every SIGPROF"""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = 0
+        self.own = {}
+        self.total = {}
+
+    def _sample(self, signum, frame):
+        self.samples += 1
+        own, total = self.own, self.total
+        if frame is not None:
+            name = _function_name(frame.f_code)
+            own[name] = own.get(name, 0) + 1
+        seen = set()
+        while frame is not None:
+            code = frame.f_code
+            if code not in seen:
+                seen.add(code)
+                name = _function_name(code)
+                total[name] = total.get(name, 0) + 1
+            frame = frame.f_back
+
+    def runcall(self, func, *args, **kwargs):
+        previous = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, previous)
+
+    def top(self, n=TOP_FUNCTIONS):
+        """[{'function', 'own_samples', 'samples'}] by samples taken in the
+        function itself, then by samples with it anywhere on the stack"""
+        own = self.own
+        ranked = sorted(self.total.iteritems(),
+                        key=lambda item: (-own.get(item[0], 0), -item[1], item[0]))[:n]
+        return [{'function': name, 'own_samples': own.get(name, 0), 'samples': count}
+                for name, count in ranked]
+
+
+class CProfiler(object):
+    """cProfile with the same interface as SamplingProfiler"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.profile = cProfile.Profile()
+
+    def runcall(self, func, *args, **kwargs):
+        try:
+            return self.profile.runcall(func, *args, **kwargs)
+        finally:
+            if self.path:
+                self.profile.dump_stats(self.path)
+
+    def top(self, n=TOP_FUNCTIONS):
+        """[{'function', 'calls', 'own_seconds', 'seconds'}] by cumulative time"""
+        stats = pstats.Stats(self.profile).stats
+        ranked = sorted(stats.iteritems(), key=lambda item: -item[1][3])[:n]
+        return [{'function': '%s:%d(%s)' % key, 'calls': calls,
+                 'own_seconds': round(own, 4), 'seconds': round(cumulative, 4)}
+                for key, (_, calls, own, cumulative, _) in ranked]
+
+
+def _sampling_profiler(instruments):
+    # a SIGPROF handler can only be set from the main thread; elsewhere the
+    # run is profiled with cProfile, and the report says so
+    if not isinstance(threading.current_thread(), threading._MainThread):
+        (instruments.stream or sys.stderr).write(
+            "sampling profiler needs the main thread, using cProfile\n")
+        instruments.profile = 'cprofile'
+        return CProfiler(instruments.profile_path)
+    return SamplingProfiler()
+
+
+PROFILERS = {'cprofile': lambda instruments: CProfiler(instruments.profile_path),
+             'sample': _sampling_profiler}
+
+
+# ================================================== #
+#               Run instruments                      #
+# ================================================== #
+class RunInstruments(object):
+    """Counts, stage times and progress of one process_map run; see the
+    module docstring"""
+
+    def __init__(self, interval=PROGRESS_INTERVAL, report_path=None, profile=None,
+                 profile_path=None, stream=None, top=TOP_FUNCTIONS):
+        if profile is not None and profile not in PROFILERS:
+            raise ValueError("profile must be one of %s" % ', '.join(sorted(PROFILERS)))
+        self.interval = interval
+        self.report_path = report_path
+        self.profile = profile
+        self.profile_path = profile_path
+        self.stream = stream
+        self.top = top
+        self.timer = pipeline.StageTimer()
+        self.counts = {}
+        self.options = {}
+        self.input = None
+        self.input_bytes = None
+        self.bytes_done = 0
+        self.position = None
+        self.profiler = None
+        self.started = None
+        self.last_progress = None
+        self.report = None
+
+    def __getstate__(self):
+        # the copy sent to a worker of process_map_parallel only counts
+        state = dict(self.__dict__)
+        state.update(interval=None, report_path=None, profile=None, stream=None,
+                     position=None, profiler=None)
+        return state
+
+    @property
+    def elements(self):
+        return sum(self.counts.itervalues())
+
+    def start(self, file_in, input_bytes=None, position=None, **options):
+        """Begin a run on file_in; position() is the number of input bytes
+        read so far, when it is known"""
+        self.input = file_in if isinstance(file_in, basestring) else getattr(file_in, 'name', None)
+        self.input_bytes = input_bytes
+        self.position = position
+        self.options.update(options)
+        self.started = self.last_progress = time.time()
+
+    def add_bytes(self, count):
+        self.bytes_done += count
+
+    def merge(self, other):
+        """Add the counts and stage times of a worker's copy"""
+        for tag, count in other.counts.iteritems():
+            self.counts[tag] = self.counts.get(tag, 0) + count
+        for stage, seconds in other.timer.seconds.iteritems():
+            self.timer.add(stage, seconds)
+
+    def _bytes(self):
+        return self.position() if self.position is not None else self.bytes_done
+
+    def tick(self, now=None):
+        """Print a progress line if interval seconds have passed"""
+        now = now or time.time()
+        if self.interval is not None and now - self.last_progress >= self.interval:
+            self.last_progress = now
+            self.progress(now)
+
+    def progress(self, now=None):
+        elapsed = (now or time.time()) - self.started
+        elements = self.elements
+        line = '%d elements (%s)  %.0f/s' % (
+            elements, ', '.join('%d %ss' % (count, tag) for tag, count in sorted(self.counts.iteritems())),
+            elements / elapsed if elapsed else 0)
+        done = self._bytes()
+        if self.input_bytes and done:
+            line += '  %.1f/%.1fMB (%.1f%%)' % (done / 1048576.0, self.input_bytes / 1048576.0,
+                                                100.0 * done / self.input_bytes)
+            line += '  ETA %s' % _duration(elapsed * (self.input_bytes - done) / done)
+        (self.stream or sys.stderr).write(line + '\n')
+
+    def watch(self, elements):
+        """Count elements as they go by, for loops timed elsewhere"""
+        counts = self.counts
+        n = 0
+        for element in elements:
+            tag = element.tag
+            counts[tag] = counts.get(tag, 0) + 1
+            n += 1
+            if n % CHECK_EVERY == 0:
+                self.tick()
+            yield element
+
+    def _loop(self, elements, shape, check, write, store):
+        clock = time.time
+        counts = self.counts
+        interval = self.interval
+        parse = shaping = checking = writing = 0.0
+        elements = iter(elements)
+        try:
+            while True:
+                start = clock()
+                try:
+                    element = next(elements)
+                except StopIteration:
+                    parse += clock() - start
+                    break
+                shaped_at = clock()
+                shaped = shape(element)
+                checked_at = done = clock()
+                if shaped:
+                    if check is not None:
+                        check(shaped)
+                        done = clock()
+                    write(shaped)
+                    if store is not None:
+                        store(element, shaped)
+                    writing += clock() - done
+                parse += shaped_at - start
+                shaping += checked_at - shaped_at
+                checking += done - checked_at
+                tag = element.tag
+                counts[tag] = counts.get(tag, 0) + 1
+                if interval is not None and start - self.last_progress >= interval:
+                    self.tick(start)
+        finally:
+            for stage, seconds in (('parse', parse), ('shape', shaping),
+                                   ('validate', checking), ('write', writing)):
+                self.timer.add(stage, seconds)
+
+    def run_loop(self, elements, shape, check, write, store=None):
+        """process_elements' loop, timed per stage: shape, check (unless
+        None), write and store(element, shaped) each element"""
+        return self.call(self._loop, elements, shape, check, write, store)
+
+    def call(self, func, *args):
+        """func(*args), under the profiler if there is one"""
+        if self.profile is None:
+            return func(*args)
+        if self.profiler is None:
+            self.profiler = PROFILERS[self.profile](self)
+        return self.profiler.runcall(func, *args)
+
+    def finish(self):
+        """Build the run report, write it to report_path and return it"""
+        seconds = time.time() - self.started
+        elements = self.elements
+        report = {'input': self.input,
+                  'input_bytes': self.input_bytes,
+                  'bytes_read': self._bytes() or None,
+                  'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.started)),
+                  'seconds': round(seconds, 3),
+                  'elements': elements,
+                  'counts': dict(self.counts),
+                  'elements_per_second': round(elements / seconds, 1) if seconds else None,
+                  'stages': dict((stage, round(value, 3))
+                                 for stage, value in self.timer.report().iteritems()),
+                  'peak_rss_mb': round(_peak_rss_mb(), 1),
+                  'options': self.options}
+        if self.profiler is not None:
+            report['profile'] = {'mode': self.profile, 'path': self.profile_path,
+                                 'top': self.profiler.top(self.top)}
+        if self.interval is not None:
+            self.progress()
+        if self.report_path:
+            with open(self.report_path, 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+        self.report = report
+        return report
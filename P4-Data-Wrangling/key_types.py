@@ -1,5 +1,5 @@
-import xml.etree.cElementTree as ET
 import re
+import osm_stream
 """
 Your task is to explore the data a bit more.
 Before you process the data and add it into your database, you should check the
@@ -44,8 +44,11 @@ def process_map(filename):
             "lower_colon": 0, 
             "problemchars": 0, 
             "other": 0}
-    for _, element in ET.iterparse(filename):
+    for element in osm_stream.iter_all(filename):
         keys = key_type(element, keys)
     print keys
+    return keys
+
+if __name__ == '__main__':
+    process_map(filename)
 
-process_map(filename) 
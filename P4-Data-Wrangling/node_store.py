@@ -0,0 +1,161 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+A compact node id -> (lat, lon) store for resolving way geometry without a
+database round trip.
+
+Ids are kept in a sorted array('l') and coordinates as 1e-7 degree fixed
+point integers in two array('i'), which is the precision OSM stores them at:
+16 bytes a node against well over 100 for a dict of tuples. Lookups are a
+bisect over the ids (numpy.searchsorted for bulk lookups when numpy is
+installed). A store can be saved to a file and opened again memory-mapped.
+
+process_map(..., node_store=NodeStore()) fills a store during the normal pass.
+"""
+from array import array
+from bisect import bisect_left
+import mmap
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SCALE = 10000000
+MAGIC = 'OSMNODES'
+HEADER = struct.Struct('<8sQ')
+MISSING = None
+
+
+class NodeStore(object):
+    """Sorted typed arrays of node ids and fixed point coordinates"""
+
+    def __init__(self):
+        self.ids = array('l')
+        self.lats = array('i')
+        self.lons = array('i')
+        self._sorted = True
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, node_id, lat, lon):
+        node_id = int(node_id)
+        # OSM files list nodes by id, so the arrays normally stay sorted
+        if self._sorted and self.ids and node_id <= self.ids[-1]:
+            self._sorted = False
+        self.ids.append(node_id)
+        self.lats.append(int(round(float(lat) * SCALE)))
+        self.lons.append(int(round(float(lon) * SCALE)))
+
+    def finish(self):
+        """Sort the arrays if nodes were added out of order"""
+        if not self._sorted:
+            order = sorted(xrange(len(self.ids)), key=self.ids.__getitem__)
+            self.ids = array('l', (self.ids[i] for i in order))
+            self.lats = array('i', (self.lats[i] for i in order))
+            self.lons = array('i', (self.lons[i] for i in order))
+            self._sorted = True
+        return self
+
+    def get(self, node_id, default=MISSING):
+        """(lat, lon) of node_id (an int or, as in parsed XML, a str)"""
+        if not self._sorted:
+            self.finish()
+        node_id = int(node_id)
+        i = bisect_left(self.ids, node_id)
+        if i < len(self.ids) and self.ids[i] == node_id:
+            return float(self.lats[i]) / SCALE, float(self.lons[i]) / SCALE
+        return default
+
+    def resolve(self, node_ids, default=MISSING):
+        """[(lat, lon), ...] for node_ids, e.g. the nodes of a way"""
+        if not self._sorted:
+            self.finish()
+        if numpy is not None and len(node_ids) > 64:
+            return _resolve_numpy(self, node_ids, default)
+        get = self.get
+        return [get(node_id, default) for node_id in node_ids]
+
+    def resolve_ways(self, ways):
+        """{way id: [(lat, lon), ...]} for {way id: [node ids]}"""
+        return dict((way_id, self.resolve(node_ids)) for way_id, node_ids in ways.iteritems())
+
+    def save(self, path):
+        self.finish()
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, len(self.ids)))
+            self.ids.tofile(f)
+            self.lats.tofile(f)
+            self.lons.tofile(f)
+
+
+def _resolve_numpy(store, node_ids, default):
+    ids = numpy.frombuffer(store.ids, dtype=numpy.int64) if isinstance(store.ids, array) \
+        else numpy.asarray(store.ids)
+    wanted = numpy.asarray(node_ids, dtype=numpy.int64)
+    idx = numpy.searchsorted(ids, wanted)
+    idx[idx >= len(ids)] = 0
+    found = ids[idx] == wanted
+    result = []
+    for i, ok in zip(idx.tolist(), found.tolist()):
+        if ok:
+            result.append((float(store.lats[i]) / SCALE, float(store.lons[i]) / SCALE))
+        else:
+            result.append(default)
+    return result
+
+
+class _MappedArray(object):
+    """Read-only sequence over fixed size integers in an mmap"""
+
+    def __init__(self, buf, offset, count, code):
+        self._buf = buf
+        self._offset = offset
+        self._count = count
+        self._item = struct.Struct('<' + code)
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        return self._item.unpack_from(self._buf, self._offset + i * self._item.size)[0]
+
+
+class MappedNodeStore(NodeStore):
+    """A saved NodeStore opened memory-mapped instead of read into memory"""
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a node store file" % path)
+        offset = HEADER.size
+        self._sorted = True
+        if numpy is not None:
+            self.ids = numpy.frombuffer(self._map, numpy.int64, count, offset)
+            self.lats = numpy.frombuffer(self._map, numpy.int32, count, offset + 8 * count)
+            self.lons = numpy.frombuffer(self._map, numpy.int32, count, offset + 12 * count)
+        else:
+            self.ids = _MappedArray(self._map, offset, count, 'q')
+            self.lats = _MappedArray(self._map, offset + 8 * count, count, 'i')
+            self.lons = _MappedArray(self._map, offset + 12 * count, count, 'i')
+
+    def add(self, node_id, lat, lon):
+        raise TypeError("a mapped node store is read-only")
+
+    def close(self):
+        self.ids = self.lats = self.lons = None
+        self._map.close()
+        self._file.close()
+
+
+def load(path):
+    """Open a store written by NodeStore.save"""
+    return MappedNodeStore(path)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Lookup tables for the value cleaners used while shaping elements.
+
+The same few thousand street names and postcodes repeat millions of times
+in an extract, so every distinct raw value is cleaned once and the result is
+looked up afterwards. A Normalizer answers from a precomputed table (built
+with build_tables and saved to disk with save_tables) and falls back to a
+bounded memoization cache for values the table does not know.
+"""
+import json
+
+import audit
+
+CACHE_SIZE = 100000
+
+
+class Normalizer(object):
+    """Map a raw value to clean(value) with a dict lookup"""
+
+    def __init__(self, clean, table=None, maxsize=CACHE_SIZE):
+        self.clean = clean
+        self.table = dict(table or {})
+        self.cache = {}
+        self.maxsize = maxsize
+
+    def __call__(self, value):
+        cleaned = self.table.get(value)
+        if cleaned is not None:
+            return cleaned
+        cleaned = self.cache.get(value)
+        if cleaned is None:
+            # the cache is only a speed up; dropping it keeps memory bounded
+            if len(self.cache) >= self.maxsize:
+                self.cache.clear()
+            cleaned = self.cache[value] = self.clean(value)
+        return cleaned
+
+    def build(self, values):
+        """Add the cleaned form of every value to the lookup table"""
+        for value in values:
+            self.table[value] = self.clean(value)
+        return self
+
+
+def collect_values(osmfile, keys_by_name):
+    """Distinct tag values in one pass: {name: set of values} for
+    keys_by_name = {name: [tag keys]}"""
+    def add(values, value):
+        values.add(value)
+    auditors = [audit.Auditor(name, keys, add, set)
+                for name, keys in keys_by_name.iteritems()]
+    return audit.run_audits(osmfile, auditors)
+
+
+def build_tables(osmfile, normalizers, keys_by_name):
+    """Fill the lookup table of each named normalizer from the values in osmfile"""
+    values = collect_values(osmfile, keys_by_name)
+    for name, normalizer in normalizers.iteritems():
+        normalizer.build(values.get(name, ()))
+    return normalizers
+
+
+def save_tables(path, normalizers):
+    with open(path, 'w') as f:
+        json.dump(dict((name, n.table) for name, n in normalizers.iteritems()), f,
+                  indent=1, sort_keys=True)
+
+
+def load_tables(path, normalizers):
+    """Replace the lookup tables of the named normalizers with the saved ones"""
+    with open(path) as f:
+        tables = json.load(f)
+    for name, normalizer in normalizers.iteritems():
+        normalizer.table = tables.get(name, {})
+        normalizer.cache.clear()
+    return normalizers
@@ -0,0 +1,113 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Helpers for cutting an OSM XML file into byte ranges that can be parsed on
+their own. Every range starts on a top level <node> or <way> element, so a
+range wrapped in <osm>...</osm> is a well formed document.
+
+'<' is always escaped inside attribute values, which means the text '<node'
+or '<way' can only ever appear at the start of one of those elements.
+"""
+import os
+import re
+
+ELEMENT_START = re.compile(r'<(?:node|way)[\s/>]')
+DOCUMENT_END = '</osm>'
+BLOCK_SIZE = 1 << 20
+
+
+def find_boundary(osm_file, offset, limit=None, pattern=ELEMENT_START):
+    """Return the offset of the first element start at or after offset, or None"""
+    overlap = 16
+    osm_file.seek(offset)
+    position = offset
+    while limit is None or position < limit:
+        block = osm_file.read(BLOCK_SIZE)
+        if not block:
+            return None
+        m = pattern.search(block)
+        if m:
+            found = position + m.start()
+            return found if limit is None or found < limit else None
+        if len(block) < BLOCK_SIZE:
+            return None
+        # step back a little so a tag cut by the block edge is seen again
+        position += len(block) - overlap
+        osm_file.seek(position)
+    return None
+
+
+def find_document_end(osm_file):
+    """Return the offset of the closing </osm> tag"""
+    size = os.fstat(osm_file.fileno()).st_size
+    position = size
+    while position > 0:
+        start = max(0, position - BLOCK_SIZE)
+        osm_file.seek(start)
+        block = osm_file.read(position - start + len(DOCUMENT_END))
+        found = block.rfind(DOCUMENT_END)
+        if found != -1:
+            return start + found
+        position = start
+    return size
+
+
+def split_osm(filename, parts):
+    """Return a list of (start, end) byte ranges covering all nodes and ways"""
+    with open(filename, 'rb') as osm_file:
+        first = find_boundary(osm_file, 0)
+        if first is None:
+            return []
+        end = find_document_end(osm_file)
+        step = max(1, (end - first) // max(1, parts))
+        starts = [first]
+        for i in range(1, parts):
+            start = find_boundary(osm_file, max(first + i * step, starts[-1] + 1), end)
+            if start is None:
+                break
+            if start > starts[-1]:
+                starts.append(start)
+    return zip(starts, starts[1:] + [end])
+
+
+class OSMChunk(object):
+    """Read-only file object over one byte range, wrapped in <osm></osm>"""
+
+    prefix = '<?xml version="1.0" encoding="UTF-8"?>\n<osm>\n'
+    suffix = '\n</osm>\n'
+
+    def __init__(self, filename, start, end):
+        self._file = open(filename, 'rb')
+        self._file.seek(start)
+        self._remaining = end - start
+        self._head = self.prefix
+        self._tail = self.suffix
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._remaining + len(self._head) + len(self._tail)
+        out = []
+        if self._head:
+            out.append(self._head[:size])
+            self._head = self._head[size:]
+            size -= len(out[-1])
+        if size > 0 and self._remaining > 0:
+            data = self._file.read(min(size, self._remaining))
+            self._remaining -= len(data)
+            if not data:
+                self._remaining = 0
+            out.append(data)
+            size -= len(data)
+        if size > 0 and self._remaining == 0 and self._tail:
+            out.append(self._tail[:size])
+            self._tail = self._tail[size:]
+        return ''.join(out)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
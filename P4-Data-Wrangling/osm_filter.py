@@ -0,0 +1,90 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Declarative element filters that run while the file is parsed, so that an
+extraction of, say, the restaurants in one neighbourhood only shapes and
+writes the elements it keeps.
+
+    ElementFilter(types=['node'], keys=['amenity', 'cuisine', 'addr:*'],
+                  tags={'amenity': ['restaurant', 'cafe']},
+                  bbox=(37.30, -121.92, 37.36, -121.86))
+
+All the given conditions must hold. types limits the element types kept.
+keys keeps elements with any of the keys ('addr:*' matches every key with
+that prefix) and tags any of the key/value pairs; given both, either one
+will do. bbox keeps the nodes inside the box and the ways with at least one
+node inside it, which means remembering the ids of the nodes in the box.
+
+A filter is passed as process_map(..., element_filter=f) or
+get_element(..., accept=f). Ways are kept or dropped on their own, so a
+filtered extract may have ways_nodes rows for nodes it left out.
+process_map starts every run with f.reset(), so a filter can be used for
+several runs; call it yourself before reusing one with get_element.
+"""
+
+
+class ElementFilter(object):
+    """A predicate on parsed elements; see the module docstring"""
+
+    def __init__(self, types=None, keys=None, tags=None, bbox=None):
+        self.types = frozenset(types) if types else None
+        keys = keys or ()
+        self.exact_keys = frozenset(k for k in keys if not k.endswith('*'))
+        self.prefixes = tuple(k[:-1] for k in keys if k.endswith('*'))
+        self.tags = {}
+        for k, values in (tags or {}).iteritems():
+            self.tags[k] = frozenset([values] if isinstance(values, basestring) else values)
+        self.match_tags = bool(self.exact_keys or self.prefixes or self.tags)
+        self.bbox = tuple(float(x) for x in bbox) if bbox is not None else None
+        self.in_box = set()
+
+    def reset(self):
+        """Forget the nodes seen in the box, before a new file or run"""
+        self.in_box = set()
+
+    @property
+    def stateful(self):
+        """True if the result for a way depends on the nodes seen before it,
+        so the file cannot be filtered in independent pieces"""
+        return self.bbox is not None and (self.types is None or 'way' in self.types)
+
+    def _inside(self, element):
+        if element.tag == 'node':
+            min_lat, min_lon, max_lat, max_lon = self.bbox
+            attrib = element.attrib
+            try:
+                inside = (min_lat <= float(attrib['lat']) <= max_lat and
+                          min_lon <= float(attrib['lon']) <= max_lon)
+            except (KeyError, ValueError):
+                return False
+            if inside and self.stateful:
+                self.in_box.add(attrib['id'])
+            return inside
+        if element.tag == 'way':
+            in_box = self.in_box
+            for nd in element.iter('nd'):
+                if nd.attrib['ref'] in in_box:
+                    return True
+        return False
+
+    def _tagged(self, element):
+        exact_keys, prefixes, tags = self.exact_keys, self.prefixes, self.tags
+        for tag in element.iter('tag'):
+            k = tag.attrib['k']
+            if k in exact_keys or (prefixes and k.startswith(prefixes)):
+                return True
+            values = tags.get(k)
+            if values is not None and tag.attrib['v'] in values:
+                return True
+        return False
+
+    def __call__(self, element):
+        # the box is checked first: nodes of other types or tags are still
+        # needed to place the ways
+        if self.bbox is not None and not self._inside(element):
+            return False
+        if self.types is not None and element.tag not in self.types:
+            return False
+        if self.match_tags:
+            return self._tagged(element)
+        return True
@@ -0,0 +1,551 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+A reader for OpenStreetMap PBF extracts (.osm.pbf) that yields the same
+elements as parsing the equivalent XML, so shape_element, the auditors and
+the exploratory scripts work on either format. osm_stream.iter_elements and
+iter_all hand .pbf paths over to this module.
+
+A PBF file is a sequence of blobs, each a zlib compressed PrimitiveBlock of
+up to 8000 nodes, ways or relations. Blobs are independent of each other, so
+they are decoded in a multiprocessing.Pool while the main thread turns the
+decoded primitives into Elements, in file order. The main thread reads a
+blob only when fewer than READ_AHEAD blobs a worker are waiting to be
+decoded or consumed, so memory stays flat however large the file is.
+
+The protobuf messages are decoded by hand (only the fields of
+fileformat.proto and osmformat.proto that the XML carries), so nothing
+beyond the standard library is needed.
+"""
+from collections import deque
+import multiprocessing
+import struct
+import time
+import xml.etree.cElementTree as ET
+import zlib
+
+WORKERS = multiprocessing.cpu_count()
+READ_AHEAD = 4
+
+SUPPORTED_FEATURES = frozenset(['OsmSchema-V0.6', 'DenseNodes', 'HistoricalInformation'])
+MEMBER_TYPES = ('node', 'way', 'relation')
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+_LENGTH = struct.Struct('>I')
+
+
+def is_pbf(osm_file):
+    return isinstance(osm_file, basestring) and osm_file.endswith('.pbf')
+
+
+# ================================================== #
+#               Protobuf wire format                 #
+# ================================================== #
+def _varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _signed(n):
+    # int32/int64 fields: negative numbers are sent as 64 bit two's complement
+    return n - (1 << 64) if n >= 1 << 63 else n
+
+
+def _zigzag(n):
+    # sint32/sint64 fields
+    return (n >> 1) ^ -(n & 1)
+
+
+def _fields(buf):
+    """Yield (field number, value) for a message in buf, a bytearray.
+    Varints are ints, length delimited fields bytearrays; fixed width fields
+    are not used by the OSM messages and are skipped."""
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = _varint(buf, pos)
+        elif wire_type == 2:
+            size, pos = _varint(buf, pos)
+            value = buf[pos:pos + size]
+            pos += size
+        elif wire_type == 1:
+            pos += 8
+            continue
+        elif wire_type == 5:
+            pos += 4
+            continue
+        else:
+            raise ValueError("unsupported protobuf wire type %d" % wire_type)
+        yield key >> 3, value
+
+
+def _packed(buf):
+    """The unsigned varints of a packed repeated field"""
+    # _varint inlined: these fields hold most of the numbers in a file
+    values = []
+    append = values.append
+    result = shift = 0
+    for b in buf:
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            append(result)
+            result = shift = 0
+        else:
+            shift += 7
+    return values
+
+
+def _packed_delta(buf):
+    """A packed sint64 field delta coded against the previous value"""
+    values = []
+    append = values.append
+    last = 0
+    for n in _packed(buf):
+        last += (n >> 1) ^ -(n & 1)
+        append(last)
+    return values
+
+
+# ================================================== #
+#               Blobs                                #
+# ================================================== #
+def iter_blobs(f):
+    """Yield (type, raw Blob message) for each blob in an open PBF file"""
+    while True:
+        prefix = f.read(4)
+        if not prefix:
+            return
+        if len(prefix) < 4:
+            raise ValueError("truncated PBF blob header")
+        header = bytearray(f.read(_LENGTH.unpack(prefix)[0]))
+        blob_type, size = None, 0
+        for number, value in _fields(header):
+            if number == 1:
+                blob_type = str(value)
+            elif number == 3:
+                size = value
+        data = f.read(size)
+        if len(data) < size:
+            raise ValueError("truncated PBF blob")
+        yield blob_type, data
+
+
+def blob_data(data):
+    """The uncompressed payload of a Blob message"""
+    for number, value in _fields(bytearray(data)):
+        if number == 1:
+            return value
+        if number == 3:
+            return bytearray(zlib.decompress(bytes(value)))
+        if number in (4, 5, 6, 7):
+            raise ValueError("unsupported PBF blob compression (field %d)" % number)
+    raise ValueError("empty PBF blob")
+
+
+def check_header(data):
+    """Raise ValueError if the OSMHeader blob requires an unsupported feature"""
+    for number, value in _fields(blob_data(data)):
+        if number == 4 and str(value) not in SUPPORTED_FEATURES:
+            raise ValueError("unsupported PBF feature %s" % value)
+
+
+# ================================================== #
+#               Primitive blocks                     #
+# ================================================== #
+def _text(value):
+    # match cElementTree: plain str for ASCII, unicode otherwise
+    value = str(value)
+    try:
+        value.decode('ascii')
+        return value
+    except UnicodeDecodeError:
+        return value.decode('utf-8')
+
+
+class _Block(object):
+    """Offsets and string table shared by the groups of a PrimitiveBlock"""
+
+    def __init__(self, strings, granularity, lat_offset, lon_offset, date_granularity):
+        self.strings = strings
+        self.granularity = granularity
+        self.lat_offset = lat_offset
+        self.lon_offset = lon_offset
+        self.date_granularity = date_granularity
+
+    def coordinate(self, offset, value):
+        degrees = (offset + self.granularity * value) * 1e-9
+        return ('%.7f' % degrees).rstrip('0').rstrip('.')
+
+    def timestamp(self, value):
+        return time.strftime(TIME_FORMAT, time.gmtime(value * self.date_granularity / 1000))
+
+    def tags(self, keys, vals):
+        strings = self.strings
+        return [(strings[k], strings[v]) for k, v in zip(keys, vals)]
+
+    def info(self, buf):
+        attrib = []
+        for number, value in _fields(buf):
+            if number == 1:
+                attrib.append(('version', str(value)))
+            elif number == 2:
+                attrib.append(('timestamp', self.timestamp(_signed(value))))
+            elif number == 3:
+                attrib.append(('changeset', str(_signed(value))))
+            elif number == 4:
+                attrib.append(('uid', str(_signed(value))))
+            elif number == 5:
+                attrib.append(('user', self.strings[value]))
+            elif number == 6 and not value:
+                attrib.append(('visible', 'false'))
+        return attrib
+
+
+def _node(block, buf):
+    node_id, lat, lon, keys, vals, info = 0, 0, 0, [], [], []
+    for number, value in _fields(buf):
+        if number == 1:
+            node_id = _zigzag(value)
+        elif number == 2:
+            keys = _packed(value)
+        elif number == 3:
+            vals = _packed(value)
+        elif number == 4:
+            info = block.info(value)
+        elif number == 8:
+            lat = _zigzag(value)
+        elif number == 9:
+            lon = _zigzag(value)
+    attrib = [('id', str(node_id)),
+              ('lat', block.coordinate(block.lat_offset, lat)),
+              ('lon', block.coordinate(block.lon_offset, lon))] + info
+    return ('node', attrib, block.tags(keys, vals), None)
+
+
+def _dense_info(block, buf, count):
+    columns = {}
+    for number, value in _fields(buf):
+        if number == 1:
+            columns['version'] = [str(v) for v in _packed(value)]
+        elif number == 2:
+            columns['timestamp'] = [block.timestamp(v) for v in _packed_delta(value)]
+        elif number == 3:
+            columns['changeset'] = [str(v) for v in _packed_delta(value)]
+        elif number == 4:
+            columns['uid'] = [str(v) for v in _packed_delta(value)]
+        elif number == 5:
+            columns['user'] = [block.strings[v] for v in _packed_delta(value)]
+        elif number == 6:
+            columns['visible'] = [None if v else 'false' for v in _packed(value)]
+    order = [name for name in ('version', 'timestamp', 'changeset', 'uid', 'user', 'visible')
+             if name in columns]
+    rows = []
+    for i in xrange(count):
+        rows.append([(name, columns[name][i]) for name in order if columns[name][i] is not None])
+    return rows
+
+
+def _dense_nodes(block, buf):
+    ids, lats, lons, keys_vals, infos = [], [], [], [], None
+    for number, value in _fields(buf):
+        if number == 1:
+            ids = _packed_delta(value)
+        elif number == 5:
+            infos = value
+        elif number == 8:
+            lats = _packed_delta(value)
+        elif number == 9:
+            lons = _packed_delta(value)
+        elif number == 10:
+            keys_vals = _packed(value)
+    infos = _dense_info(block, infos, len(ids)) if infos is not None else None
+    strings = block.strings
+    coordinate = block.coordinate
+    lat_offset, lon_offset = block.lat_offset, block.lon_offset
+    # keys_vals holds k, v, k, v, ..., 0 for each node
+    keys_vals = iter(keys_vals)
+    nodes = []
+    for i, node_id in enumerate(ids):
+        tags = []
+        for k in keys_vals:
+            if k == 0:
+                break
+            tags.append((strings[k], strings[next(keys_vals)]))
+        attrib = [('id', str(node_id)),
+                  ('lat', coordinate(lat_offset, lats[i])),
+                  ('lon', coordinate(lon_offset, lons[i]))]
+        if infos is not None:
+            attrib += infos[i]
+        nodes.append(('node', attrib, tags, None))
+    return nodes
+
+
+def _way(block, buf):
+    way_id, keys, vals, info, refs = 0, [], [], [], []
+    for number, value in _fields(buf):
+        if number == 1:
+            way_id = _signed(value)
+        elif number == 2:
+            keys = _packed(value)
+        elif number == 3:
+            vals = _packed(value)
+        elif number == 4:
+            info = block.info(value)
+        elif number == 8:
+            refs = [('nd', [('ref', str(ref))]) for ref in _packed_delta(value)]
+    return ('way', [('id', str(way_id))] + info, block.tags(keys, vals), refs)
+
+
+def _relation(block, buf):
+    relation_id, keys, vals, info, roles, memids, types = 0, [], [], [], [], [], []
+    for number, value in _fields(buf):
+        if number == 1:
+            relation_id = _signed(value)
+        elif number == 2:
+            keys = _packed(value)
+        elif number == 3:
+            vals = _packed(value)
+        elif number == 4:
+            info = block.info(value)
+        elif number == 8:
+            roles = [block.strings[_signed(v)] for v in _packed(value)]
+        elif number == 9:
+            memids = _packed_delta(value)
+        elif number == 10:
+            types = _packed(value)
+    members = [('member', [('type', MEMBER_TYPES[t]), ('ref', str(ref)), ('role', role)])
+               for t, ref, role in zip(types, memids, roles)]
+    return ('relation', [('id', str(relation_id))] + info, block.tags(keys, vals), members)
+
+
+GROUP_DECODERS = {1: ('node', _node), 3: ('way', _way), 4: ('relation', _relation)}
+
+
+def decode_block(args):
+    """Decode one OSMData blob into a list of (tag, attrib, tags, children)
+    for the element types in tags. Runs in the worker processes."""
+    data, tags = args
+    payload = blob_data(data)
+    strings, groups = [], []
+    settings = {17: 100, 19: 0, 20: 0, 18: 1000}
+    for number, value in _fields(payload):
+        if number == 1:
+            strings = [_text(s) for n, s in _fields(value) if n == 1]
+        elif number == 2:
+            groups.append(value)
+        elif number in settings:
+            settings[number] = _signed(value)
+    block = _Block(strings, settings[17], settings[19], settings[20], settings[18])
+    primitives = []
+    for group in groups:
+        for number, value in _fields(group):
+            if number == 2:
+                if 'node' in tags:
+                    primitives.extend(_dense_nodes(block, value))
+            elif number in GROUP_DECODERS:
+                tag, decode = GROUP_DECODERS[number]
+                if tag in tags:
+                    primitives.append(decode(block, value))
+    return primitives
+
+
+# ================================================== #
+#               Elements                             #
+# ================================================== #
+def _element(primitive):
+    tag, attrib, tags, children = primitive
+    elem = ET.Element(tag, dict(attrib))
+    if children:
+        for child_tag, child_attrib in children:
+            ET.SubElement(elem, child_tag, dict(child_attrib))
+    for k, v in tags:
+        ET.SubElement(elem, 'tag', {'k': k, 'v': v})
+    return elem
+
+
+def _data_blobs(f, tags):
+    for blob_type, data in iter_blobs(f):
+        if blob_type == 'OSMHeader':
+            check_header(data)
+        elif blob_type == 'OSMData':
+            yield data, tags
+
+
+def iter_blocks(osm_file, tags, workers=WORKERS):
+    """Yield the decoded primitives of each data blob, in file order"""
+    with open(osm_file, 'rb') as f:
+        blobs = _data_blobs(f, tags)
+        if workers <= 1:
+            for args in blobs:
+                yield decode_block(args)
+            return
+        # Pool.imap would read the whole file into its task queue up front
+        pool = multiprocessing.Pool(workers)
+        try:
+            pending = deque()
+            limit = workers * READ_AHEAD
+            for args in blobs:
+                if len(pending) >= limit:
+                    yield pending.popleft().get()
+                pending.append(pool.apply_async(decode_block, (args,)))
+            while pending:
+                yield pending.popleft().get()
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+def iter_elements(osm_file, tags=('node', 'way', 'relation'), workers=WORKERS):
+    """Yield an Element for each node, way or relation whose tag is in tags,
+    with the children the XML would have (tag, nd, member)"""
+    for primitives in iter_blocks(osm_file, tags, workers):
+        for primitive in primitives:
+            yield _element(primitive)
+
+
+def iter_all(osm_file, workers=WORKERS):
+    """Every element, children before their parent, like osm_stream.iter_all"""
+    for elem in iter_elements(osm_file, workers=workers):
+        for child in elem:
+            yield child
+        yield elem
+
+
+# ================================================== #
+#               Round trip test                      #
+# ================================================== #
+def _encode_varint(n):
+    if n < 0:
+        n += 1 << 64
+    out = bytearray()
+    while True:
+        b = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return out
+
+
+def _encode_field(number, value):
+    if isinstance(value, (int, long)):
+        return _encode_varint(number << 3) + _encode_varint(value)
+    value = bytearray(value)
+    return _encode_varint(number << 3 | 2) + _encode_varint(len(value)) + value
+
+
+def _encode_packed(number, values, zigzag=False, delta=False):
+    out = bytearray()
+    last = 0
+    for v in values:
+        if delta:
+            v, last = v - last, v
+        if zigzag:
+            v = (v << 1) ^ (v >> 63)
+        out += _encode_varint(v)
+    return _encode_field(number, out)
+
+
+def _encode_blob(blob_type, payload, compress=True):
+    if compress:
+        blob = _encode_field(2, len(payload)) + _encode_field(3, zlib.compress(bytes(payload)))
+    else:
+        blob = _encode_field(1, payload)
+    header = _encode_field(1, blob_type) + _encode_field(3, len(blob))
+    return _LENGTH.pack(len(header)) + bytes(header) + bytes(blob)
+
+
+def _test_file(path, nodes):
+    """A file with two data blobs: dense nodes, then a way, a plain node and
+    a relation. Returns the XML attributes each element should come back with."""
+    strings = ['', 'name', 'addr:street', 'someone', u'Caf\xe9'.encode('utf-8'), 'outer',
+               'highway', 'residential']
+    ids = range(1, nodes + 1)
+    lats = [373000000 + i for i in ids]          # granularity 100: 37.3 + i * 1e-7
+    lons = [-1219000000 - i for i in ids]
+    keys_vals = []
+    for i in ids:
+        keys_vals += [1, 4, 0] if i % 2 else [0]
+    dense_info = (_encode_packed(1, [2] * nodes) +
+                  _encode_packed(2, [1451606400 + i for i in ids], zigzag=True, delta=True) +
+                  _encode_packed(3, [7] * nodes, zigzag=True, delta=True) +
+                  _encode_packed(4, [42] * nodes, zigzag=True, delta=True) +
+                  _encode_packed(5, [3] * nodes, zigzag=True, delta=True))
+    dense = (_encode_packed(1, ids, zigzag=True, delta=True) + _encode_field(5, dense_info) +
+             _encode_packed(8, lats, zigzag=True, delta=True) +
+             _encode_packed(9, lons, zigzag=True, delta=True) + _encode_packed(10, keys_vals))
+    string_table = bytearray().join(_encode_field(1, s) for s in strings)
+    settings = _encode_field(18, 1000)
+    first = _encode_field(1, string_table) + _encode_field(2, _encode_field(2, dense)) + settings
+    info = _encode_field(1, 3) + _encode_field(2, 1451606400) + _encode_field(5, 3)
+    way = (_encode_field(1, 1000) + _encode_packed(2, [6]) + _encode_packed(3, [7]) +
+           _encode_field(4, info) + _encode_packed(8, [3, 1, 2], zigzag=True, delta=True))
+    node = (_encode_field(1, (nodes + 1) << 1) + _encode_packed(2, [2]) + _encode_packed(3, [4]) +
+            _encode_field(8, (1000000 << 1) - 1) + _encode_field(9, 5 << 1))
+    relation = (_encode_field(1, 2000) + _encode_packed(8, [5, 0]) +
+                _encode_packed(9, [1000, nodes + 1], zigzag=True, delta=True) +
+                _encode_packed(10, [1, 0]))
+    second = (_encode_field(1, string_table) +
+              _encode_field(2, _encode_field(3, way)) +
+              _encode_field(2, _encode_field(1, node) + _encode_field(4, relation)) + settings)
+    header = _encode_field(4, 'OsmSchema-V0.6') + _encode_field(4, 'DenseNodes')
+    with open(path, 'wb') as f:
+        f.write(_encode_blob('OSMHeader', header))
+        f.write(_encode_blob('OSMData', first))
+        f.write(_encode_blob('OSMData', second, compress=False))
+    expected = []
+    for i in ids:
+        expected.append(('node', {'id': str(i), 'version': '2', 'changeset': '7', 'uid': '42', 'user': 'someone',
+                                  'timestamp': time.strftime(TIME_FORMAT, time.gmtime(1451606400 + i))},
+                         [('name', u'Caf\xe9')] if i % 2 else []))
+    expected.append(('way', {'id': '1000', 'version': '3', 'user': 'someone',
+                             'timestamp': '2016-01-01T00:00:00Z'}, [('highway', 'residential')]))
+    expected.append(('node', {'id': str(nodes + 1), 'lat': '-0.1', 'lon': '0.0000005'},
+                     [('addr:street', u'Caf\xe9')]))
+    expected.append(('relation', {'id': '2000'}, []))
+    return expected
+
+
+def test(nodes=5000):
+    """Encode a small PBF file and read it back serially and in parallel"""
+    import os
+    import tempfile
+    fd, path = tempfile.mkstemp(suffix='.osm.pbf')
+    os.close(fd)
+    try:
+        expected = _test_file(path, nodes)
+        for workers in (1, 2):
+            elements = list(iter_elements(path, workers=workers))
+            assert len(elements) == len(expected), len(elements)
+            for elem, (tag, attrib, tags) in zip(elements, expected):
+                assert elem.tag == tag, (elem.tag, tag)
+                for k, v in attrib.iteritems():
+                    if v is not None:
+                        assert elem.get(k) == v, (tag, k, elem.get(k), v)
+                assert [(t.get('k'), t.get('v')) for t in elem.iter('tag')] == tags
+            assert [nd.get('ref') for nd in elements[nodes].iter('nd')] == ['3', '1', '2']
+            assert [(m.get('type'), m.get('ref'), m.get('role')) for m in elements[-1]] == \
+                [('way', '1000', 'outer'), ('node', str(nodes + 1), '')]
+            assert (elements[0].get('lat'), elements[0].get('lon')) == ('37.3000001', '-121.9000001')
+        ways = list(iter_elements(path, tags=('way',)))
+        assert [w.get('id') for w in ways] == ['1000']
+        assert sum(1 for _ in iter_all(path)) == len(expected) + nodes / 2 + nodes % 2 + 7
+        print "osm_pbf: %d elements read back" % len(expected)
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    test()
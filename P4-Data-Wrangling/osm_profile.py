@@ -0,0 +1,244 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+One streaming pass over an OSM file that produces the reports of
+tag_types.count_tags, key_types.process_map and exploring_users.process_map
+together, plus the number of distinct values of each tag key.
+
+profile(osmfile) is exact: it keeps every uid and every distinct value per
+key, which is fine for a city extract. profile(osmfile, approximate=True)
+keeps memory bounded for country sized files instead:
+
+  - distinct users and the values of each key are counted with HyperLogLog
+    (about 1% standard error for users, 3% per key),
+  - key frequencies go into a count-min sketch, which never undercounts,
+    and only the most frequent keys are tracked by name (top).
+
+Element and key category counts are small and always exact.
+"""
+import hashlib
+import math
+import pprint
+import struct
+from array import array
+
+import key_types
+import osm_stream
+
+filename = 'san_jose_california.osm'
+
+TOP_KEYS = 50
+CATEGORY_CACHE_SIZE = 100000
+
+_UINT64 = struct.Struct('<Q')
+_UINT32x4 = struct.Struct('<IIII')
+
+
+def key_category(k):
+    """The key_types category of a tag key"""
+    if key_types.lower.search(k):
+        return 'lower'
+    elif key_types.lower_colon.search(k):
+        return 'lower_colon'
+    elif key_types.problemchars.search(k):
+        return 'problemchars'
+    return 'other'
+
+
+def _digest(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return hashlib.md5(value).digest()
+
+
+# ================================================== #
+#               Sketches                             #
+# ================================================== #
+class HyperLogLog(object):
+    """Distinct count estimate in 2**precision bytes"""
+
+    def __init__(self, precision=14):
+        self.p = precision
+        self.m = 1 << precision
+        self.registers = bytearray(self.m)
+        self.alpha = 0.7213 / (1 + 1.079 / self.m)
+
+    def add(self, value):
+        x = _UINT64.unpack(_digest(value)[:8])[0]
+        index = x >> (64 - self.p)
+        rest = x & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def __len__(self):
+        m = self.m
+        estimate = self.alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        if estimate <= 2.5 * m:
+            zeros = self.registers.count('\x00')
+            if zeros:
+                # linear counting is more accurate while registers are empty
+                estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+
+class CountMinSketch(object):
+    """Frequency estimates that are never too low, in depth * width counters"""
+
+    def __init__(self, width=1 << 16, depth=4):
+        if depth > 4:
+            raise ValueError("at most 4 rows are hashed from one digest")
+        self.width = width
+        self.rows = [array('l', [0]) * width for _ in xrange(depth)]
+
+    def add(self, value, count=1):
+        """Count value and return its new estimate"""
+        hashes = _UINT32x4.unpack(_digest(value))
+        width = self.width
+        estimate = None
+        for row, h in zip(self.rows, hashes):
+            i = h % width
+            row[i] += count
+            if estimate is None or row[i] < estimate:
+                estimate = row[i]
+        return estimate
+
+    def __getitem__(self, value):
+        hashes = _UINT32x4.unpack(_digest(value))
+        return min(row[h % self.width] for row, h in zip(self.rows, hashes))
+
+
+class TopKeys(object):
+    """The (approximately) most frequent keys fed through a CountMinSketch,
+    each with a HyperLogLog of its values. A key that only becomes frequent
+    late has its values counted from then on."""
+
+    def __init__(self, size=TOP_KEYS, sketch=None, precision=10):
+        self.size = size
+        self.sketch = sketch or CountMinSketch()
+        self.precision = precision
+        self.counts = {}
+        self.values = {}
+        self.floor = 0
+
+    def add(self, key, value):
+        estimate = self.sketch.add(key)
+        counts = self.counts
+        if key not in counts:
+            if len(counts) >= self.size:
+                # floor is a lower bound on the smallest tracked count
+                if estimate <= self.floor:
+                    return
+                evicted = min(counts, key=counts.get)
+                self.floor = counts[evicted]
+                if estimate <= self.floor:
+                    return
+                del counts[evicted]
+                del self.values[evicted]
+            self.values[key] = HyperLogLog(self.precision)
+        counts[key] = estimate
+        self.values[key].add(value)
+
+    def most_common(self):
+        return sorted(self.counts.iteritems(), key=lambda item: (-item[1], item[0]))
+
+    def cardinalities(self):
+        return dict((key, len(hll)) for key, hll in self.values.iteritems())
+
+
+# ================================================== #
+#               Profile                              #
+# ================================================== #
+def profile(osmfile, approximate=False, top=TOP_KEYS):
+    """{'tags': element counts (count_tags), 'keys': key categories
+    (key_types), 'users': distinct uids (exploring_users), 'key_counts':
+    [(key, count)] most frequent first, 'value_cardinality': {key: distinct
+    values}}. Exact mode returns every key, approximate mode the top ones."""
+    tags = {}
+    categories = {'lower': 0, 'lower_colon': 0, 'problemchars': 0, 'other': 0}
+    category_of = {}
+    if approximate:
+        users = HyperLogLog()
+        add_user = users.add
+        keys = TopKeys(top)
+        add_key = keys.add
+    else:
+        users = set()
+        add_user = users.add
+        key_counts = {}
+        key_values = {}
+
+    for element in osm_stream.iter_all(osmfile):
+        tag = element.tag
+        tags[tag] = tags.get(tag, 0) + 1
+        if tag == 'tag':
+            k = element.attrib['k']
+            category = category_of.get(k)
+            if category is None:
+                category = key_category(k)
+                if len(category_of) < CATEGORY_CACHE_SIZE:
+                    category_of[k] = category
+            categories[category] += 1
+            v = element.get('v', '')
+            if approximate:
+                add_key(k, v)
+            else:
+                key_counts[k] = key_counts.get(k, 0) + 1
+                values = key_values.get(k)
+                if values is None:
+                    values = key_values[k] = set()
+                values.add(v)
+        elif tag in osm_stream.TOP_LEVEL:
+            uid = element.get('uid')
+            if uid:
+                add_user(uid)
+
+    if approximate:
+        most_common = keys.most_common()
+        cardinality = keys.cardinalities()
+    else:
+        most_common = sorted(key_counts.iteritems(), key=lambda item: (-item[1], item[0]))
+        cardinality = dict((k, len(values)) for k, values in key_values.iteritems())
+    return {'tags': tags,
+            'keys': categories,
+            'users': len(users),
+            'key_counts': most_common,
+            'value_cardinality': cardinality}
+
+
+# ================================================== #
+#               Sketch accuracy test                 #
+# ================================================== #
+def test(n=200000):
+    hll = HyperLogLog()
+    for i in xrange(n):
+        hll.add('uid %d' % i)
+        hll.add('uid %d' % (i / 2))
+    error = abs(len(hll) - n) / float(n)
+    assert error < 0.03, (len(hll), n)
+
+    small = HyperLogLog(10)
+    for i in xrange(100):
+        small.add(str(i))
+    assert abs(len(small) - 100) <= 5, len(small)
+
+    keys = TopKeys(size=10, sketch=CountMinSketch(width=1 << 10))
+    expected = {}
+    for i in xrange(n / 10):
+        # key j occurs about 1/j as often as key 1
+        j = 1 + (i * 7919) % 997
+        for k in xrange(1, 20):
+            if j % k == 0:
+                key = 'key%d' % k
+                keys.add(key, str(i % (k * 10)))
+                expected[key] = expected.get(key, 0) + 1
+    for key, count in keys.most_common():
+        assert count >= expected[key], (key, count, expected[key])
+    top = [key for key, _ in keys.most_common()[:5]]
+    assert top == ['key1', 'key2', 'key3', 'key4', 'key5'], top
+    assert keys.cardinalities()['key1'] == 10, keys.cardinalities()
+    print "osm_profile: HyperLogLog error %.2f%%, top keys %s" % (100 * error, ', '.join(top))
+
+
+if __name__ == '__main__':
+    pprint.pprint(profile(filename))
@@ -0,0 +1,197 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Bulk loading of shaped OSM elements into the tables of data_wrangling_schema.sql.
+
+The load runs with import-time PRAGMAs (no journal, no fsync, big page cache),
+inserts rows with batched executemany calls inside large transactions, and
+only builds the secondary indexes and checks the foreign keys once all rows
+are in.
+"""
+import os
+import sqlite3
+
+import rollups
+import spatial
+
+SCHEMA_SQL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               "data_wrangling_schema.sql")
+
+# shape_element output key -> table
+ELEMENT_TABLES = [('node', 'nodes'),
+                  ('node_tags', 'nodes_tags'),
+                  ('way', 'ways'),
+                  ('way_nodes', 'ways_nodes'),
+                  ('way_tags', 'ways_tags')]
+
+IMPORT_PRAGMAS = ["PRAGMA journal_mode = OFF",
+                  "PRAGMA synchronous = OFF",
+                  "PRAGMA foreign_keys = OFF",
+                  "PRAGMA temp_store = MEMORY",
+                  "PRAGMA cache_size = -200000"]
+
+# WAL lets query_service readers go on while apply_changes or the next load
+# writes
+AFTER_IMPORT_PRAGMAS = ["PRAGMA journal_mode = WAL"]
+
+TAG_INDEXES = ["CREATE INDEX IF NOT EXISTS nodes_tags_id ON nodes_tags (id)",
+               "CREATE INDEX IF NOT EXISTS ways_tags_id ON ways_tags (id)"]
+WAY_NODE_INDEXES = ["CREATE INDEX IF NOT EXISTS ways_nodes_id ON ways_nodes (id, position)",
+                    "CREATE INDEX IF NOT EXISTS ways_nodes_node_id ON ways_nodes (node_id)"]
+INDEXES = TAG_INDEXES + WAY_NODE_INDEXES
+
+BATCH_SIZE = 10000
+COMMIT_EVERY = 500000
+
+
+def read_schema(path=SCHEMA_SQL_PATH):
+    """Return the CREATE TABLE statements in the .sql file"""
+    with open(path) as f:
+        return [s.strip() for s in f.read().split(';') if s.strip()]
+
+
+def table_columns(con, table):
+    """Column names of table, in table order"""
+    return [row[1] for row in con.execute("PRAGMA table_info(%s)" % table)]
+
+
+def insert_statement(con, table, columns=None):
+    if columns is None:
+        columns = table_columns(con, table)
+    return "INSERT INTO %s (%s) VALUES (%s)" % (table, ", ".join(columns),
+                                               ", ".join("?" * len(columns))), columns
+
+
+def connect_for_import(db_path):
+    """Open db_path in autocommit mode with the import PRAGMAs applied.
+    Text may be inserted as UTF-8 encoded str. The connection may be handed
+    to the writer thread of a pipelined run."""
+    con = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+    con.text_factory = str
+    wal = con.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+    for pragma in IMPORT_PRAGMAS:
+        # leaving WAL mode needs the database to itself; stay in it, and the
+        # readers of query_service are not locked out while the load runs
+        if wal and pragma.startswith("PRAGMA journal_mode"):
+            continue
+        con.execute(pragma)
+    return con
+
+
+def drop(con, name):
+    """Drop the table or view called name, if there is one"""
+    row = con.execute("SELECT type FROM sqlite_master WHERE name = ? AND type IN ('table', 'view')",
+                      (name,)).fetchone()
+    if row is not None:
+        con.execute("DROP %s %s" % (row[0].upper(), name))
+
+
+def create_tables(con, schema_path=SCHEMA_SQL_PATH, replace=True):
+    """Create the typed tables of data_wrangling_schema.sql"""
+    for statement in read_schema(schema_path):
+        if replace:
+            drop(con, statement.split()[2])
+        con.execute(statement)
+
+
+def finish_import(con, indexes=INDEXES):
+    """Build the indexes (including the spatial ones) and the rollup tables,
+    check the foreign keys and restore the normal PRAGMAs. Returns the number of foreign key
+    violations; they are not fatal because an extract references nodes
+    outside its own bounds."""
+    for statement in indexes:
+        con.execute(statement)
+    spatial.build_spatial_index(con)
+    rollups.build_rollups(con)
+    con.execute("ANALYZE")
+    violations = sum(1 for _ in con.execute("PRAGMA foreign_key_check"))
+    for pragma in AFTER_IMPORT_PRAGMAS:
+        con.execute(pragma)
+    return violations
+
+
+class SQLiteSink(object):
+    """process_map sink that inserts shaped elements straight into SQLite.
+    With a tag_dictionary.TagDictionary the tags of write_rows are stored
+    dictionary encoded."""
+
+    def __init__(self, db_path, batch_size=BATCH_SIZE, commit_every=COMMIT_EVERY,
+                 schema_path=SCHEMA_SQL_PATH, row_fields=None, dictionary=None):
+        self.con = connect_for_import(db_path)
+        create_tables(self.con, schema_path)
+        self.dictionary = dictionary
+        self.tables = ELEMENT_TABLES
+        self.indexes = INDEXES
+        if dictionary is not None:
+            dictionary.create_tables(self.con)
+            self.tables = dictionary.element_tables
+            self.indexes = dictionary.indexes
+        self.batch_size = batch_size
+        self.commit_every = commit_every
+        self.statements = {}
+        self.buffers = {}
+        for key, table in self.tables:
+            columns = row_fields[key] if row_fields is not None else None
+            self.statements[key] = insert_statement(self.con, table, columns)
+            self.buffers[key] = []
+        self.pending = 0
+        self.foreign_key_violations = None
+        self.con.execute("BEGIN")
+
+    def _row(self, key, record):
+        return tuple(record[c] for c in self.statements[key][1])
+
+    def write(self, el):
+        for key, value in el.iteritems():
+            buf = self.buffers[key]
+            if isinstance(value, dict):
+                buf.append(self._row(key, value))
+            else:
+                buf.extend(self._row(key, record) for record in value)
+            if len(buf) >= self.batch_size:
+                self.flush(key)
+
+    def write_rows(self, rows):
+        """Buffer the output of shape_element_rows; the tuples must be in
+        the row_fields order given to the sink (table order by default)"""
+        if self.dictionary is not None:
+            rows = self.dictionary.encode_rows(rows)
+        for key, value in rows.iteritems():
+            buf = self.buffers[key]
+            if isinstance(value, tuple):
+                buf.append(value)
+            else:
+                buf.extend(value)
+            if len(buf) >= self.batch_size:
+                self.flush(key)
+
+    def flush(self, key):
+        buf = self.buffers[key]
+        if buf:
+            self.con.executemany(self.statements[key][0], buf)
+            self.pending += len(buf)
+            del buf[:]
+        if self.pending >= self.commit_every:
+            self.con.execute("COMMIT")
+            self.con.execute("BEGIN")
+            self.pending = 0
+
+    def close(self):
+        try:
+            for key, _ in self.tables:
+                self.flush(key)
+            if self.dictionary is not None:
+                self.dictionary.insert(self.con)
+            self.con.execute("COMMIT")
+            self.foreign_key_violations = finish_import(self.con, self.indexes)
+        finally:
+            self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.con.close()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Constant-memory iteration over an OSM XML file, shared by the transform,
+the auditors and the exploratory scripts.
+
+iterparse builds the whole tree unless elements are cleared. Here every top
+level element (node, way, relation, bounds, ...) is dropped from the root as
+soon as it has been handled, whether or not it matched the filter, so memory
+stays flat however large the file is.
+
+lxml is used as the parser when it is installed, cElementTree otherwise.
+Paths ending in .pbf are read with osm_pbf instead, which yields the same
+elements, and .gz and .bz2 files are decompressed as they are parsed.
+"""
+import os
+import resource
+import tempfile
+
+try:
+    from lxml import etree as ET
+    BACKEND = 'lxml'
+except ImportError:
+    import xml.etree.cElementTree as ET
+    BACKEND = 'cElementTree'
+
+import compressed_io
+import osm_pbf
+
+TOP_LEVEL = ('node', 'way', 'relation')
+
+
+def iter_elements(osm_file, tags=TOP_LEVEL, accept=None):
+    """Yield each top level element whose tag is in tags, complete with its
+    children. The element is cleared once the caller moves on.
+    accept(element), e.g. an osm_filter.ElementFilter, can reject elements
+    before they are yielded."""
+    if osm_pbf.is_pbf(osm_file):
+        for elem in osm_pbf.iter_elements(osm_file, tags):
+            if accept is None or accept(elem):
+                yield elem
+        return
+    if compressed_io.is_compressed(osm_file):
+        with compressed_io.open_input(osm_file) as source:
+            for elem in iter_elements(source, tags, accept):
+                yield elem
+        return
+    context = ET.iterparse(osm_file, events=("start", "end"))
+    _, root = next(context)
+    depth = 0
+    for event, elem in context:
+        if event == "start":
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 0:
+            if elem.tag in tags and (accept is None or accept(elem)):
+                yield elem
+            root.clear()
+
+
+def iter_all(osm_file):
+    """Yield every element, nested ones included, as it ends - the
+    equivalent of iterating over ET.iterparse(osm_file) - clearing each top
+    level element after its children have been yielded."""
+    if osm_pbf.is_pbf(osm_file):
+        for elem in osm_pbf.iter_all(osm_file):
+            yield elem
+        return
+    if compressed_io.is_compressed(osm_file):
+        with compressed_io.open_input(osm_file) as source:
+            for elem in iter_all(source):
+                yield elem
+        return
+    context = ET.iterparse(osm_file, events=("start", "end"))
+    _, root = next(context)
+    depth = 0
+    for event, elem in context:
+        if event == "start":
+            depth += 1
+            continue
+        depth -= 1
+        yield elem
+        if depth == 0:
+            root.clear()
+
+
+# ================================================== #
+#               Memory ceiling test                  #
+# ================================================== #
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _write_test_file(f, elements):
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n')
+    for i in xrange(elements):
+        f.write('  <node id="%d" lat="37.3" lon="-121.9" user="u" uid="1" version="1" '
+                'changeset="1" timestamp="2016-01-01T00:00:00Z">\n'
+                '    <tag k="name" v="node %d"/>\n  </node>\n' % (i, i))
+    # relations come last, as in real extracts, and are filtered out below;
+    # nothing matches after the last node so they must be cleared regardless
+    for i in xrange(elements):
+        f.write('  <relation id="%d" user="u" uid="1" version="1" changeset="1" '
+                'timestamp="2016-01-01T00:00:00Z">\n'
+                '    <member type="node" ref="%d" role=""/>\n'
+                '    <tag k="type" v="multipolygon"/>\n  </relation>\n' % (i, i))
+    f.write('</osm>\n')
+
+
+def test(elements=300000, ceiling_mb=32):
+    """RSS must not grow with the file: ~100MB of XML in under ceiling_mb"""
+    fd, path = tempfile.mkstemp(suffix='.osm')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            _write_test_file(f, elements)
+        before = _peak_rss_mb()
+        count = sum(1 for _ in iter_elements(path, tags=('node', 'way')))
+        assert count == elements, count
+        count = sum(1 for _ in iter_all(path))
+        assert count == elements * 5 + 1, count
+        growth = _peak_rss_mb() - before
+        assert growth < ceiling_mb, "peak RSS grew %.1fMB over %d elements" % (growth, elements)
+        print "%s: peak RSS grew %.1fMB streaming %.0fMB" % (
+            BACKEND, growth, os.path.getsize(path) / 1048576.0)
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    test()
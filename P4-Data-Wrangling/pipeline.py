@@ -0,0 +1,110 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+A two stage pipeline for process_map: the main thread parses, shapes and
+validates elements and hands them in batches through a bounded queue to a
+writer thread, so disk writes overlap with parsing. When the writer falls
+behind the queue fills up and the parser blocks, which keeps memory bounded.
+
+run() returns the seconds spent in each stage. "put_wait" is time the parser
+spent blocked on a full queue (the writer is the bottleneck) and
+"writer_idle" time the writer spent waiting for work (the parser is).
+"""
+import threading
+import time
+from Queue import Queue
+
+QUEUE_SIZE = 16
+BATCH_SIZE = 1000
+
+_DONE = object()
+
+
+class StageTimer(object):
+    """Accumulated wall time per stage"""
+
+    def __init__(self):
+        self.seconds = {}
+
+    def add(self, stage, seconds):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def report(self):
+        return dict(self.seconds)
+
+
+class _Writer(threading.Thread):
+
+    def __init__(self, queue, write, timer):
+        threading.Thread.__init__(self, name='osm-writer')
+        self.daemon = True
+        self.queue = queue
+        self.write = write
+        self.timer = timer
+        self.error = None
+
+    def run(self):
+        clock = time.time
+        while True:
+            start = clock()
+            batch = self.queue.get()
+            self.timer.add('writer_idle', clock() - start)
+            if batch is _DONE:
+                return
+            if self.error is not None:
+                continue  # keep draining so the parser never blocks forever
+            start = clock()
+            try:
+                for shaped in batch:
+                    self.write(shaped)
+            except Exception as e:
+                self.error = e
+            self.timer.add('write', clock() - start)
+
+
+def run(elements, shape, validate, write, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE):
+    """Shape (and validate, unless validate is None) each element on the
+    calling thread and write() it on a writer thread. Returns
+    {stage: seconds}."""
+    timer = StageTimer()
+    queue = Queue(queue_size)
+    writer = _Writer(queue, write, timer)
+    writer.start()
+    clock = time.time
+    batch = []
+    elements = iter(elements)
+    started = clock()
+    try:
+        while True:
+            start = clock()
+            try:
+                element = next(elements)
+            except StopIteration:
+                timer.add('parse', clock() - start)
+                break
+            shaped_at = clock()
+            shaped = shape(element)
+            validated_at = clock()
+            if shaped and validate is not None:
+                validate(shaped)
+            done = clock()
+            timer.add('parse', shaped_at - start)
+            timer.add('shape', validated_at - shaped_at)
+            timer.add('validate', done - validated_at)
+            if shaped:
+                batch.append(shaped)
+            if len(batch) >= batch_size:
+                if writer.error is not None:
+                    break
+                queue.put(batch)
+                timer.add('put_wait', clock() - done)
+                batch = []
+        if batch and writer.error is None:
+            queue.put(batch)
+    finally:
+        queue.put(_DONE)
+        writer.join()
+    if writer.error is not None:
+        raise writer.error
+    timer.add('total', clock() - started)
+    return timer.report()
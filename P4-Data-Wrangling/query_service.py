@@ -0,0 +1,419 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+A local read-only query service over the imported database, so that
+notebooks and analysts share a pool of connections instead of each opening
+their own.
+
+    python query_service.py --db san_jose_california.db --readers 4 --port 8642
+
+    GET  /queries                         the named queries and their parameters
+    GET  /query/tag_values?key=cuisine    a named query
+    POST /sql  {"sql": "SELECT ...", "params": [...]}
+
+Answers are JSON, {"columns": [...], "rows": [...], "ms": ...}.
+
+Requests are handled on threads (ThreadingMixIn) and run on one of the
+pooled connections; the sqlite3 module lets go of the GIL while SQLite
+works, so the readers run in parallel. The connections are opened with
+PRAGMA query_only and an authorizer that lets through reads and reading
+pragmas only (so /sql cannot turn query_only off again, write, ATTACH or
+begin a transaction), and the database is switched to WAL mode, in which
+readers never wait for a writer: apply_changes or a reload can run while
+the service answers from the last committed state. Every connection keeps
+its compiled statements (cached_statements), and named queries always use
+the same SQL text, so they are parsed once per connection.
+
+QueryService can also be used in process, without HTTP.
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib2
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from contextlib import contextmanager
+from Queue import Empty, Queue
+from SocketServer import ThreadingMixIn
+
+import spatial
+
+DB_PATH = "san_jose_california.db"
+READERS = 4
+POOL_TIMEOUT = 10.0
+STATEMENT_CACHE_SIZE = 256
+MAX_ROWS = 10000
+HOST = '127.0.0.1'
+PORT = 8642
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+def enable_wal(db_path):
+    """Put db_path in WAL mode (it stays so) and return the journal mode"""
+    con = sqlite3.connect(db_path)
+    try:
+        return con.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+    finally:
+        con.close()
+
+
+# authorizer action codes the sqlite3 module of Python 2 does not name
+SQLITE_FUNCTION = 31
+SQLITE_RECURSIVE = 33
+
+READ_ACTIONS = frozenset([sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, SQLITE_FUNCTION,
+                          SQLITE_RECURSIVE])
+
+# pragmas that only read; the ones in ARGUMENT_PRAGMAS take the name of a
+# table or index, all others must be given no value
+READ_PRAGMAS = frozenset(['table_info', 'table_xinfo', 'index_list', 'index_info',
+                          'index_xinfo', 'foreign_key_list', 'database_list', 'table_list',
+                          'collation_list', 'function_list', 'pragma_list', 'compile_options',
+                          'data_version', 'schema_version', 'user_version', 'encoding',
+                          'journal_mode', 'page_count', 'page_size', 'freelist_count',
+                          'query_only'])
+ARGUMENT_PRAGMAS = frozenset(['table_info', 'table_xinfo', 'index_list', 'index_info',
+                              'index_xinfo', 'foreign_key_list'])
+
+# the R-tree module prepares writes to its shadow tables (and sqlite_master)
+# whenever it opens nodes_rtree or ways_rtree, even for a read; they are let
+# through here and query_only refuses them should one ever run
+RTREE_INTERNALS = frozenset(['sqlite_master'] + ['%s_%s' % (table, shadow)
+                                                 for table in ('nodes_rtree', 'ways_rtree')
+                                                 for shadow in ('node', 'rowid', 'parent')])
+RTREE_ACTIONS = frozenset([sqlite3.SQLITE_INSERT, sqlite3.SQLITE_UPDATE, sqlite3.SQLITE_DELETE])
+
+
+def _authorize(action, arg1, arg2, database, trigger):
+    """sqlite3 authorizer letting through reads and nothing else: no writes,
+    schema changes, ATTACH, transactions or pragmas that set something (such
+    as query_only = 0)"""
+    if action in READ_ACTIONS:
+        return sqlite3.SQLITE_OK
+    if action == sqlite3.SQLITE_PRAGMA:
+        name = arg1.lower()
+        if name in READ_PRAGMAS and (arg2 is None or name in ARGUMENT_PRAGMAS):
+            return sqlite3.SQLITE_OK
+    if action in RTREE_ACTIONS and arg1 in RTREE_INTERNALS:
+        return sqlite3.SQLITE_OK
+    return sqlite3.SQLITE_DENY
+
+
+def connect_read_only(db_path, cached_statements=STATEMENT_CACHE_SIZE):
+    con = sqlite3.connect(db_path, check_same_thread=False, cached_statements=cached_statements)
+    con.execute("PRAGMA query_only = ON")
+    con.execute("PRAGMA mmap_size = 268435456")
+    # query_only alone can be switched off again by the next statement
+    con.set_authorizer(_authorize)
+    return con
+
+
+class ConnectionPool(object):
+    """A fixed set of read-only connections shared by threads"""
+
+    def __init__(self, db_path=DB_PATH, size=READERS, timeout=POOL_TIMEOUT):
+        self.timeout = timeout
+        self._idle = Queue()
+        self._all = [connect_read_only(db_path) for _ in xrange(size)]
+        for con in self._all:
+            self._idle.put(con)
+
+    @contextmanager
+    def connection(self):
+        try:
+            con = self._idle.get(timeout=self.timeout)
+        except Empty:
+            raise PoolTimeout("no connection free after %.0fs" % self.timeout)
+        try:
+            yield con
+        finally:
+            self._idle.put(con)
+
+    def close(self):
+        for con in self._all:
+            con.close()
+
+
+# ================================================== #
+#               Named queries                        #
+# ================================================== #
+def _sql(statement):
+    def run(con, *args):
+        return con.execute(statement, args)
+    return run
+
+
+# name -> (function(con, *args), [(parameter, type, default)]); a default
+# of None makes the parameter required
+QUERIES = {
+    'element_counts': (_sql("SELECT element, count FROM element_counts"), []),
+    'top_users': (_sql("SELECT user, nodes + ways AS edits, nodes, ways FROM user_counts "
+                       "ORDER BY edits DESC, uid LIMIT ?"),
+                  [('limit', int, 10)]),
+    'tag_values': (_sql("SELECT value, SUM(count) AS count FROM tag_counts WHERE key = ? "
+                        "GROUP BY value ORDER BY count DESC, value LIMIT ?"),
+                   [('key', unicode, None), ('limit', int, -1)]),
+    'top_keys': (_sql("SELECT key, SUM(count) AS count FROM tag_counts GROUP BY key "
+                      "ORDER BY count DESC, key LIMIT ?"),
+                 [('limit', int, 20)]),
+    'node': (_sql("SELECT * FROM nodes WHERE id = ?"), [('id', int, None)]),
+    'node_tags': (_sql("SELECT key, value, type FROM nodes_tags WHERE id = ?"),
+                  [('id', int, None)]),
+    'way': (_sql("SELECT * FROM ways WHERE id = ?"), [('id', int, None)]),
+    'way_tags': (_sql("SELECT key, value, type FROM ways_tags WHERE id = ?"),
+                 [('id', int, None)]),
+    'way_nodes': (_sql("SELECT node_id FROM ways_nodes WHERE id = ? ORDER BY position"),
+                  [('id', int, None)]),
+    'nodes_in_bbox': (spatial.bbox, [('min_lat', float, None), ('min_lon', float, None),
+                                     ('max_lat', float, None), ('max_lon', float, None)]),
+}
+
+
+def _arguments(spec, params):
+    args = []
+    for name, kind, default in spec:
+        value = params.get(name)
+        if value is None:
+            if default is None:
+                raise ValueError("missing parameter %r" % name)
+            value = default
+        try:
+            args.append(kind(value))
+        except (TypeError, ValueError):
+            raise ValueError("parameter %r must be %s" % (name, kind.__name__))
+    return args
+
+
+def _result(rows, started, columns=None):
+    rows = list(rows)
+    truncated = len(rows) > MAX_ROWS
+    return {'columns': columns, 'rows': rows[:MAX_ROWS], 'truncated': truncated,
+            'ms': round((time.time() - started) * 1000, 2)}
+
+
+def _fetch(cursor, started):
+    # the cursor is closed before its connection goes back to the pool: a
+    # truncated result would otherwise leave the statement running, holding a
+    # read snapshot that keeps WAL checkpoints from finishing
+    try:
+        columns = [d[0] for d in cursor.description] if cursor.description else []
+        rows = cursor.fetchmany(MAX_ROWS + 1)
+    finally:
+        cursor.close()
+    return _result(rows, started, columns)
+
+
+class QueryService(object):
+    """Named and ad hoc read-only queries on a connection pool"""
+
+    def __init__(self, db_path=DB_PATH, readers=READERS, queries=QUERIES, wal=True):
+        if wal:
+            enable_wal(db_path)
+        self.pool = ConnectionPool(db_path, readers)
+        self.queries = queries
+
+    def describe(self):
+        return dict((name, [parameter for parameter, _, _ in spec])
+                    for name, (_, spec) in sorted(self.queries.iteritems()))
+
+    def query(self, name, **params):
+        """Run a named query; parameters are converted to their types"""
+        if name not in self.queries:
+            raise KeyError(name)
+        function, spec = self.queries[name]
+        args = _arguments(spec, params)
+        started = time.time()
+        with self.pool.connection() as con:
+            cursor = function(con, *args)
+            if not isinstance(cursor, sqlite3.Cursor):
+                return _result(cursor[:MAX_ROWS + 1], started)
+            return _fetch(cursor, started)
+
+    def sql(self, statement, params=()):
+        """Run one SELECT (or other read-only) statement"""
+        started = time.time()
+        with self.pool.connection() as con:
+            return _fetch(con.execute(statement, params), started)
+
+    def close(self):
+        self.pool.close()
+
+
+# ================================================== #
+#               HTTP                                 #
+# ================================================== #
+class QueryHandler(BaseHTTPRequestHandler):
+
+    def _send(self, status, body):
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _answer(self, run):
+        try:
+            self._send(200, run())
+        except KeyError as e:
+            self._send(404, {'error': "no query %s" % e})
+        except (ValueError, sqlite3.Error, sqlite3.Warning) as e:
+            # sqlite3.Warning: more than one statement
+            self._send(400, {'error': str(e)})
+        except PoolTimeout as e:
+            self._send(503, {'error': str(e)})
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        service = self.server.service
+        if url.path == '/queries':
+            self._send(200, service.describe())
+        elif url.path.startswith('/query/'):
+            params = dict((k, v.decode('utf-8')) for k, v in urlparse.parse_qsl(url.query))
+            self._answer(lambda: service.query(url.path[len('/query/'):], **params))
+        else:
+            self._send(404, {'error': "unknown path %s" % url.path})
+
+    def do_POST(self):
+        if self.path != '/sql':
+            self._send(404, {'error': "unknown path %s" % self.path})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.getheader('content-length', 0))))
+            statement, params = body['sql'], body.get('params', [])
+        except (ValueError, KeyError, TypeError):
+            self._send(400, {'error': 'expected {"sql": ..., "params": [...]}'})
+            return
+        self._answer(lambda: self.server.service.sql(statement, params))
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class QueryServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, service, address=(HOST, PORT), verbose=False):
+        HTTPServer.__init__(self, address, QueryHandler)
+        self.service = service
+        self.verbose = verbose
+
+
+def serve(db_path=DB_PATH, host=HOST, port=PORT, readers=READERS, verbose=True):
+    service = QueryService(db_path, readers)
+    server = QueryServer(service, (host, port), verbose)
+    print "serving %s on http://%s:%d with %d readers" % (db_path, host, server.server_port, readers)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        service.close()
+
+
+def start_in_background(service, host=HOST, port=0):
+    """A QueryServer for service on a daemon thread; port 0 picks a free
+    port (server.server_port)"""
+    server = QueryServer(service, (host, port))
+    thread = threading.Thread(target=server.serve_forever, name='query-service')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def test():
+    """Serve a generated database over HTTP: named and ad hoc queries, the
+    400s for writes and for switching query_only off, and a WAL checkpoint
+    that is not held up by a truncated result"""
+    import benchmark
+    import data_transform
+    global MAX_ROWS
+    directory = tempfile.mkdtemp(prefix='query_service_test_')
+    max_rows = MAX_ROWS
+    try:
+        osm_path = os.path.join(directory, 'test.osm')
+        db_path = os.path.join(directory, 'test.db')
+        counts = benchmark.generate(osm_path, 0.3, seed=3)
+        data_transform.process_map(osm_path, validate=True, sink='sqlite', db_path=db_path)
+        # a named query that holds on to its cursor, as a caller might
+        kept = []
+
+        def all_nodes(con):
+            kept.append(con.execute("SELECT id FROM nodes"))
+            return kept[-1]
+
+        service = QueryService(db_path, readers=1, queries=dict(QUERIES, all_nodes=(all_nodes, [])))
+        server = start_in_background(service)
+        url = 'http://%s:%d' % (HOST, server.server_port)
+
+        def request(path, body=None):
+            try:
+                response = urllib2.urlopen(url + path, body and json.dumps(body))
+                return response.getcode(), json.load(response)
+            except urllib2.HTTPError as e:
+                return e.code, json.load(e)
+
+        status, answer = request('/query/element_counts')
+        assert status == 200 and dict(answer['rows']) == {'node': counts['nodes'],
+                                                          'way': counts['ways']}, answer
+        status, answer = request('/query/tag_values?key=amenity&limit=3')
+        assert status == 200 and len(answer['rows']) == 3, answer
+        status, answer = request('/query/nodes_in_bbox?min_lat=%s&min_lon=%s&max_lat=%s&max_lon=%s'
+                                 % (benchmark.MIN_LAT, benchmark.MIN_LON,
+                                    benchmark.MAX_LAT, benchmark.MAX_LON))
+        assert status == 200 and len(answer['rows']) == counts['nodes'], (status, answer)
+        assert request('/query/node?id=x')[0] == 400
+        assert request('/query/nothing')[0] == 404
+        status, answer = request('/sql', {'sql': "SELECT COUNT(*) FROM nodes WHERE id > ?",
+                                          'params': [0]})
+        assert status == 200 and answer['rows'] == [[counts['nodes']]], answer
+        assert request('/sql', {'sql': "PRAGMA table_info(nodes)"})[0] == 200
+        for statement in ("PRAGMA query_only = 0", "DELETE FROM tag_counts",
+                          "ATTACH DATABASE ':memory:' AS other", "BEGIN",
+                          "DELETE FROM nodes_rtree_node",
+                          "SELECT 1; DELETE FROM nodes"):
+            status, answer = request('/sql', {'sql': statement})
+            assert status == 400, (statement, status, answer)
+        # still read-only, and nothing was deleted
+        assert request('/sql', {'sql': "DELETE FROM tag_counts"})[0] == 400
+        assert service.sql("SELECT COUNT(*) FROM tag_counts")['rows'][0][0] > 0
+
+        # the one pooled connection goes back with no statement running, even
+        # with a truncated result whose cursor lives on, so a writer's
+        # checkpoint goes all the way through
+        MAX_ROWS = 10
+        status, answer = request('/query/all_nodes')
+        assert status == 200 and answer['truncated'] and len(answer['rows']) == 10, answer
+        assert kept
+        writer = sqlite3.connect(db_path, timeout=1)
+        writer.execute("UPDATE nodes SET version = version + 1")
+        writer.commit()
+        busy, frames, copied = writer.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+        assert busy == 0 and frames > 0 and copied == frames, (busy, frames, copied)
+        writer.close()
+        server.shutdown()
+        server.server_close()
+        service.close()
+        print "query_service: %d nodes served read-only" % counts['nodes']
+    finally:
+        MAX_ROWS = max_rows
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Read-only query service over the OSM database")
+    parser.add_argument('--db', default=DB_PATH)
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--readers', type=int, default=READERS)
+    args = parser.parse_args()
+    serve(args.db, args.host, args.port, args.readers)
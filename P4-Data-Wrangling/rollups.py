@@ -0,0 +1,264 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Materialized counts behind the analysis of project.ipynb, and a cached
+Python API to read them.
+
+Every figure the notebook reports is a full scan of the imported tables:
+COUNT(*) on nodes and ways, distinct uids, and value counts over
+nodes_tags UNION ALL ways_tags for city, cuisine and amenity. Three small
+tables hold them instead:
+
+  element_counts (element, count)
+  user_counts    (uid, user, nodes, ways)
+  tag_counts     (element, key, type, value, count)
+
+They are built by osm_sqlite.finish_import after a load and kept current by
+apply_changes, which subtracts an element's old rows before changing it and
+adds the new ones after. City counts are tag_counts for the 'city' key
+merged by normalize_city, so 'san jose' and 'San Jose, CA' count together.
+
+    stats = rollups.Rollups(DB_PATH)
+    stats.element_counts()        # {'node': 60000, 'way': 12000}
+    stats.tag_values('cuisine')   # [(value, count)], most frequent first
+    stats.cities()
+
+Results are cached per Rollups object until the database changes (checked
+with PRAGMA data_version and the connection's total_changes on every call,
+so writes through another connection or through con itself both count) or
+refresh() is called.
+"""
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+
+DB_PATH = "san_jose_california.db"
+
+ROLLUP_TABLES = ["CREATE TABLE IF NOT EXISTS element_counts ("
+                 "element TEXT PRIMARY KEY NOT NULL, count INTEGER NOT NULL)",
+                 "CREATE TABLE IF NOT EXISTS user_counts ("
+                 "uid INTEGER PRIMARY KEY, user TEXT, "
+                 "nodes INTEGER NOT NULL, ways INTEGER NOT NULL)",
+                 "CREATE TABLE IF NOT EXISTS tag_counts ("
+                 "element TEXT NOT NULL, key TEXT NOT NULL, type TEXT NOT NULL, "
+                 "value TEXT NOT NULL, count INTEGER NOT NULL, "
+                 "PRIMARY KEY (element, key, type, value))",
+                 "CREATE INDEX IF NOT EXISTS tag_counts_key ON tag_counts (key, count)"]
+
+# element -> (element table, tag table)
+TABLES = {'node': ('nodes', 'nodes_tags'),
+          'way': ('ways', 'ways_tags')}
+
+CITY_KEY = 'city'
+_STATE_SUFFIX = re.compile(r'\s*,?\s*\b(CA|California)\.?$', re.IGNORECASE)
+
+
+def normalize_city(name):
+    """'san jose', 'SAN JOSE' and 'San Jose, CA' all become 'San Jose'"""
+    name = _STATE_SUFFIX.sub('', ' '.join(name.split()))
+    return ' '.join(word[:1].upper() + word[1:].lower() for word in name.split(' '))
+
+
+def build_rollups(con):
+    """(Re)build the rollup tables from the element and tag tables"""
+    for statement in ROLLUP_TABLES:
+        con.execute(statement)
+    for table in ('element_counts', 'user_counts', 'tag_counts'):
+        con.execute("DELETE FROM %s" % table)
+    for element, (table, tags) in sorted(TABLES.iteritems()):
+        con.execute("INSERT INTO element_counts SELECT ?, COUNT(*) FROM %s" % table, (element,))
+        con.execute("INSERT INTO tag_counts SELECT ?, key, IFNULL(type, ''), IFNULL(value, ''), "
+                    "COUNT(*) FROM %s GROUP BY 2, 3, 4" % tags, (element,))
+    con.execute("INSERT INTO user_counts SELECT uid, MAX(user), SUM(node), SUM(way) FROM "
+                "(SELECT uid, user, 1 AS node, 0 AS way FROM nodes "
+                "UNION ALL SELECT uid, user, 0, 1 FROM ways) GROUP BY uid")
+
+
+def has_rollups(con):
+    return con.execute("SELECT 1 FROM sqlite_master WHERE name = 'tag_counts'").fetchone() is not None
+
+
+# ================================================== #
+#               Incremental updates                  #
+# ================================================== #
+def _adjust(con, element_type, element_id, sign):
+    table, tags = TABLES[element_type]
+    row = con.execute("SELECT uid, user FROM %s WHERE id = ?" % table, (element_id,)).fetchone()
+    if row is None:
+        return
+    uid, user = row
+    con.execute("UPDATE element_counts SET count = count + ? WHERE element = ?",
+                (sign, element_type))
+    con.execute("INSERT OR IGNORE INTO user_counts VALUES (?, ?, 0, 0)", (uid, user))
+    con.execute("UPDATE user_counts SET %ss = %ss + ? WHERE uid = ?" % (element_type, element_type),
+                (sign, uid))
+    if sign > 0:
+        # the same name build_rollups picks, MAX(user)
+        con.execute("UPDATE user_counts SET user = MAX(IFNULL(user, ''), ?) WHERE uid = ?",
+                    (user, uid))
+    else:
+        con.execute("DELETE FROM user_counts WHERE uid = ? AND nodes <= 0 AND ways <= 0", (uid,))
+    for key, tag_type, value in con.execute(
+            "SELECT key, IFNULL(type, ''), IFNULL(value, '') FROM %s WHERE id = ?" % tags,
+            (element_id,)).fetchall():
+        where = (element_type, key, tag_type, value)
+        con.execute("INSERT OR IGNORE INTO tag_counts VALUES (?, ?, ?, ?, 0)", where)
+        con.execute("UPDATE tag_counts SET count = count + ? WHERE element = ? AND key = ? "
+                    "AND type = ? AND value = ?", (sign,) + where)
+        if sign < 0:
+            con.execute("DELETE FROM tag_counts WHERE element = ? AND key = ? AND type = ? "
+                        "AND value = ? AND count <= 0", where)
+
+
+def add_element(con, element_type, element_id):
+    """Count a stored element, its user and its tags"""
+    _adjust(con, element_type, element_id, 1)
+
+
+def remove_element(con, element_type, element_id):
+    """Uncount a stored element before it is changed or deleted"""
+    _adjust(con, element_type, element_id, -1)
+
+
+# ================================================== #
+#               Cached queries                       #
+# ================================================== #
+def _cached(method):
+    def cached(self, *args, **kwargs):
+        self._check_version()
+        key = (method.__name__, args, tuple(sorted(kwargs.iteritems())))
+        try:
+            return self._cache[key]
+        except KeyError:
+            result = self._cache[key] = method(self, *args, **kwargs)
+            return result
+    cached.__name__ = method.__name__
+    cached.__doc__ = method.__doc__
+    return cached
+
+
+class Rollups(object):
+    """Read the rollup tables of db_path, building them if they are missing.
+    Results are shared: do not modify the returned lists and dicts."""
+
+    def __init__(self, db_path=DB_PATH, con=None):
+        self.con = con if con is not None else sqlite3.connect(db_path, check_same_thread=False)
+        if not has_rollups(self.con):
+            with self.con:
+                build_rollups(self.con)
+        self._cache = {}
+        self._version = None
+
+    def _check_version(self):
+        # data_version changes whenever another connection commits, and
+        # total_changes when con itself writes (say, shared with a ChangeApplier)
+        version = (self.con.execute("PRAGMA data_version").fetchone()[0],
+                   self.con.total_changes)
+        if version != self._version:
+            self._cache.clear()
+            self._version = version
+
+    def refresh(self, rebuild=False):
+        """Drop cached results; rebuild=True also recounts from the tables"""
+        if rebuild:
+            with self.con:
+                build_rollups(self.con)
+        self._cache.clear()
+
+    def close(self):
+        self.con.close()
+
+    @_cached
+    def element_counts(self):
+        """{'node': n, 'way': n}"""
+        return dict(self.con.execute("SELECT element, count FROM element_counts"))
+
+    @_cached
+    def distinct_users(self):
+        return self.con.execute("SELECT COUNT(*) FROM user_counts").fetchone()[0]
+
+    @_cached
+    def top_users(self, limit=10):
+        """[(user, nodes + ways, nodes, ways)] of the most active users"""
+        return self.con.execute("SELECT user, nodes + ways AS edits, nodes, ways FROM user_counts "
+                                "ORDER BY edits DESC, uid LIMIT ?", (limit,)).fetchall()
+
+    @_cached
+    def tag_values(self, key, element=None, limit=None):
+        """[(value, count)] for a tag key ('cuisine', 'amenity', ...) over
+        nodes and ways, or only element ('node' or 'way')"""
+        where, params = "key = ?", [key]
+        if element is not None:
+            where += " AND element = ?"
+            params.append(element)
+        params.append(-1 if limit is None else limit)
+        return self.con.execute("SELECT value, SUM(count) AS total FROM tag_counts WHERE %s "
+                                "GROUP BY value ORDER BY total DESC, value LIMIT ?" % where,
+                                params).fetchall()
+
+    @_cached
+    def value_count(self, value, element='node'):
+        """Tags with value, whatever their key (e.g. 'school')"""
+        return self.con.execute("SELECT IFNULL(SUM(count), 0) FROM tag_counts "
+                                "WHERE value = ? AND element = ?", (value, element)).fetchone()[0]
+
+    @_cached
+    def top_keys(self, limit=20):
+        """[(key, count)] of the most used tag keys"""
+        return self.con.execute("SELECT key, SUM(count) AS total FROM tag_counts GROUP BY key "
+                                "ORDER BY total DESC, key LIMIT ?", (limit,)).fetchall()
+
+    @_cached
+    def cities(self):
+        """[(city, count)] after normalize_city, most frequent first"""
+        counts = {}
+        for value, count in self.tag_values(CITY_KEY):
+            city = normalize_city(value)
+            counts[city] = counts.get(city, 0) + count
+        return sorted(counts.iteritems(), key=lambda item: (-item[1], item[0]))
+
+
+def _dump(con):
+    return [sorted(con.execute("SELECT * FROM %s" % table))
+            for table in ('element_counts', 'user_counts', 'tag_counts')]
+
+
+def test():
+    """Apply an osmChange to a generated database in both tag layouts and
+    check the incrementally updated counts against build_rollups"""
+    import apply_changes
+    import benchmark
+    import data_transform
+    directory = tempfile.mkdtemp(prefix='rollups_test_')
+    try:
+        osm_path = os.path.join(directory, 'test.osm')
+        osc_path = os.path.join(directory, 'test.osc')
+        benchmark.generate(osm_path, 0.3, seed=5)
+        for encode_tags in (False, True):
+            db_path = os.path.join(directory, 'test%d.db' % encode_tags)
+            data_transform.process_map(osm_path, validate=True, sink='sqlite', db_path=db_path,
+                                       encode_tags=encode_tags)
+            con = sqlite3.connect(db_path)
+            stats = Rollups(con=con)
+            before = stats.element_counts()
+            changed = benchmark.generate_changes(osc_path, con)
+            apply_changes.apply_changes(osc_path, db_path)
+            after = _dump(con)
+            build_rollups(con)
+            assert _dump(con) == after, encode_tags
+            assert stats.element_counts() == {'node': before['node'], 'way': before['way'] - 1}
+            assert con.execute("SELECT nodes, ways FROM user_counts WHERE user = 'change_tester'"
+                               ).fetchone() == (2, 1)
+            assert stats.tag_values('flavour') == [(u'a value not seen before', 1)]
+            assert con.execute("SELECT COUNT(*) FROM ways WHERE id = ?",
+                               (changed['deleted_way'],)).fetchone()[0] == 0
+            con.close()
+        print "rollups: incremental counts match a rebuild in both tag layouts"
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    test()
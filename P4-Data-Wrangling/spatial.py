@@ -0,0 +1,122 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+R-tree indexes over the imported nodes and ways, and bounding box, radius
+and nearest-k queries on top of them.
+
+nodes_rtree holds one point box per node; ways_rtree holds the bounding box
+of each way computed from its nodes in ways_nodes. Both are built by
+osm_sqlite.finish_import after a load and kept current by apply_changes.
+Distances are in metres.
+"""
+import math
+
+EARTH_RADIUS = 6371008.8
+
+RTREE_TABLES = ["CREATE VIRTUAL TABLE IF NOT EXISTS nodes_rtree "
+                "USING rtree(id, min_lat, max_lat, min_lon, max_lon)",
+                "CREATE VIRTUAL TABLE IF NOT EXISTS ways_rtree "
+                "USING rtree(id, min_lat, max_lat, min_lon, max_lon)"]
+
+# nodes whose coordinates were loaded unvalidated as text are left out
+WAY_BOXES = """SELECT wn.id, MIN(n.lat), MAX(n.lat), MIN(n.lon), MAX(n.lon)
+               FROM ways_nodes wn JOIN nodes n ON n.id = wn.node_id
+               AND typeof(n.lat) = 'real' AND typeof(n.lon) = 'real'
+               %s GROUP BY wn.id"""
+
+
+def build_spatial_index(con):
+    """(Re)build nodes_rtree and ways_rtree from the nodes and ways_nodes tables"""
+    for statement in RTREE_TABLES:
+        con.execute(statement)
+    con.execute("DELETE FROM nodes_rtree")
+    con.execute("DELETE FROM ways_rtree")
+    con.execute("INSERT INTO nodes_rtree SELECT id, lat, lat, lon, lon FROM nodes "
+                "WHERE typeof(lat) = 'real' AND typeof(lon) = 'real'")
+    con.execute("INSERT INTO ways_rtree " + WAY_BOXES % "")
+
+
+def has_spatial_index(con):
+    return con.execute("SELECT 1 FROM sqlite_master WHERE name = 'nodes_rtree'").fetchone() is not None
+
+
+# ================================================== #
+#               Incremental updates                  #
+# ================================================== #
+def update_node(con, node_id):
+    """Refresh the box of a node and of every way that uses it"""
+    con.execute("DELETE FROM nodes_rtree WHERE id = ?", (node_id,))
+    con.execute("INSERT INTO nodes_rtree SELECT id, lat, lat, lon, lon FROM nodes "
+                "WHERE id = ? AND typeof(lat) = 'real' AND typeof(lon) = 'real'", (node_id,))
+    way_ids = [row[0] for row in
+               con.execute("SELECT DISTINCT id FROM ways_nodes WHERE node_id = ?", (node_id,))]
+    for way_id in way_ids:
+        update_way(con, way_id)
+
+
+def update_way(con, way_id):
+    con.execute("DELETE FROM ways_rtree WHERE id = ?", (way_id,))
+    con.execute("INSERT INTO ways_rtree " + WAY_BOXES % "WHERE wn.id = ?", (way_id,))
+
+
+def delete_element(con, element_type, element_id):
+    table = 'nodes_rtree' if element_type == 'node' else 'ways_rtree'
+    con.execute("DELETE FROM %s WHERE id = ?" % table, (element_id,))
+
+
+# ================================================== #
+#               Queries                              #
+# ================================================== #
+def distance(lat1, lon1, lat2, lon2):
+    """Great circle distance in metres (haversine)"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def radius_box(lat, lon, meters):
+    """(min_lat, min_lon, max_lat, max_lon) enclosing the circle"""
+    dlat = math.degrees(meters / EARTH_RADIUS)
+    cos_lat = math.cos(math.radians(lat))
+    dlon = 180.0 if cos_lat < 1e-9 else min(180.0, math.degrees(meters / (EARTH_RADIUS * cos_lat)))
+    return lat - dlat, lon - dlon, lat + dlat, lon + dlon
+
+
+def bbox(con, min_lat, min_lon, max_lat, max_lon, element='node'):
+    """Nodes as (id, lat, lon) inside the box, or ids of ways whose bounding
+    box intersects it"""
+    if element == 'way':
+        return [row[0] for row in con.execute(
+            "SELECT id FROM ways_rtree WHERE max_lat >= ? AND min_lat <= ? "
+            "AND max_lon >= ? AND min_lon <= ?", (min_lat, max_lat, min_lon, max_lon))]
+    # the rtree stores 32 bit floats, so the exact coordinates are re-checked
+    return con.execute(
+        "SELECT n.id, n.lat, n.lon FROM nodes_rtree r JOIN nodes n ON n.id = r.id "
+        "WHERE r.max_lat >= ? AND r.min_lat <= ? AND r.max_lon >= ? AND r.min_lon <= ? "
+        "AND n.lat BETWEEN ? AND ? AND n.lon BETWEEN ? AND ?",
+        (min_lat, max_lat, min_lon, max_lon, min_lat, max_lat, min_lon, max_lon)).fetchall()
+
+
+def radius(con, lat, lon, meters):
+    """Nodes within meters of (lat, lon) as (distance, id, lat, lon), nearest first"""
+    found = []
+    for node_id, node_lat, node_lon in bbox(con, *radius_box(lat, lon, meters)):
+        d = distance(lat, lon, node_lat, node_lon)
+        if d <= meters:
+            found.append((d, node_id, node_lat, node_lon))
+    found.sort()
+    return found
+
+
+def nearest(con, lat, lon, k=1, start_radius=100.0):
+    """The k nodes nearest to (lat, lon) as (distance, id, lat, lon).
+    Searches a growing circle until it holds k nodes or covers the globe."""
+    meters = start_radius
+    while True:
+        found = radius(con, lat, lon, meters)
+        if len(found) >= k or meters > math.pi * EARTH_RADIUS:
+            return found[:k]
+        meters *= 4
+
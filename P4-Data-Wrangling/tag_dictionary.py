@@ -0,0 +1,264 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+An optional dictionary-encoded layout for the tag tables.
+
+nodes_tags and ways_tags repeat a few thousand keys and a small set of
+common values ('amenity' = 'restaurant', 'building' = 'yes') hundreds of
+thousands of times. With process_map(..., encode_tags=True) every
+distinct (key, type) and value is given an integer id while the file is
+processed and the tags are stored as ids:
+
+    tag_keys (id, key, type)              tag_values (id, value)
+    nodes_tag_ids (id, key_id, value_id)  ways_tag_ids (id, key_id, value_id)
+
+nodes_tags and ways_tags become views with the usual columns, so the
+queries of project.ipynb still run, and INSTEAD OF triggers on the views
+intern new keys and values, so apply_changes.py works unchanged.
+value_counts() groups on the ids and only looks up the text of the values
+it returns.
+
+The dictionary is kept in memory during the run, which is fine for the
+keys and for the values of a city or region. Ids are handed out in the
+order the tags are met, so the layout needs a serial run.
+"""
+import csv
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import compressed_io
+import osm_sqlite
+
+TAG_KEYS_PATH = "tag_keys.csv"
+TAG_VALUES_PATH = "tag_values.csv"
+NODE_TAG_IDS_PATH = "nodes_tag_ids.csv"
+WAY_TAG_IDS_PATH = "ways_tag_ids.csv"
+
+TAG_KEY_FIELDS = ['id', 'key', 'type']
+TAG_VALUE_FIELDS = ['id', 'value']
+TAG_ID_FIELDS = ['id', 'key_id', 'value_id']
+
+# shape_element output key -> table, as osm_sqlite.ELEMENT_TABLES
+ELEMENT_TABLES = [('node', 'nodes'),
+                  ('node_tags', 'nodes_tag_ids'),
+                  ('way', 'ways'),
+                  ('way_nodes', 'ways_nodes'),
+                  ('way_tags', 'ways_tag_ids')]
+
+# csv file -> table, in load order, as insert_into_database.CSV_TABLES
+CSV_TABLES = [('nodes.csv', 'nodes'),
+              (TAG_KEYS_PATH, 'tag_keys'),
+              (TAG_VALUES_PATH, 'tag_values'),
+              (NODE_TAG_IDS_PATH, 'nodes_tag_ids'),
+              ('ways.csv', 'ways'),
+              ('ways_nodes.csv', 'ways_nodes'),
+              (WAY_TAG_IDS_PATH, 'ways_tag_ids')]
+
+# text view -> id table
+TAG_VIEWS = [('nodes_tags', 'nodes_tag_ids', 'nodes'),
+             ('ways_tags', 'ways_tag_ids', 'ways')]
+
+DICTIONARY_TABLES = [
+    """CREATE TABLE tag_keys (
+    id INTEGER PRIMARY KEY NOT NULL,
+    key TEXT NOT NULL,
+    type TEXT,
+    UNIQUE (key, type)
+)""",
+    """CREATE TABLE tag_values (
+    id INTEGER PRIMARY KEY NOT NULL,
+    value TEXT UNIQUE
+)"""]
+
+TAG_ID_TABLE = """CREATE TABLE %(ids)s (
+    id INTEGER NOT NULL,
+    key_id INTEGER NOT NULL,
+    value_id INTEGER NOT NULL,
+    FOREIGN KEY (id) REFERENCES %(elements)s(id),
+    FOREIGN KEY (key_id) REFERENCES tag_keys(id),
+    FOREIGN KEY (value_id) REFERENCES tag_values(id)
+)"""
+
+TAG_VIEW = """CREATE VIEW %(view)s AS
+    SELECT t.id AS id, k.key AS key, v.value AS value, k.type AS type
+    FROM %(ids)s t JOIN tag_keys k ON k.id = t.key_id JOIN tag_values v ON v.id = t.value_id"""
+
+_KEY_ID = "(SELECT id FROM tag_keys WHERE key = %(row)s.key AND type IS %(row)s.type)"
+_VALUE_ID = "(SELECT id FROM tag_values WHERE value IS %(row)s.value)"
+_INTERN = ("INSERT INTO tag_keys (key, type) SELECT NEW.key, NEW.type WHERE NOT EXISTS "
+           + _KEY_ID % {'row': 'NEW'} + ";\n"
+           "INSERT INTO tag_values (value) SELECT NEW.value WHERE NOT EXISTS "
+           + _VALUE_ID % {'row': 'NEW'} + ";\n"
+           "INSERT INTO %(ids)s (id, key_id, value_id) VALUES (NEW.id, "
+           + _KEY_ID % {'row': 'NEW'} + ", " + _VALUE_ID % {'row': 'NEW'} + ");\n")
+_FORGET = ("DELETE FROM %(ids)s WHERE id = OLD.id AND key_id IN " + _KEY_ID % {'row': 'OLD'}
+           + " AND value_id IN " + _VALUE_ID % {'row': 'OLD'} + ";\n")
+
+TAG_TRIGGERS = ["CREATE TRIGGER %(view)s_insert INSTEAD OF INSERT ON %(view)s BEGIN\n"
+                + _INTERN + "END",
+                "CREATE TRIGGER %(view)s_delete INSTEAD OF DELETE ON %(view)s BEGIN\n"
+                + _FORGET + "END",
+                "CREATE TRIGGER %(view)s_update INSTEAD OF UPDATE ON %(view)s BEGIN\n"
+                + _FORGET + _INTERN + "END"]
+
+INDEXES = osm_sqlite.WAY_NODE_INDEXES + [
+    "CREATE INDEX IF NOT EXISTS nodes_tag_ids_id ON nodes_tag_ids (id)",
+    "CREATE INDEX IF NOT EXISTS nodes_tag_ids_key ON nodes_tag_ids (key_id, value_id)",
+    "CREATE INDEX IF NOT EXISTS ways_tag_ids_id ON ways_tag_ids (id)",
+    "CREATE INDEX IF NOT EXISTS ways_tag_ids_key ON ways_tag_ids (key_id, value_id)"]
+
+
+def create_tables(con):
+    """Replace the nodes_tags and ways_tags tables made by
+    osm_sqlite.create_tables with the dictionary tables and views"""
+    for view, ids, _ in TAG_VIEWS:
+        osm_sqlite.drop(con, view)
+        osm_sqlite.drop(con, ids)
+    for table in ('tag_keys', 'tag_values'):
+        osm_sqlite.drop(con, table)
+    for statement in DICTIONARY_TABLES:
+        con.execute(statement)
+    for view, ids, elements in TAG_VIEWS:
+        names = {'view': view, 'ids': ids, 'elements': elements}
+        con.execute(TAG_ID_TABLE % names)
+        con.execute(TAG_VIEW % names)
+        for trigger in TAG_TRIGGERS:
+            con.execute(trigger % names)
+
+
+def is_dictionary_encoded(con):
+    """True if the tag tables of the database at con are views over ids"""
+    return con.execute("SELECT 1 FROM sqlite_master WHERE type = 'view' AND name = 'nodes_tags'"
+                       ).fetchone() is not None
+
+
+class TagDictionary(object):
+    """Ids for tag keys and values, handed out as they are first seen"""
+
+    element_tables = ELEMENT_TABLES
+    indexes = INDEXES
+
+    def __init__(self):
+        self.key_ids = {}
+        self.value_ids = {}
+        self.keys = []
+        self.values = []
+
+    def key_id(self, key, tag_type):
+        key_id = self.key_ids.get((key, tag_type))
+        if key_id is None:
+            self.keys.append((key, tag_type))
+            key_id = self.key_ids[(key, tag_type)] = len(self.keys)
+        return key_id
+
+    def value_id(self, value):
+        value_id = self.value_ids.get(value)
+        if value_id is None:
+            self.values.append(value)
+            value_id = self.value_ids[value] = len(self.values)
+        return value_id
+
+    def encode(self, tags):
+        """(id, key_id, value_id) for each (id, key, value, type) tag row"""
+        key_ids, value_ids = self.key_ids, self.value_ids
+        encoded = []
+        for element_id, key, value, tag_type in tags:
+            key_id = key_ids.get((key, tag_type)) or self.key_id(key, tag_type)
+            value_id = value_ids.get(value) or self.value_id(value)
+            encoded.append((element_id, key_id, value_id))
+        return encoded
+
+    def encode_rows(self, rows):
+        """shape_element_rows output with its tags encoded; rows itself is
+        left alone, as it may still be waiting to be validated"""
+        tags_key = 'node_tags' if 'node' in rows else 'way_tags'
+        encoded = dict(rows)
+        encoded[tags_key] = self.encode(rows[tags_key])
+        return encoded
+
+    def create_tables(self, con):
+        create_tables(con)
+
+    def insert(self, con):
+        """Insert the keys and values into the tag_keys and tag_values tables"""
+        con.executemany("INSERT INTO tag_keys (id, key, type) VALUES (?, ?, ?)",
+                        ((i, key, tag_type) for i, (key, tag_type) in enumerate(self.keys, 1)))
+        con.executemany("INSERT INTO tag_values (id, value) VALUES (?, ?)",
+                        enumerate(self.values, 1))
+
+    def write_csv(self, keys_path=TAG_KEYS_PATH, values_path=TAG_VALUES_PATH, use_tools=True):
+        """Write tag_keys.csv and tag_values.csv (compressed if the paths end
+        in .gz or .bz2)"""
+        with compressed_io.open_output(keys_path, use_tools) as f:
+            writer = csv.writer(f)
+            writer.writerow(TAG_KEY_FIELDS)
+            writer.writerows((i, key, tag_type) for i, (key, tag_type) in enumerate(self.keys, 1))
+        with compressed_io.open_output(values_path, use_tools) as f:
+            writer = csv.writer(f)
+            writer.writerow(TAG_VALUE_FIELDS)
+            writer.writerows(enumerate(self.values, 1))
+
+
+def value_counts(con, key, tables=('nodes_tag_ids', 'ways_tag_ids')):
+    """[(value, count)] of tag key in tables, most frequent first; the same
+    as GROUP BY value over the text views, but grouped on value ids"""
+    counted = " UNION ALL ".join(
+        "SELECT value_id FROM %s WHERE key_id IN (SELECT id FROM tag_keys WHERE key = ?)" % table
+        for table in tables)
+    return con.execute("SELECT v.value, c.count FROM "
+                       "(SELECT value_id, COUNT(*) AS count FROM (%s) GROUP BY value_id) c "
+                       "JOIN tag_values v ON v.id = c.value_id "
+                       "ORDER BY c.count DESC, v.value" % counted,
+                       (key,) * len(tables)).fetchall()
+
+
+def test():
+    """Load a generated file as text and as ids (csv and load_database), and
+    check the views give the text rows, also after apply_changes"""
+    import apply_changes
+    import benchmark
+    import data_transform
+    import insert_into_database
+    directory = tempfile.mkdtemp(prefix='tag_dictionary_test_')
+    cwd = os.getcwd()
+    # process_map writes its csvs to the working directory
+    os.chdir(directory)
+    try:
+        benchmark.generate('test.osm', 0.3, seed=11)
+        data_transform.process_map('test.osm', validate=True, sink='sqlite', db_path='text.db')
+        data_transform.process_map('test.osm', validate=True, encode_tags=True)
+        insert_into_database.load_database('ids.db', verbose=False, encoded_tags=True)
+        text, ids = sqlite3.connect('text.db'), sqlite3.connect('ids.db')
+        assert is_dictionary_encoded(ids) and not is_dictionary_encoded(text)
+        changed = benchmark.generate_changes('test.osc', text)
+        for step in ('load', 'apply_changes'):
+            for table in ('nodes_tags', 'ways_tags'):
+                query = "SELECT id, key, value, type FROM %s ORDER BY 1, 2, 3, 4" % table
+                expected = text.execute(query).fetchall()
+                assert ids.execute(query).fetchall() == expected, (step, table)
+                assert expected, table
+            assert value_counts(ids, 'amenity') == text.execute(
+                "SELECT value, COUNT(*) FROM (SELECT * FROM nodes_tags UNION ALL "
+                "SELECT * FROM ways_tags) WHERE key = 'amenity' "
+                "GROUP BY value ORDER BY 2 DESC, value").fetchall(), step
+            if step == 'load':
+                for db_path in ('text.db', 'ids.db'):
+                    apply_changes.apply_changes('test.osc', db_path)
+        assert ids.execute("SELECT value FROM nodes_tags WHERE id = ? AND key = 'flavour'",
+                           (changed['node'],)).fetchall() == [(u'a value not seen before',)]
+        assert ids.execute("SELECT COUNT(*) FROM ways_tags WHERE id = ?",
+                           (changed['deleted_way'],)).fetchone()[0] == 0
+        print "tag_dictionary: %d keys, %d values, views match the text tables" % (
+            ids.execute("SELECT COUNT(*) FROM tag_keys").fetchone()[0],
+            ids.execute("SELECT COUNT(*) FROM tag_values").fetchone()[0])
+        text.close()
+        ids.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    test()
@@ -10,15 +10,15 @@ the map as value.
 
 Note that your code will be tested with a different data file than the 'example.osm'
 """
-import xml.etree.cElementTree as ET
 import pprint
+import osm_stream
 
 filename = 'san_jose_california.osm'
 
 def count_tags(filename):
     data = {}
-    for event, element in ET.iterparse(filename):
-        if element.tag in data.keys():
+    for element in osm_stream.iter_all(filename):
+        if element.tag in data:
             data[element.tag] += 1
         else:
             data[element.tag] = 1
@@ -28,4 +28,5 @@ def test():
     tags = count_tags('san_jose_california.osm')
     pprint.pprint(tags)
 
-test()
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Validation that reports instead of raising, for leaving validation on in
+long production runs.
+
+Passing an ErrorCollector as process_map's validate argument (instead of
+True) checks a fraction of the shaped elements, optionally on a pool of
+worker processes, and gathers the errors into a ValidationReport: how many
+elements were checked and failed, how often each field failed (nested
+fields as 'node_tags.*.key') and a few example element ids per field.
+Elements are written whether they pass or not.
+
+    collector = validation.ErrorCollector(fraction=0.1, workers=2)
+    data_transform.process_map(OSM_PATH, validate=collector)
+    print collector.report
+"""
+import multiprocessing
+import random
+
+import fast_validator
+import schema as osm_schema
+
+EXAMPLES = 5
+BATCH_SIZE = 1000
+
+
+def error_paths(errors, path=''):
+    """Yield (field path, message) for each message in a validator.errors
+    dict; list positions become '*'"""
+    if isinstance(errors, dict):
+        for key, value in errors.iteritems():
+            key = '*' if isinstance(key, (int, long)) else key
+            for item in error_paths(value, path + '.' + key if path else key):
+                yield item
+    elif isinstance(errors, list):
+        for value in errors:
+            for item in error_paths(value, path):
+                yield item
+    else:
+        yield path, errors
+
+
+def split_message(message):
+    """(message, detail): the value a coercion failed on is moved to the
+    detail so that equal failures are counted together"""
+    if isinstance(message, basestring) and 'cannot be coerced: ' in message:
+        message, detail = message.split(': ', 1)
+        return message, detail
+    return message, None
+
+
+def element_id(shaped):
+    record = shaped['node'] if 'node' in shaped else shaped['way']
+    if isinstance(record, tuple):
+        return record[0]
+    return record['id'] if isinstance(record, dict) else None
+
+
+class ValidationReport(object):
+    """Error counts and examples per field"""
+
+    def __init__(self, examples=EXAMPLES):
+        self.max_examples = examples
+        self.checked = 0
+        self.failed = 0
+        self.skipped = 0
+        self.fields = {}
+        self.examples = {}
+
+    def add(self, shaped, errors):
+        self.checked += 1
+        if not errors:
+            return
+        self.failed += 1
+        for path, message in error_paths(errors):
+            message, detail = split_message(message)
+            key = (path, message)
+            self.fields[key] = self.fields.get(key, 0) + 1
+            examples = self.examples.setdefault(key, [])
+            if len(examples) < self.max_examples:
+                examples.append((element_id(shaped), detail))
+
+    def merge(self, other):
+        self.checked += other.checked
+        self.failed += other.failed
+        self.skipped += other.skipped
+        for key, count in other.fields.iteritems():
+            self.fields[key] = self.fields.get(key, 0) + count
+            examples = self.examples.setdefault(key, [])
+            examples.extend(other.examples[key][:self.max_examples - len(examples)])
+        return self
+
+    def summary(self):
+        """{'checked': n, 'failed': n, 'skipped': n, 'errors': [(field,
+        message, count, [(element id, detail), ...])] most frequent first}"""
+        errors = sorted(((path, message, count, self.examples[(path, message)])
+                         for (path, message), count in self.fields.iteritems()),
+                        key=lambda error: (-error[2], error[0], error[1]))
+        return {'checked': self.checked, 'failed': self.failed, 'skipped': self.skipped,
+                'errors': errors}
+
+    def __str__(self):
+        lines = ["%d elements checked, %d failed, %d not sampled"
+                 % (self.checked, self.failed, self.skipped)]
+        for path, message, count, examples in self.summary()['errors']:
+            examples = ', '.join('%s (%s)' % example if example[1] else str(example[0])
+                                 for example in examples)
+            lines.append("  %-16s %-36s %8d  e.g. %s" % (path, message, count, examples))
+        return '\n'.join(lines)
+
+
+# ================================================== #
+#               Worker pool                          #
+# ================================================== #
+_worker = {}
+
+
+def _init_worker(schema, row_fields, examples):
+    _worker['validator'] = fast_validator.FastValidator(schema)
+    _worker['schema'] = schema
+    _worker['row_fields'] = row_fields
+    _worker['examples'] = examples
+
+
+def _check(validator, schema, row_fields, shaped, report):
+    record = shaped['node'] if 'node' in shaped else shaped['way']
+    if isinstance(record, tuple):
+        valid = validator.validate_rows(shaped, row_fields, schema)
+    else:
+        valid = validator.validate(shaped, schema)
+    report.add(shaped, None if valid is True else validator.errors)
+
+
+def _check_batch(batch):
+    report = ValidationReport(_worker['examples'])
+    for shaped in batch:
+        _check(_worker['validator'], _worker['schema'], _worker['row_fields'], shaped, report)
+    return report
+
+
+class ErrorCollector(object):
+    """Checks a fraction of the shaped elements it is given and collects the
+    errors in .report. workers > 0 validates batches on a process pool
+    while the caller goes on parsing."""
+
+    def __init__(self, fraction=1.0, workers=0, seed=0, examples=EXAMPLES,
+                 batch_size=BATCH_SIZE, schema=osm_schema.schema):
+        self.fraction = fraction
+        self.workers = workers
+        self.seed = seed
+        self.examples = examples
+        self.batch_size = batch_size
+        self.schema = schema
+        self.report = ValidationReport(examples)
+        self._pool = None
+        self._validator = None
+        self._batch = []
+        self._pending = []
+
+    def __getstate__(self):
+        # a collector is sent to the workers of process_map_parallel; they
+        # open their own copy
+        state = dict(self.__dict__)
+        state.update(_pool=None, _validator=None, _batch=[], _pending=[])
+        return state
+
+    def open(self, row_fields):
+        """Start checking elements; row_fields are the field orders of
+        shape_element_rows output"""
+        self._row_fields = row_fields
+        self._random = random.Random(self.seed)
+        if self.workers > 0:
+            self._pool = multiprocessing.Pool(self.workers, _init_worker,
+                                              (self.schema, row_fields, self.examples))
+        else:
+            self._validator = fast_validator.FastValidator(self.schema)
+
+    def add(self, shaped):
+        if self.fraction < 1.0 and self._random.random() >= self.fraction:
+            self.report.skipped += 1
+            return
+        if self._pool is None:
+            _check(self._validator, self.schema, self._row_fields, shaped, self.report)
+            return
+        self._batch.append(shaped)
+        if len(self._batch) >= self.batch_size:
+            self._submit()
+
+    def _submit(self):
+        self._pending.append(self._pool.apply_async(_check_batch, (self._batch,)))
+        self._batch = []
+        # bound the batches in flight so a slow pool cannot fill up memory
+        while len(self._pending) > 2 * self.workers:
+            self.report.merge(self._pending.pop(0).get())
+
+    def close(self):
+        """Wait for outstanding batches; returns the report"""
+        if self._pool is not None:
+            try:
+                if self._batch:
+                    self._submit()
+                for result in self._pending:
+                    self.report.merge(result.get())
+                self._pending = []
+                self._pool.close()
+            finally:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+        return self.report